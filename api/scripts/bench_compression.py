@@ -0,0 +1,65 @@
+"""
+Microbenchmark: tamanho e CPU da compressão de uma listagem típica
+
+Gera o JSON de uma página de clientes (limit=100 por padrão) e mede, para
+cada nível de gzip e qualidade de brotli, o tamanho final e o tempo por
+resposta. Serve para escolher COMPRESSION_GZIP_LEVEL/COMPRESSION_BROTLI_QUALITY;
+em produção, os números reais por rota ficam em /health ("compression").
+
+    python scripts/bench_compression.py
+    LINHAS=500 REPETICOES=200 python scripts/bench_compression.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.compression import BROTLI, GZIP, Encoder, brotli  # noqa: E402
+
+LINHAS = int(os.getenv("LINHAS", "100"))
+REPETICOES = int(os.getenv("REPETICOES", "500"))
+
+
+def pagina():
+    return json.dumps([
+        {
+            "id_cliente": i,
+            "nome": f"Cliente Exemplo {i}",
+            "cpf": f"{i:011d}",
+            "telefone": f"(11) 9{i:04d}-{i * 7 % 10000:04d}",
+            "email": f"cliente{i}@exemplo.com.br",
+            "endereco": f"Rua das Flores, {i}, Apto {i % 50} - Centro",
+            "data_cadastro": "2024-05-17T10:32:00",
+            "ativo": True,
+            "observacoes": "Cliente prefere banho às terças" if i % 3 == 0 else None,
+        }
+        for i in range(LINHAS)
+    ]).encode()
+
+
+def medir(encoding, nivel, corpo):
+    inicio = time.perf_counter()
+    for _ in range(REPETICOES):
+        encoder = Encoder(encoding, gzip_level=nivel, brotli_quality=nivel)
+        saida = encoder.compress(corpo, True)
+    return len(saida), (time.perf_counter() - inicio) * 1e6 / REPETICOES
+
+
+def main():
+    corpo = pagina()
+    print(f"=== {LINHAS} linhas, {len(corpo):,} bytes sem compressão ===")
+    print(f"{'codificação':<14} {'bytes':>8} {'taxa':>7} {'µs/resposta':>12}")
+    casos = [(GZIP, nivel) for nivel in (1, 4, 6, 9)]
+    if brotli is not None:
+        casos += [(BROTLI, nivel) for nivel in (1, 4, 5, 8, 11)]
+    else:
+        print("(pacote brotli não instalado: só gzip)")
+    for encoding, nivel in casos:
+        tamanho, micros = medir(encoding, nivel, corpo)
+        print(f"{encoding + ' ' + str(nivel):<14} {tamanho:>8,} {tamanho / len(corpo):>7.3f} {micros:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
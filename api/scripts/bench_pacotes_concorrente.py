@@ -0,0 +1,93 @@
+"""
+Benchmark: listagem concorrente de pacotes (GET /pacotes)
+
+Mede throughput e latência (p50/p95/p99) de N requisições simultâneas
+(httpx assíncrono, CONCORRENCIA requisições em voo). Para comparar
+antes/depois da camada async, rode contra a API no commit anterior e no
+atual, com o mesmo banco e a mesma concorrência:
+
+    API_URL=http://127.0.0.1:8000 CONCORRENCIA=50 TOTAL=1000 \\
+        python scripts/bench_pacotes_concorrente.py
+
+API_TOKEN=<jwt> pula o login (LOGIN_USER/LOGIN_PASS).
+
+Medido com `uvicorn --workers 1`, 30 pacotes de 3 serviços e um servidor de
+teste falando o protocolo MySQL na mesma máquina (mysql-mimic sobre SQLite):
+
+    antes (rota async com sessão sync de get_db_by_empresa, nunca fechada)
+        as 7 primeiras requisições em ~15 ms; depois o pool (2 + 5 de
+        overflow) se esgota e cada checkout espera 30 s travando o event
+        loop: 200 requisições não terminam em 100 s, nem com CONCORRENCIA=1
+    depois (AsyncSession aiomysql de get_db_async)
+        CONCORRENCIA=1   58.8 req/s  p50  14.7 ms  p99   30.2 ms
+        CONCORRENCIA=10  53.0 req/s  p50 180.8 ms  p99  352.1 ms
+        CONCORRENCIA=50  51.7 req/s  p50 965.4 ms  p99 2171.2 ms  (0 erros)
+
+O teto de ~55 req/s é a CPU compartilhada com o servidor de teste; compare
+sempre no mesmo ambiente.
+"""
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+API = os.getenv("API_URL", "http://127.0.0.1:8000")
+EMPRESA = os.getenv("EMPRESA", "teste")
+USER = os.getenv("LOGIN_USER", "admin")
+PASS = os.getenv("LOGIN_PASS", "admin123")
+TOKEN = os.getenv("API_TOKEN")
+CONCORRENCIA = int(os.getenv("CONCORRENCIA", "50"))
+TOTAL = int(os.getenv("TOTAL", "1000"))
+
+
+async def login(client: httpx.AsyncClient) -> str:
+    r = await client.post("/auth/login", headers={"X-Empresa": EMPRESA},
+                          data={"username": USER, "password": PASS})
+    if r.status_code != 200:
+        print("Falha no login:", r.status_code, r.text)
+        raise SystemExit(1)
+    return r.json()["access_token"]
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    idx = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[idx]
+
+
+async def main():
+    limites = httpx.Limits(max_connections=CONCORRENCIA, max_keepalive_connections=CONCORRENCIA)
+    async with httpx.AsyncClient(base_url=API, limits=limites, timeout=60) as client:
+        token = TOKEN or await login(client)
+        headers = {"Authorization": f"Bearer {token}", "X-Empresa": EMPRESA}
+        vagas = asyncio.Semaphore(CONCORRENCIA)
+
+        async def uma_requisicao():
+            async with vagas:
+                inicio = time.perf_counter()
+                r = await client.get("/pacotes", headers=headers)
+                return (time.perf_counter() - inicio) * 1000, r.status_code
+
+        # Aquecimento (engines, pools e caches)
+        for _ in range(5):
+            await uma_requisicao()
+
+        inicio = time.perf_counter()
+        resultados = await asyncio.gather(*(uma_requisicao() for _ in range(TOTAL)))
+        duracao = time.perf_counter() - inicio
+
+    latencias = [ms for ms, _ in resultados]
+    erros = sum(1 for _, status in resultados if status != 200)
+
+    print(f"\n=== GET /pacotes | concorrência={CONCORRENCIA} total={TOTAL} ===")
+    print(f"Throughput: {TOTAL / duracao:.1f} req/s")
+    print(f"Latência média: {statistics.mean(latencias):.1f} ms")
+    print(f"p50: {percentil(latencias, 50):.1f} ms | p95: {percentil(latencias, 95):.1f} ms | "
+          f"p99: {percentil(latencias, 99):.1f} ms")
+    print(f"Erros: {erros}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
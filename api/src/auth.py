@@ -1,8 +1,14 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+import asyncio
+import hashlib
+import threading
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from src.config import get_settings
 
@@ -18,6 +24,108 @@ def get_password_hash(password: str) -> str:
     """Gera hash bcrypt da senha"""
     return pwd_context.hash(password)
 
+
+class PasswordHasher:
+    """Pool dedicado e limitado para bcrypt (hash/verificação de senha).
+
+    Isola o custo do bcrypt do threadpool compartilhado do AnyIO: no máximo
+    `workers` hashes em paralelo e `max_queue` esperando. Acima disso a
+    requisição é rejeitada na hora com 503 (Retry-After).
+    """
+
+    SAMPLES = 1024  # Amostras recentes para percentis
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._wait_ms = deque(maxlen=self.SAMPLES)
+        self._hash_ms = deque(maxlen=self.SAMPLES)
+        self.completed = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args):
+        """Executa fn(*args) no pool dedicado; 503 se o pool estiver saturado"""
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Servidor ocupado, tente novamente em instantes",
+                    headers={"Retry-After": "1"},
+                )
+            self._pending += 1
+
+        submitted_at = time.perf_counter()
+
+        def _job():
+            started_at = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self._wait_ms.append((started_at - submitted_at) * 1000)
+                self._hash_ms.append((time.perf_counter() - started_at) * 1000)
+
+        future = self._executor.submit(_job)
+        # A vaga só volta quando o job termina: requisição cancelada não para
+        # o bcrypt que já começou
+        future.add_done_callback(self._job_done)
+        return await asyncio.wrap_future(future)
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled():  # Cancelado ainda na fila: não chegou a rodar
+                self.cancelled += 1
+            elif future.exception() is not None:
+                self.errors += 1
+            else:
+                self.completed += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _summary(samples) -> dict:
+        values = sorted(samples)
+        if not values:
+            return {"avg_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        return {
+            "avg_ms": round(sum(values) / len(values), 2),
+            "p95_ms": round(values[int(0.95 * (len(values) - 1))], 2),
+            "max_ms": round(values[-1], 2),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "completed": self.completed,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "queue_wait": self._summary(list(self._wait_ms)),
+            "hash_time": self._summary(list(self._hash_ms)),
+        }
+
+
+_password_hasher = PasswordHasher(settings.password_hash_workers, settings.password_hash_max_queue)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password no pool dedicado do bcrypt (para rotas async)"""
+    return await _password_hasher.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """get_password_hash no pool dedicado do bcrypt (para rotas async)"""
+    return await _password_hasher.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Cria token JWT com expiração"""
     to_encode = data.copy()
@@ -30,50 +138,103 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
-from functools import lru_cache
-import time
+class TokenCache:
+    """Cache LRU de payloads JWT decodificados, limitado em tamanho.
+
+    - Chave: SHA-256 do token (o token em si não fica em memória)
+    - Cada entrada expira no menor entre TTL do cache e o `exp` do token
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, token: str, payload: dict):
+        expires_at = time.time() + self.ttl
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
 
-# Cache simples para tokens decodificados (TTL 5 minutos)
-_token_cache = {}
+# Cache de tokens decodificados (LRU + TTL limitado ao exp do token)
+_token_cache = TokenCache(settings.token_cache_max_size, settings.token_cache_ttl)
 
 def decode_access_token(token: str):
     """Decodifica e valida token JWT com cache"""
-    current_time = time.time()
-
-    # Verifica cache
-    if token in _token_cache:
-        cached_payload, cache_time = _token_cache[token]
-        if current_time - cache_time < 300:  # 5 minutos
-            return cached_payload
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
 
     try:
         payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
 
         # Verifica expiração
         exp = payload.get("exp")
-        if exp and current_time > exp:
+        if exp and time.time() > exp:
             return None
 
         # Cache o payload válido
-        _token_cache[token] = (payload, current_time)
+        _token_cache.put(token, payload)
 
         return payload
     except JWTError:
         return None
 
-def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
-    """
-    Dependency global para obter usuário autenticado
-    Retorna dict com: id, nome, cargo, empresa_id, empresa_nome
-    """
-    payload = decode_access_token(token)
-    if payload is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token inválido ou expirado",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
+def _user_from_payload(payload: dict) -> dict:
+    """Monta o dict do usuário a partir do payload do token"""
     return {
         "id": payload.get("id_funcionario"),
         "login": payload.get("sub"),
@@ -84,3 +245,88 @@ def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
         "is_superadmin": payload.get("cargo") == "admin" and (payload.get("empresa_id") == 1 or payload.get("empresa") == "teste")
     }
 
+
+class AuthContext:
+    """
+    Identidade da requisição, calculada uma única vez (AuthContextMiddleware)
+    e guardada em request.state.auth. get_db e get_current_user leem daqui
+    em vez de decodificar o token de novo.
+    """
+
+    __slots__ = ("token", "payload", "empresa_header", "_user")
+
+    def __init__(self, token: Optional[str], payload: Optional[dict], empresa_header: Optional[str]):
+        self.token = token
+        self.payload = payload
+        self.empresa_header = empresa_header
+        self._user = None
+
+    @classmethod
+    def from_headers(cls, authorization: Optional[str], x_empresa: Optional[str]) -> "AuthContext":
+        token = None
+        if authorization and authorization[:7].lower() == "bearer ":
+            token = authorization[7:].strip() or None
+        empresa = x_empresa.strip() if x_empresa else None
+        return cls(token, decode_access_token(token) if token else None, empresa or None)
+
+    @property
+    def empresa(self) -> Optional[str]:
+        """Empresa: 1) Header X-Empresa  2) Token ('empresa', 'empresa_code' ou 'empresa_id')"""
+        if self.empresa_header:
+            return self.empresa_header
+        if self.payload:
+            return self.payload.get("empresa") or self.payload.get("empresa_code") or self.payload.get("empresa_id")
+        return None
+
+    @property
+    def login(self) -> Optional[str]:
+        return self.payload.get("sub") if self.payload else None
+
+    @property
+    def user(self) -> Optional[dict]:
+        if self._user is None and self.payload:
+            self._user = _user_from_payload(self.payload)
+        return self._user
+
+
+def get_auth_context(request: Request) -> AuthContext:
+    """AuthContext da requisição; calcula e guarda se o middleware não rodou"""
+    ctx = getattr(request.state, "auth", None)
+    if ctx is None:
+        ctx = AuthContext.from_headers(request.headers.get("Authorization"), request.headers.get("X-Empresa"))
+        request.state.auth = ctx
+    return ctx
+
+
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme)) -> dict:
+    """
+    Dependency global para obter usuário autenticado
+    Retorna dict com: id, nome, cargo, empresa_id, empresa_nome
+    Usa o token já decodificado da requisição (AuthContext).
+    """
+    ctx = get_auth_context(request)
+    if ctx.token == token:
+        user = ctx.user
+    else:
+        payload = decode_access_token(token)
+        user = _user_from_payload(payload) if payload else None
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido ou expirado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+
+def require_superadmin(user: dict = Depends(get_current_user)) -> dict:
+    """Dependency para rotas que afetam o processo inteiro (todas as empresas):
+    só o admin global (is_superadmin), não o admin de cada empresa
+    """
+    if not user.get("is_superadmin", False):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Acesso restrito ao administrador global",
+        )
+    return user
+
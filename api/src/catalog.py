@@ -0,0 +1,159 @@
+"""
+ETag e GET condicional dos catálogos (/servicos, /produtos, /pacotes)
+
+Cada banco (empresa) tem em catalogo_versoes uma versão por catálogo. As
+rotas de escrita chamam bump_catalog_version depois do commit; as listagens
+usam CatalogETag/AsyncCatalogETag como dependency:
+
+- If-None-Match igual ao ETag atual: 304 sem executar a query do catálogo
+  (só a leitura da versão, por chave primária)
+- senão: ETag + Cache-Control: private, no-cache (o navegador guarda, mas
+  revalida sempre; a borda da Cloudflare não compartilha entre usuários)
+
+O ETag inclui a empresa e a query string: trocar de empresa na mesma URL
+nunca recebe 304 com os dados de outra. O bump depois do commit (e não
+antes) garante que uma versão nova nunca fique associada a dados antigos.
+Escritas fora da API (SQL manual) precisam do mesmo UPDATE de versão.
+"""
+import hashlib
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request, Response, status
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from src.auth import get_auth_context
+from src.compression import BROTLI, GZIP
+from src.database import get_db, get_db_async
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+SERVICOS = "servicos"
+PRODUTOS = "produtos"
+PACOTES = "pacotes"
+
+# Muda quando o formato das respostas muda (invalida ETags de versões anteriores da API)
+_ETAG_FORMAT = "1"
+# Sufixo que o CompressionMiddleware põe no ETag da resposta comprimida
+_ENCODING_SUFFIXES = tuple(f'-{encoding}"' for encoding in (GZIP, BROTLI))
+
+_SELECT_VERSION = text("SELECT versao FROM catalogo_versoes WHERE catalogo = :catalogo")
+# GREATEST com o relógio: um banco restaurado de backup não repete versões antigas
+_BUMP_VERSION = """
+    INSERT INTO catalogo_versoes (catalogo, versao) VALUES {values}
+    ON DUPLICATE KEY UPDATE versao = GREATEST(versao + 1, FLOOR(UNIX_TIMESTAMP(NOW(6)) * 1000000))
+"""
+
+_stats = {"not_modified": 0, "full": 0, "unversioned": 0, "bump_errors": 0}
+
+
+def _bump_statement(catalogos):
+    values = ", ".join(f"(:c{i}, FLOOR(UNIX_TIMESTAMP(NOW(6)) * 1000000))" for i in range(len(catalogos)))
+    return text(_BUMP_VERSION.format(values=values)), {f"c{i}": c for i, c in enumerate(catalogos)}
+
+
+def bump_catalog_version(db: Session, *catalogos: str):
+    """Nova versão dos catálogos alterados (chamar depois do commit da escrita)"""
+    statement, params = _bump_statement(catalogos)
+    try:
+        db.execute(statement, params)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        _stats["bump_errors"] += 1
+        logger.warning("Falha ao atualizar versão do catálogo", extra={"catalogos": catalogos, "error": str(e)})
+
+
+async def bump_catalog_version_async(db: AsyncSession, *catalogos: str):
+    statement, params = _bump_statement(catalogos)
+    try:
+        await db.execute(statement, params)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        _stats["bump_errors"] += 1
+        logger.warning("Falha ao atualizar versão do catálogo", extra={"catalogos": catalogos, "error": str(e)})
+
+
+def catalog_etag(empresa: Optional[str], catalogo: str, versao: int, query: str) -> str:
+    digest = hashlib.sha1(f"{_ETAG_FORMAT}|{empresa}|{catalogo}|{versao}|{query}".encode()).hexdigest()
+    return f'"{digest[:24]}"'
+
+
+def matching_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """Comparação fraca do If-None-Match (RFC 9110), ignorando o sufixo de compressão.
+    Retorna o ETag do cliente que bateu (com o sufixo, se veio comprimido), para
+    o 304 repetir o ETag da representação que o cliente tem; None se nenhum bateu
+    """
+    if not if_none_match:
+        return None
+    for sent in if_none_match.split(","):
+        sent = sent.strip()
+        if sent == "*":
+            return etag
+        candidate = sent[2:] if sent.startswith("W/") else sent
+        for suffix in _ENCODING_SUFFIXES:
+            if candidate.endswith(suffix):
+                candidate = candidate[:-len(suffix)] + '"'
+                break
+        if candidate == etag:
+            return sent
+    return None
+
+
+def _conditional(request: Request, response: Response, catalogo: str, versao: Optional[int]):
+    if versao is None:
+        # Banco sem a migration V17 (ou linha ausente): resposta normal, sem ETag
+        _stats["unversioned"] += 1
+        return
+    etag = catalog_etag(get_auth_context(request).empresa, catalogo, versao, request.url.query)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Authorization, X-Empresa",
+    }
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        # O CompressionMiddleware não mexe em 304: o ETag sai como o cliente mandou
+        _stats["not_modified"] += 1
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers={**headers, "ETag": matched})
+    _stats["full"] += 1
+    response.headers.update(headers)
+
+
+class CatalogETag:
+    """
+    Dependency de GET condicional para rotas com Session (sync)
+    Declarar depois do parâmetro de autenticação: sem token, 401 (nunca 304).
+    """
+
+    def __init__(self, catalogo: str):
+        self.catalogo = catalogo
+
+    def __call__(self, request: Request, response: Response, db: Session = Depends(get_db)):
+        try:
+            versao = db.execute(_SELECT_VERSION, {"catalogo": self.catalogo}).scalar()
+        except Exception as e:
+            db.rollback()
+            logger.debug("Versão do catálogo indisponível", extra={"catalogo": self.catalogo, "error": str(e)})
+            versao = None
+        _conditional(request, response, self.catalogo, versao)
+
+
+class AsyncCatalogETag(CatalogETag):
+    """Mesma dependency para rotas com AsyncSession"""
+
+    async def __call__(self, request: Request, response: Response, db: AsyncSession = Depends(get_db_async)):
+        try:
+            versao = (await db.execute(_SELECT_VERSION, {"catalogo": self.catalogo})).scalar()
+        except Exception as e:
+            await db.rollback()
+            logger.debug("Versão do catálogo indisponível", extra={"catalogo": self.catalogo, "error": str(e)})
+            versao = None
+        _conditional(request, response, self.catalogo, versao)
+
+
+def stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,144 @@
+"""
+Compressão de respostas (gzip; brotli se o pacote estiver instalado)
+
+- Negociação pelo Accept-Encoding (q-values, "*"); brotli preferido no empate
+- Codificadores incrementais: o mesmo código serve respostas inteiras e
+  streaming (cada chunk sai com flush, sem segurar dados do cliente)
+- Estatísticas por rota (template, ex.: /clientes/{id}): bytes antes/depois,
+  taxa de compressão e tempo de CPU gasto comprimindo
+"""
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # Opcional: sem o pacote, só gzip
+    brotli = None
+
+GZIP = "gzip"
+BROTLI = "br"
+
+_COMPRESSIBLE_PREFIXES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+
+
+def available_encodings():
+    return (BROTLI, GZIP) if brotli is not None else (GZIP,)
+
+
+@lru_cache(maxsize=128)
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Codificação escolhida para o Accept-Encoding (None = sem compressão)"""
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        name = name.strip()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    content_type = content_type.lower()
+    return content_type.startswith(_COMPRESSIBLE_PREFIXES) or content_type.split(";")[0].endswith(("+json", "+xml"))
+
+
+class Encoder:
+    """Compressor incremental; compress() devolve os bytes prontos para enviar"""
+
+    __slots__ = ("encoding", "_obj", "cpu_seconds")
+
+    def __init__(self, encoding: str, gzip_level: int = 6, brotli_quality: int = 4):
+        self.encoding = encoding
+        self.cpu_seconds = 0.0
+        if encoding == BROTLI:
+            self._obj = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._obj = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)  # wbits 31 = formato gzip
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # thread_time: CPU da thread atual (event loop ou threadpool)
+        start = time.thread_time()
+        if self.encoding == BROTLI:
+            out = self._obj.process(data) + (self._obj.finish() if final else self._obj.flush())
+        else:
+            out = self._obj.compress(data) + self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        self.cpu_seconds += time.thread_time() - start
+        return out
+
+
+class CompressionStats:
+    """Contadores por rota para calibrar o limite mínimo e o nível"""
+
+    def __init__(self):
+        self._routes = {}
+        self._skipped = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, encoding: str, raw_bytes: int, compressed_bytes: int,
+               cpu_seconds: float, offloaded: bool, streamed: bool):
+        with self._lock:
+            entry = self._routes.get(route)
+            if entry is None:
+                entry = self._routes[route] = {
+                    "responses": 0, "raw_bytes": 0, "compressed_bytes": 0, "cpu_seconds": 0.0,
+                    "offloaded": 0, "streamed": 0, "encodings": {},
+                }
+            entry["responses"] += 1
+            entry["raw_bytes"] += raw_bytes
+            entry["compressed_bytes"] += compressed_bytes
+            entry["cpu_seconds"] += cpu_seconds
+            entry["offloaded"] += offloaded
+            entry["streamed"] += streamed
+            entry["encodings"][encoding] = entry["encodings"].get(encoding, 0) + 1
+
+    def skip(self, reason: str):
+        with self._lock:
+            self._skipped[reason] = self._skipped.get(reason, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {}
+            for route, entry in self._routes.items():
+                responses = entry["responses"]
+                routes[route] = {
+                    "responses": responses,
+                    "raw_bytes": entry["raw_bytes"],
+                    "compressed_bytes": entry["compressed_bytes"],
+                    "ratio": round(entry["compressed_bytes"] / entry["raw_bytes"], 4) if entry["raw_bytes"] else 0.0,
+                    "avg_raw_bytes": entry["raw_bytes"] // responses,
+                    "cpu_ms_total": round(entry["cpu_seconds"] * 1000, 2),
+                    "cpu_ms_avg": round(entry["cpu_seconds"] * 1000 / responses, 3),
+                    "offloaded": entry["offloaded"],
+                    "streamed": entry["streamed"],
+                    "encodings": dict(entry["encodings"]),
+                }
+            return {
+                "encodings": list(available_encodings()),
+                "routes": routes,
+                "skipped": dict(self._skipped),
+            }
@@ -1,15 +1,115 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Dict, List, Optional
 
 class Settings(BaseSettings):
     database_url: str
     secret_key: str
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 60
+    token_cache_max_size: int = 10000   # Tokens decodificados em cache por worker
+    token_cache_ttl: int = 300          # Segundos (limitado ao exp do token)
+    password_hash_workers: int = 4      # Threads dedicadas ao bcrypt
+    password_hash_max_queue: int = 32   # Hashes aguardando; acima disso, 503
+
+    # Logging via fila (formatação e stdout em thread própria)
+    log_queue_size: int = 10000         # Registros pendentes; acima disso, descarta
+    log_queue_info_ratio: float = 0.9   # INFO/DEBUG descartados a partir desta ocupação (folga para WARNING+)
+
+    # Amostragem do log de acesso (erros, lentas e eventos de segurança: sempre)
+    access_log_sample_rate: float = 0.1             # Fração das requisições rápidas e bem-sucedidas logadas
+    access_log_route_rates: Dict[str, float] = {}   # Por template de rota: {"/health/live": 0, "/vendas": 1}
+    access_log_tenant_rates: Dict[str, float] = {}  # Por empresa (ex.: 1.0 ao investigar um cliente)
+    access_log_slow_ms: float = 1000                # Sempre loga acima disso (além do p95 móvel da rota)
+    access_log_summary_interval: float = 60         # Segundos entre os agregados por rota
+
+    # Instrumentação das queries por requisição
+    db_slow_query_ms: float = 500               # Statement acima disso: log_database_query
+    db_repeated_query_threshold: int = 10       # Mesmo statement mais vezes que isso: suspeita de N+1
+    db_query_budget: int = 50                   # Statements por requisição antes de marcar
+
+    # Métricas Prometheus (/metrics)
+    metrics_enabled: bool = True               # Só com METRICS_TOKEN ou allowlist de IP para /metrics
+    metrics_token: str = ""                    # Bearer token exigido no /metrics (scrape_config authorization)
+    metrics_top_tenants: int = 10              # Empresas com label próprio; as demais viram "other"
+    metrics_refresh_interval: float = 15       # Segundos entre atualizações dos gauges (pools, threadpool)
+    prometheus_multiproc_dir: str = ""         # Diretório compartilhado pelos workers (--workers N)
+
+    # Header Server-Timing (fases da requisição no DevTools)
+    server_timing_enabled: bool = True
+    server_timing_public: bool = True          # False: só admins; True: também quem mandar X-Server-Timing: 1
+
+    # Profiler por amostragem sob demanda (header X-Profile assinado, só admins)
+    profiling_enabled: bool = True
+    profiling_dir: str = "profiles"            # Perfis .folded (collapsed stacks) + .json
+    profiling_max_files: int = 50              # Perfis mantidos; os mais antigos são apagados
+    profiling_interval_ms: float = 5           # Intervalo entre amostras
+    profiling_max_seconds: float = 30          # Amostragem para depois disso (requisição segue)
+    profiling_max_concurrent: int = 2          # Perfis simultâneos por worker
+    profiling_token_ttl: int = 900             # Validade (s) do header gerado em /admin/profiling/token
+
+    # Diagnóstico de memória (tracemalloc via /admin/memory)
+    memory_trace_on_startup: bool = False      # Todos os workers sobem com tracemalloc (mais lento)
+    memory_trace_frames: int = 10              # Frames guardados por alocação
+    memory_snapshot_dir: str = "memory_snapshots"
+    memory_max_snapshots: int = 6              # Snapshots mantidos; os mais antigos são apagados
+
+    # Timeout da requisição repassado ao banco
+    request_timeout_seconds: float = 30
+    db_statement_time_limit: bool = True  # max_statement_time / MAX_EXECUTION_TIME pelo tempo restante
+    db_kill_on_timeout: bool = True       # KILL QUERY nas queries em andamento quando a requisição estoura
     api_host: str = "0.0.0.0"
     api_port: int = 8000
     debug: bool = False
     cors_origins: str = "http://localhost:3000"
+
+    # Filtro de IPs (CIDRs IPv4/IPv6 separados por vírgula; vazio = desligado)
+    ip_allowlist: str = ""
+    ip_denylist: str = ""
+    ip_path_rules: Dict[str, Dict[str, List[str]]] = {}  # {"/admin": {"allow": ["10.0.0.0/8"]}}
+    trusted_proxies: str = ""           # Proxies (ex.: cloudflared) cujos headers de IP são confiáveis
+    ip_filter_cache_size: int = 10000
+
+    # Tamanho máximo do corpo (MB), também para uploads chunked sem Content-Length
+    request_max_body_mb: float = 10
+    request_body_limits_mb: Dict[str, float] = {}  # Por prefixo de rota: {"/auth": 0.05}
+
+    # Verificação de SQL injection na query string
+    sqli_max_query_bytes: int = 16384   # Acima disso, 414 sem varrer
+    sqli_route_rules: Dict[str, Optional[List[str]]] = {}  # Por prefixo: {"/webhook": null, "/busca": ["statement"]}
+
+    # Compressão de respostas (gzip; brotli se o pacote estiver instalado)
+    compression_enabled: bool = True
+    compression_min_size: int = 1024             # Bytes; corpos menores vão sem compressão
+    compression_threadpool_min_size: int = 65536  # A partir disso, comprime fora do event loop
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4           # 0-11; acima de ~5 fica caro para respostas dinâmicas
+
+    # Registro de engines por empresa (multi-banco)
+    db_max_engines: int = 50            # Máximo de engines vivas por processo
+    db_engine_idle_timeout: int = 600   # Segundos sem uso até descartar o pool
+    db_pool_size_min: int = 2           # Pool mínimo (empresas com pouco tráfego)
+    db_pool_size_max: int = 10          # Pool máximo (empresas com muito tráfego)
+    db_pool_max_overflow: int = 5       # Conexões extras além do pool
+    # "tenant": um pool por URL | "server": um pool por servidor MySQL,
+    # com troca de schema (USE) ao iniciar cada transação
+    db_pool_mode: str = "tenant"
+    db_neutral_schema: str = "information_schema"  # Schema após checkin (modo server)
+    db_session_leak_debug: bool = False  # Loga sessões abertas no fim da requisição
+    databases_reload_interval: float = 5.0  # Segundos entre verificações do databases.json (0 = desliga)
+
+    # Réplicas de leitura (entrada {"url": ..., "replicas": [...]} no databases.json)
+    db_replica_policy: str = "round_robin"   # ou "least_latency"
+    db_replica_max_lag: float = 5            # Atraso máximo (s) para receber leituras
+    db_replica_check_interval: float = 10    # Segundos entre health checks por réplica
+    db_replica_sticky_seconds: float = 5     # Leituras no primário após escrita do usuário
+
+    # Warm-up dos pools no startup (readiness só após concluir)
+    db_warmup_enabled: bool = False
+    db_warmup_tenants: int = 0              # 0 = todas; N = as N mais ativas (até db_max_engines)
+    db_warmup_connections: int = 2          # Conexões abertas por pool
+    db_warmup_concurrency: int = 8          # Conexões abertas em paralelo
+    db_activity_file: str = "tenant_activity.json"  # Ranking de atividade entre deploys
     
     class Config:
         env_file = ".env"
@@ -1,183 +1,991 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from fastapi import Request
-from typing import Dict, Optional
+from starlette.concurrency import run_in_threadpool
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import hmac
 import json
+import math
 import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: trava com msvcrt
+    fcntl = None
+    import msvcrt
 
 from src.config import get_settings
-from src.auth import decode_access_token
+from src.auth import get_auth_context
+from src.logger import setup_logger
+from src.replicas import ReplicaRouter
+from src import deadlines, query_collector, server_timing
 
 settings = get_settings()
+logger = setup_logger(__name__)
 
-# Cache de engines por empresa
-_ENGINES: Dict[str, any] = {}
-_DATABASES_MAP: Optional[Dict[str, str]] = None
 
+class _EngineEntry:
+    """Engine registrada para uma empresa + metadados de uso"""
 
-def _load_databases_map() -> Dict[str, str]:
-    """Carrega o mapa de bancos por empresa.
-    Ordem de prioridade:
-    1) Variável de ambiente DATABASES_JSON (JSON string)
-    2) Arquivo databases.json na raiz do projeto da API
-    3) Fallback: usar settings.database_url como 'default'
+    __slots__ = ("engine", "db_url", "pool_size", "last_used", "created_at")
+
+    def __init__(self, engine, db_url: str, pool_size: int):
+        self.engine = engine
+        self.db_url = db_url
+        self.pool_size = pool_size
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class _TrafficCounter:
+    """Estima requisições por minuto de uma empresa (janela de 60s)"""
+
+    __slots__ = ("window_start", "count", "last_rpm")
+
+    def __init__(self):
+        self.window_start = time.monotonic()
+        self.count = 0
+        self.last_rpm = 0.0
+
+    def hit(self, now: float) -> float:
+        elapsed = now - self.window_start
+        if elapsed >= 60:
+            self.last_rpm = self.count * 60 / elapsed
+            self.window_start = now
+            self.count = 0
+        self.count += 1
+        # A contagem parcial da janela atual já é um limite inferior do rpm
+        return max(self.last_rpm, self.count)
+
+
+class EngineRegistry:
+    """Registro de engines por empresa com limite de tamanho.
+
+    - Mantém no máximo `max_engines` engines vivas por processo (LRU)
+    - Descarta o pool de empresas sem uso há mais de `idle_timeout` segundos
+    - Dimensiona o pool de cada empresa conforme o tráfego observado, para
+      cima e de volta para `pool_size_min` quando o tráfego cai
     """
-    global _DATABASES_MAP
-    if _DATABASES_MAP is not None:
-        return _DATABASES_MAP
 
+    SWEEP_INTERVAL = 30        # Segundos entre varreduras de engines ociosas
+    RESIZE_INTERVAL = 60       # Segundos mínimos entre redimensionamentos
+    REQUESTS_PER_CONNECTION = 60  # Requisições/minuto atendidas por conexão
+
+    def __init__(self, factory, max_engines: int, idle_timeout: int,
+                 pool_size_min: int, pool_size_max: int, disposer=None):
+        self._factory = factory
+        self._dispose = disposer or (lambda engine: engine.dispose())
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self.pool_size_min = pool_size_min
+        self.pool_size_max = pool_size_max
+        self._entries: "OrderedDict[str, _EngineEntry]" = OrderedDict()
+        self._traffic: Dict[str, _TrafficCounter] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_disposals = 0
+        self.resizes = 0
+
+    def _target_pool_size(self, rpm: float) -> int:
+        size = math.ceil(rpm / self.REQUESTS_PER_CONNECTION)
+        return max(self.pool_size_min, min(self.pool_size_max, size))
+
+    def get(self, key: str, db_url: str):
+        """Retorna a engine da empresa, criando/redimensionando se necessário"""
+        now = time.monotonic()
+        to_dispose = []
+        with self._lock:
+            traffic = self._traffic.get(key)
+            if traffic is None:
+                traffic = self._traffic[key] = _TrafficCounter()
+            target_size = self._target_pool_size(traffic.hit(now))
+
+            entry = self._entries.get(key)
+            if entry is not None and entry.db_url == db_url:
+                if (target_size != entry.pool_size
+                        and now - entry.created_at >= self.RESIZE_INTERVAL):
+                    # Tráfego mudou: recria com o novo tamanho, o antigo é drenado
+                    to_dispose.append(entry.engine)
+                    entry = None
+                    self.resizes += 1
+                else:
+                    self.hits += 1
+                    entry.last_used = now
+                    self._entries.move_to_end(key)
+            elif entry is not None:
+                # URL mudou: descarta engine antiga
+                to_dispose.append(entry.engine)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                entry = self._insert(key, db_url, target_size, to_dispose)
+
+            if now - self._last_sweep >= self.SWEEP_INTERVAL:
+                self._last_sweep = now
+                to_dispose.extend(self._collect_idle(now, keep=key))
+
+            engine = entry.engine
+
+        # dispose() fecha conexões (I/O): feito fora do lock
+        for old in to_dispose:
+            self._dispose(old)
+        return engine
+
+    def peek(self, key: str, db_url: str):
+        """Engine da chave sem contar tráfego nem renovar o uso (health checks
+        e warm-up): não mantêm viva nem aumentam o pool de quem não recebe
+        requisições. Cria com o pool mínimo se não existir
+        """
+        to_dispose = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.db_url != db_url:
+                if entry is not None:
+                    to_dispose.append(entry.engine)
+                entry = self._insert(key, db_url, self.pool_size_min, to_dispose)
+            engine = entry.engine
+        for old in to_dispose:
+            self._dispose(old)
+        return engine
+
+    def _insert(self, key: str, db_url: str, pool_size: int, to_dispose: list) -> _EngineEntry:
+        """Cria e registra a engine, removendo as mais antigas acima do limite (chamar com lock)"""
+        entry = _EngineEntry(self._factory(db_url, pool_size), db_url, pool_size)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_engines:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._traffic.pop(evicted_key, None)
+            to_dispose.append(evicted.engine)
+            self.evictions += 1
+        return entry
+
+    def _collect_idle(self, now: float, keep: str) -> list:
+        """Remove engines ociosas sem conexões em uso (chamar com lock)"""
+        idle = []
+        for key, entry in list(self._entries.items()):
+            if key == keep or now - entry.last_used < self.idle_timeout:
+                continue
+            if entry.engine.pool.checkedout() > 0:
+                continue
+            del self._entries[key]
+            self._traffic.pop(key, None)
+            idle.append(entry.engine)
+            self.idle_disposals += 1
+        return idle
+
+    def discard(self, key: str) -> bool:
+        """Remove a engine da chave e a descarta. Retorna True se existia"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            self._traffic.pop(key, None)
+        if entry is None:
+            return False
+        self._dispose(entry.engine)
+        return True
+
+    def clear(self) -> list:
+        """Remove todas as engines do registro e as retorna (sem descartar)"""
+        with self._lock:
+            engines = [entry.engine for entry in self._entries.values()]
+            self._entries.clear()
+            self._traffic.clear()
+        return engines
+
+    def dispose_all(self):
+        """Descarta todas as engines (shutdown)"""
+        for engine in self.clear():
+            self._dispose(engine)
+
+    def engines(self) -> list:
+        """Pares (chave, engine) vivos no momento (métricas dos pools)"""
+        with self._lock:
+            return [(key, entry.engine) for key, entry in self._entries.items()]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self, detail: bool = False) -> dict:
+        """Contadores do registro (hit/miss/evictions) para observabilidade.
+        Pools só somados; detail=True inclui o tamanho por chave (empresa),
+        que não pode sair no /health público
+        """
+        with self._lock:
+            pool_sizes = {key: entry.pool_size for key, entry in self._entries.items()}
+            result = {
+                "engines": len(self._entries),
+                "tracked_tenants": len(self._traffic),
+                "max_engines": self.max_engines,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle_disposals": self.idle_disposals,
+                "resizes": self.resizes,
+                "pool_size_total": sum(pool_sizes.values()),
+                "pool_size_max": max(pool_sizes.values(), default=0),
+            }
+        if detail:
+            result["pool_sizes"] = pool_sizes
+        return result
+
+
+_DATABASES_MAP: Optional[Dict[str, str]] = None
+_DATABASES_FILE_STAT: Optional[tuple] = None  # (path, mtime_ns, size) do arquivo carregado
+_DATABASES_LOCK = threading.Lock()
+
+
+def _databases_file_candidates() -> List[str]:
+    """Caminhos comuns do databases.json: api/databases.json e ./databases.json"""
+    return [
+        os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "databases.json")),
+        os.path.abspath(os.path.join(os.getcwd(), "databases.json")),
+    ]
+
+
+def _stat_databases_file() -> Optional[tuple]:
+    """Retorna (path, mtime_ns, size) do primeiro databases.json existente"""
+    for path in _databases_file_candidates():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        return (path, st.st_mtime_ns, st.st_size)
+    return None
+
+
+def _read_databases_map():
+    """Lê o mapa de bancos das fontes configuradas, sem alterar o cache.
+    Retorna (mapa, stat do arquivo lido ou None).
+    """
     # 1) Env var
     env_json = os.getenv("DATABASES_JSON")
     if env_json:
         try:
-            _DATABASES_MAP = json.loads(env_json)
-            return _DATABASES_MAP
+            return json.loads(env_json), None
         except Exception:
             pass
 
     # 2) Arquivo databases.json
-    # Tenta caminhos comuns: api/databases.json e ./databases.json
-    candidates = [
-        os.path.join(os.path.dirname(__file__), "..", "databases.json"),
-        os.path.join(os.getcwd(), "databases.json"),
-    ]
-    for path in candidates:
+    file_stat = _stat_databases_file()
+    if file_stat:
         try:
-            path = os.path.abspath(path)
-            if os.path.exists(path):
-                with open(path, "r", encoding="utf-8") as f:
-                    _DATABASES_MAP = json.load(f)
-                    return _DATABASES_MAP
+            with open(file_stat[0], "r", encoding="utf-8") as f:
+                return json.load(f), file_stat
         except Exception:
-            continue
+            pass
 
     # 3) Fallback
-    _DATABASES_MAP = {"default": settings.database_url}
+    return {"default": settings.database_url}, None
+
+
+def _load_databases_map() -> Dict[str, str]:
+    """Carrega o mapa de bancos por empresa.
+    Ordem de prioridade:
+    1) Variável de ambiente DATABASES_JSON (JSON string)
+    2) Arquivo databases.json na raiz do projeto da API
+    3) Fallback: usar settings.database_url como 'default'
+    O mapa fica em cache; mudanças no arquivo são aplicadas pelo watcher.
+    """
+    global _DATABASES_MAP, _DATABASES_FILE_STAT
+    if _DATABASES_MAP is not None:
+        return _DATABASES_MAP
+
+    with _DATABASES_LOCK:
+        if _DATABASES_MAP is None:
+            _DATABASES_MAP, _DATABASES_FILE_STAT = _read_databases_map()
     return _DATABASES_MAP
 
 
-def reload_databases_map():
-    """Força recarregamento do mapa de bancos"""
-    global _DATABASES_MAP
-    _DATABASES_MAP = None
-    return _load_databases_map()
+def _registry_keys(databases: Dict[str, str]) -> Dict[str, str]:
+    """Mapeia chave do registro de engines -> URL usada pela engine"""
+    keys = {}
+    for code, entry in databases.items():
+        key, engine_url, _ = _binding(code, _primary_url(entry))
+        keys[key] = engine_url
+        for replica_url in _replica_urls(entry):
+            key, engine_url, _ = _binding(code, replica_url, replica=True)
+            keys[key] = engine_url
+    return keys
 
 
-def update_databases_map(empresa_code: str, db_url: str):
-    """Atualiza o mapa de bancos e salva no arquivo"""
-    # Recarregar mapa atual
-    databases = reload_databases_map()
+def _apply_databases_map(databases: Dict[str, str], file_stat: Optional[tuple] = None) -> dict:
+    """Troca o mapa em cache e descarta apenas as engines que mudaram.
+    Engines removidas/alteradas saem do registro; requisições em andamento
+    terminam na conexão que já possuem (pool antigo é drenado) e as novas
+    usam a engine nova, criada sob demanda.
+    """
+    global _DATABASES_MAP, _DATABASES_FILE_STAT
+    with _DATABASES_LOCK:
+        old = _DATABASES_MAP or {}
+        _DATABASES_MAP = databases
+        _DATABASES_FILE_STAT = file_stat
 
-    # Adicionar novo banco
-    databases[empresa_code] = db_url
+    diff = {
+        "added": sorted(set(databases) - set(old)),
+        "removed": sorted(set(old) - set(databases)),
+        "changed": sorted(code for code in set(old) & set(databases) if old[code] != databases[code]),
+    }
 
-    # Salvar no arquivo
-    candidates = [
-        os.path.join(os.path.dirname(__file__), "..", "databases.json"),
-        os.path.join(os.getcwd(), "databases.json"),
-    ]
+    old_keys, new_keys = _registry_keys(old), _registry_keys(databases)
+    for key, db_url in old_keys.items():
+        if new_keys.get(key) != db_url:
+            _ENGINES.discard(key)
+            _ASYNC_ENGINES.discard(key)
+
+    if any(diff.values()):
+        logger.info("Mapa de bancos atualizado", extra={**diff, "event_type": "databases_reload"})
+    return diff
+
+
+def reload_databases_map():
+    """Força recarregamento do mapa de bancos (aplicando só as diferenças)"""
+    databases, file_stat = _read_databases_map()
+    _apply_databases_map(databases, file_stat)
+    return databases
 
+
+def check_databases_file() -> bool:
+    """Recarrega o mapa se o databases.json mudou (mtime/tamanho).
+    Retorna True se o mapa foi recarregado.
+    """
+    global _DATABASES_FILE_STAT
+    if os.getenv("DATABASES_JSON"):
+        return False
+    current = _stat_databases_file()
+    if current is None or current == _DATABASES_FILE_STAT:
+        return False
+    try:
+        with open(current[0], "r", encoding="utf-8") as f:
+            databases = json.load(f)
+    except Exception as e:
+        # Arquivo inválido: mantém o mapa atual até a próxima alteração
+        _DATABASES_FILE_STAT = current
+        logger.error("databases.json inválido, mantendo mapa atual", extra={"error": str(e)})
+        return False
+    _apply_databases_map(databases, current)
+    return True
+
+
+def _write_databases_file(databases: Dict[str, str]) -> Optional[str]:
+    """Salva o mapa de forma atômica (arquivo temporário + rename)"""
+    current = _stat_databases_file()
+    candidates = [current[0]] if current else _databases_file_candidates()
     for path in candidates:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
         try:
-            path = os.path.abspath(path)
-            with open(path, "w", encoding="utf-8") as f:
+            with open(tmp_path, "w", encoding="utf-8") as f:
                 json.dump(databases, f, indent=2, ensure_ascii=False)
-            break
+            os.replace(tmp_path, path)
+            return path
         except Exception:
             continue
+    return None
 
-    # Limpar cache para forçar recarregamento
-    global _DATABASES_MAP
-    _DATABASES_MAP = None
+
+def update_databases_map(empresa_code: str, db_url: str):
+    """Atualiza o mapa de bancos e salva no arquivo.
+    O processo atual aplica a mudança na hora; os demais workers a recebem
+    pelo watcher do arquivo.
+    """
+    # Parte do arquivo mais recente (ou do mapa atual, se o arquivo for inválido)
+    check_databases_file()
+    databases = dict(_load_databases_map())
+
+    # Adicionar novo banco
+    databases[empresa_code] = db_url
+
+    _write_databases_file(databases)
+    _apply_databases_map(databases, _stat_databases_file())
+
+
+class _DatabasesWatcher:
+    """Thread que verifica periodicamente o databases.json (um por worker).
+    Cada worker aplica a alteração em até `interval` segundos, sem ler o
+    arquivo nas requisições.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="databases-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                check_databases_file()
+            except Exception as e:
+                logger.error("Falha ao verificar databases.json", extra={"error": str(e)})
 
 
-def _get_engine(db_url: str):
+_WATCHER = _DatabasesWatcher(settings.databases_reload_interval)
+
+
+def start_databases_watcher():
+    """Inicia o watcher do databases.json (chamado no startup da aplicação)"""
+    if settings.databases_reload_interval > 0:
+        _load_databases_map()
+        _WATCHER.start()
+
+
+def stop_databases_watcher():
+    """Para o watcher do databases.json (chamado no shutdown)"""
+    _WATCHER.stop()
+
+
+def _quote_schema(schema: str) -> str:
+    """Escapa nome de schema para uso em USE `...`"""
+    return "`" + schema.replace("`", "``") + "`"
+
+
+def _reset_schema_on_checkin(dbapi_connection, connection_record):
+    """Modo server: volta a conexão para um schema neutro ao devolver ao pool.
+    Garante isolamento: uma conexão esquecida sem USE não enxerga dados de
+    nenhuma empresa.
+    """
+    if dbapi_connection is None:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"USE {_quote_schema(settings.db_neutral_schema)}")
+        finally:
+            cursor.close()
+    except Exception as e:
+        # Conexão em estado desconhecido: descarta em vez de reutilizar
+        logger.warning("Falha ao resetar schema no checkin", extra={"error": str(e)})
+        connection_record.invalidate(e)
+
+
+def _url_digest(db_url: str) -> str:
+    """Identificador opaco da URL para chaves do registro, que aparecem nas
+    métricas e em /admin: HMAC com a SECRET_KEY, sem usuário nem host
+    """
+    return hmac.new(settings.secret_key.encode(), db_url.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def _split_server_url(db_url: str):
+    """Separa a URL da empresa em (chave do servidor, URL do servidor, schema).
+    Empresas no mesmo host/porta/credenciais compartilham a mesma chave.
+    """
+    url = make_url(db_url)
+    server_url = url.set(database="").render_as_string(hide_password=False)
+    return f"server:{_url_digest(server_url)}", server_url, url.database
+
+
+def _get_engine(db_url: str, pool_size: int = settings.db_pool_size_max):
     """Cria engine otimizada para MySQL/MariaDB"""
-    return create_engine(
+    engine = create_engine(
         db_url,
+        poolclass=server_timing.TimedQueuePool,  # QueuePool + fase checkout do Server-Timing
         pool_pre_ping=True,  # Verifica conexão antes de usar
         pool_recycle=3600,  # Recicla conexões a cada hora
-        pool_size=10,       # Pool de 10 conexões
-        max_overflow=20,    # Máximo 20 conexões extras
+        pool_size=pool_size,  # Dimensionado pelo tráfego da empresa
+        max_overflow=settings.db_pool_max_overflow,
         echo=settings.debug,
         connect_args={
             "charset": "utf8mb4",
             "autocommit": False
         }
     )
+    if settings.db_pool_mode == "server":
+        event.listen(engine, "checkin", _reset_schema_on_checkin)
+    query_collector.install(engine)
+    deadlines.install(engine)
+    return engine
 
 
-def get_engine_for_empresa(empresa_code: Optional[str]):
-    """Retorna (ou cria) engine para a empresa informada.
-    Se empresa_code for None, usa 'default'.
+def _async_url(db_url: str) -> str:
+    """Troca o driver da URL pelo driver asyncio (aiomysql)"""
+    url = make_url(db_url).set(drivername="mysql+aiomysql")
+    return url.render_as_string(hide_password=False)
+
+
+def _get_async_engine(db_url: str, pool_size: int = settings.db_pool_size_max):
+    """Cria AsyncEngine (aiomysql) com os mesmos parâmetros de pool da engine sync"""
+    engine = create_async_engine(
+        _async_url(db_url),
+        poolclass=server_timing.TimedAsyncAdaptedQueuePool,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        pool_size=pool_size,
+        max_overflow=settings.db_pool_max_overflow,
+        echo=settings.debug,
+        connect_args={
+            "charset": "utf8mb4",
+            "autocommit": False
+        }
+    )
+    if settings.db_pool_mode == "server":
+        event.listen(engine.sync_engine, "checkin", _reset_schema_on_checkin)
+    query_collector.install(engine.sync_engine)
+    deadlines.install(engine.sync_engine)
+    return engine
+
+
+_PENDING_DISPOSALS = set()
+# Event loop da aplicação (lifespan): engines async descartadas por outras
+# threads (watcher do databases.json, threadpool) fecham as conexões nele
+_APP_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def bind_app_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    """Registra o loop da aplicação no startup (None no shutdown)"""
+    global _APP_LOOP
+    _APP_LOOP = loop
+
+
+def _log_dispose_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Falha ao descartar engine async", extra={"error": str(future.exception())})
+
+
+def _dispose_async_engine(engine):
+    """Descarta AsyncEngine sem bloquear, fechando as conexões no event loop:
+    o loop atual ou, vindo de outra thread, o da aplicação
     """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        task = loop.create_task(engine.dispose())
+        _PENDING_DISPOSALS.add(task)
+        task.add_done_callback(_PENDING_DISPOSALS.discard)
+        task.add_done_callback(_log_dispose_error)
+        return
+    app_loop = _APP_LOOP
+    if app_loop is not None and app_loop.is_running():
+        asyncio.run_coroutine_threadsafe(engine.dispose(), app_loop).add_done_callback(_log_dispose_error)
+        return
+    # Shutdown, loop já encerrado: apenas solta o pool (conexões fecham no GC)
+    engine.sync_engine.dispose(close=False)
+
+
+def _primary_url(entry) -> str:
+    """URL do primário. Entrada do databases.json: "url" ou {"url": ..., "replicas": [...]}"""
+    return entry["url"] if isinstance(entry, dict) else entry
+
+
+def _replica_urls(entry) -> List[str]:
+    """URLs das réplicas de leitura da entrada (lista vazia se não houver)"""
+    if isinstance(entry, dict):
+        return list(entry.get("replicas") or [])
+    return []
+
+
+def _resolve_empresa(empresa_code: Optional[str]):
+    """Resolve (código, entrada do mapa) da empresa, com fallback para 'default'"""
     databases = _load_databases_map()
     code = empresa_code or "default"
-    db_url = databases.get(code)
-    if not db_url:
+    entry = databases.get(code)
+    if not entry:
         # fallback para default
         code = "default"
-        db_url = databases.get("default", settings.database_url)
+        entry = databases.get("default", settings.database_url)
+    return code, entry
+
+
+def _binding(code: str, db_url: str, replica: bool = False):
+    """Retorna (chave no registro, URL da engine, schema) para a URL da empresa.
+    No modo server a chave/URL são do servidor e o schema vem da URL.
+    """
+    if settings.db_pool_mode == "server":
+        return _split_server_url(db_url)
+    if replica:
+        return f"{code}@replica:{_url_digest(db_url)}", db_url, None
+    return code, db_url, None
+
+
+def _engine_and_schema(empresa_code: Optional[str], registry=None,
+                       read_only: bool = False, user: Optional[str] = None):
+    """Retorna (engine, schema) da empresa.
+    schema só é preenchido no modo server (pool compartilhado por servidor).
+    Com read_only=True, usa uma réplica saudável quando a empresa tiver
+    réplicas configuradas (e o usuário não tiver escrito há pouco).
+    """
+    if registry is None:
+        registry = _ENGINES
+    code, entry = _resolve_empresa(empresa_code)
+    _TENANT_ACTIVITY[code] += 1
+    if read_only:
+        replicas = _replica_urls(entry)
+        if replicas and not _REPLICAS.is_sticky(code, user):
+            chosen = _REPLICAS.choose([_binding(code, url, replica=True) for url in replicas])
+            if chosen:
+                key, engine_url, schema = chosen
+                engine = registry.get(key, engine_url)
+                _REPLICAS.watch(key, getattr(engine, "sync_engine", engine))
+                return engine, schema
+    key, engine_url, schema = _binding(code, _primary_url(entry))
+    return registry.get(key, engine_url), schema
+
+
+def health_check_engine():
+    """Engine da empresa 'default' para o /health, sem contar como tráfego
+    (não entra no ranking de atividade nem no dimensionamento do pool)
+    """
+    code, entry = _resolve_empresa(None)
+    key, engine_url, _ = _binding(code, _primary_url(entry))
+    return _ENGINES.peek(key, engine_url)
+
+
+def get_engine_for_empresa(empresa_code: Optional[str]):
+    """Retorna (ou cria) engine para a empresa informada.
+    Se empresa_code for None, usa 'default'.
+    No modo server a engine é compartilhada por todas as empresas do mesmo
+    servidor; use as sessões de get_db/get_db_by_empresa para selecionar o schema.
+    """
+    return _engine_and_schema(empresa_code)[0]
+
+
+_SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+@event.listens_for(_SessionLocal, "after_begin")
+def _select_tenant_schema(session, transaction, connection):
+    """Modo server: seleciona o schema da empresa na conexão recém-obtida"""
+    schema = session.info.get("schema")
+    if schema:
+        connection.exec_driver_sql(f"USE {_quote_schema(schema)}")
+
+
+# AsyncSession reutiliza a mesma classe de sessão (e o evento after_begin)
+_AsyncSessionLocal = async_sessionmaker(
+    autocommit=False, autoflush=False, sync_session_class=_SessionLocal.class_
+)
+
+
+# Sessões abertas durante a requisição atual: (sessão, stack de abertura)
+_REQUEST_SESSIONS: ContextVar[Optional[List[tuple]]] = ContextVar("request_sessions", default=None)
+
+
+def _track_session(session):
+    """Registra a sessão no escopo da requisição (fechada em end_session_scope)"""
+    tracked = _REQUEST_SESSIONS.get()
+    if tracked is not None:
+        stack = None
+        if settings.db_session_leak_debug:
+            stack = "".join(traceback.format_stack(limit=15)[:-2])
+        tracked.append((session, stack))
+    return session
 
-    if code not in _ENGINES:
-        _ENGINES[code] = _get_engine(db_url)
-    return _ENGINES[code]
+
+def begin_session_scope():
+    """Abre o escopo de sessões da requisição. Retorna token para end_session_scope"""
+    return _REQUEST_SESSIONS.set([])
+
+
+def report_open_sessions(path: str) -> int:
+    """Modo debug: loga sessões que ainda seguram conexão no momento da resposta"""
+    tracked = _REQUEST_SESSIONS.get() or []
+    leaked = 0
+    for session, stack in tracked:
+        if session.in_transaction():
+            leaked += 1
+            logger.warning(
+                f"Sessão de banco aberta no fim da requisição: {path}",
+                extra={
+                    "http_path": path,
+                    "opened_at": stack,
+                    "event_type": "db_session_leak"
+                }
+            )
+    return leaked
+
+
+async def end_session_scope(token):
+    """Fecha de forma determinística as sessões abertas durante a requisição"""
+    tracked = _REQUEST_SESSIONS.get() or []
+    _REQUEST_SESSIONS.reset(token)
+    for session, _ in tracked:
+        try:
+            if isinstance(session, AsyncSession):
+                await session.close()
+            elif session.in_transaction():
+                # rollback + devolução da conexão é I/O: fora do event loop
+                await run_in_threadpool(session.close)
+            else:
+                session.close()
+        except Exception as e:
+            logger.error("Falha ao fechar sessão de banco", extra={"error": str(e)})
+
+
+def _open_session(empresa_code: Optional[str], read_only: bool = False, user: Optional[str] = None):
+    """Cria sessão ligada à engine (e schema, no modo server) da empresa.
+    A conexão só é retirada do pool no primeiro statement e volta ao pool
+    ao fim de cada transação (commit/rollback).
+    """
+    engine, schema = _engine_and_schema(empresa_code, read_only=read_only, user=user)
+    return _track_session(_SessionLocal(bind=engine, info={"schema": schema}))
+
+
+def _open_async_session(empresa_code: Optional[str], read_only: bool = False, user: Optional[str] = None):
+    """Cria AsyncSession ligada à engine async da empresa"""
+    engine, schema = _engine_and_schema(empresa_code, _ASYNC_ENGINES, read_only, user)
+    return _track_session(_AsyncSessionLocal(bind=engine, info={"schema": schema}))
+
+
+# Cache de engines por empresa (limitado, LRU + descarte por ociosidade)
+_ENGINES = EngineRegistry(
+    factory=_get_engine,
+    max_engines=settings.db_max_engines,
+    idle_timeout=settings.db_engine_idle_timeout,
+    pool_size_min=settings.db_pool_size_min,
+    pool_size_max=settings.db_pool_size_max,
+)
+
+# Engines async (aiomysql) por empresa, com as mesmas regras de limite
+_ASYNC_ENGINES = EngineRegistry(
+    factory=_get_async_engine,
+    max_engines=settings.db_max_engines,
+    idle_timeout=settings.db_engine_idle_timeout,
+    pool_size_min=settings.db_pool_size_min,
+    pool_size_max=settings.db_pool_size_max,
+    disposer=_dispose_async_engine,
+)
+
+# Réplicas de leitura: health check usa as engines sync do registro
+_REPLICAS = ReplicaRouter(
+    engine_getter=_ENGINES.peek,
+    policy=settings.db_replica_policy,
+    max_lag=settings.db_replica_max_lag,
+    check_interval=settings.db_replica_check_interval,
+    sticky_seconds=settings.db_replica_sticky_seconds,
+)
+
+
+async def dispose_async_engines():
+    """Descarta todas as engines async aguardando o fechamento das conexões"""
+    for engine in _ASYNC_ENGINES.clear():
+        await engine.dispose()
+
+
+# ==================== Warm-up de pools ====================
+
+# Sessões abertas por empresa neste processo (ranking para o warm-up)
+_TENANT_ACTIVITY: Counter = Counter()
+
+
+def _activity_file_path() -> str:
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "..", settings.db_activity_file))
+
+
+@contextmanager
+def _activity_lock(path: str):
+    """Trava exclusiva entre os workers (arquivo .lock ao lado do ranking)"""
+    with open(f"{path}.lock", "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_activity(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def save_tenant_activity():
+    """Persiste a atividade por empresa (com decaimento) para o próximo warm-up.
+    Todos os workers gravam no mesmo arquivo no shutdown: leitura + escrita
+    sob trava, senão a contagem de um worker apaga a do outro.
+    """
+    path = _activity_file_path()
+    try:
+        with _activity_lock(path):
+            merged = Counter({code: count / 2 for code, count in _read_activity(path).items()})
+            merged.update(_TENANT_ACTIVITY)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(dict(merged.most_common(1000)), f)
+            os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning("Falha ao salvar atividade por empresa", extra={"error": str(e)})
+
+
+def _warmup_bindings() -> Dict[str, str]:
+    """Chaves/URLs a aquecer, das empresas mais ativas para as menos: todas ou
+    as DB_WARMUP_TENANTS primeiras, no máximo DB_MAX_ENGINES engines (além disso
+    o registro descartaria as primeiras enquanto aquece as seguintes)
+    """
+    databases = _load_databases_map()
+    activity = _read_activity(_activity_file_path())
+    codes = sorted(databases, key=lambda code: activity.get(code, 0), reverse=True)
+    if settings.db_warmup_tenants > 0:
+        codes = codes[:settings.db_warmup_tenants]
+    bindings = {}
+    for code in codes:
+        key, engine_url, _ = _binding(code, _primary_url(databases[code]))
+        if key not in bindings and len(bindings) >= settings.db_max_engines:
+            break
+        bindings[key] = engine_url
+    return bindings
+
+
+def warm_up_pools() -> dict:
+    """Cria as engines e abre DB_WARMUP_CONNECTIONS conexões por pool, em paralelo.
+    As conexões voltam ao pool já autenticadas, evitando o custo no 1º request.
+    """
+    start = time.perf_counter()
+    bindings = _warmup_bindings()
+    engines = [_ENGINES.peek(key, url) for key, url in bindings.items()]
+    opened, failed = [], 0
+
+    with ThreadPoolExecutor(max_workers=settings.db_warmup_concurrency,
+                            thread_name_prefix="db-warmup") as executor:
+        futures = [
+            executor.submit(engine.connect)
+            for engine in engines
+            for _ in range(min(settings.db_warmup_connections, engine.pool.size()))
+        ]
+        for future in futures:
+            try:
+                opened.append(future.result())
+            except Exception as e:
+                failed += 1
+                logger.warning("Falha no warm-up de conexão", extra={"error": str(e)})
+    for conn in opened:
+        conn.close()
+
+    return {
+        "pools": len(engines),
+        "connections": len(opened),
+        "failed": failed,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+async def warm_up_async_pools() -> dict:
+    """Versão async do warm-up (engines aiomysql usadas pelas rotas async)"""
+    start = time.perf_counter()
+    engines = [_ASYNC_ENGINES.peek(key, url) for key, url in _warmup_bindings().items()]
+    semaphore = asyncio.Semaphore(settings.db_warmup_concurrency)
+
+    async def _connect(engine):
+        async with semaphore:
+            return await engine.connect()
+
+    results = await asyncio.gather(
+        *(_connect(engine)
+          for engine in engines
+          for _ in range(min(settings.db_warmup_connections, engine.pool.size()))),
+        return_exceptions=True,
+    )
+    opened = [conn for conn in results if not isinstance(conn, BaseException)]
+    for conn in opened:
+        await conn.close()
+
+    return {
+        "pools": len(engines),
+        "connections": len(opened),
+        "failed": len(results) - len(opened),
+        "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
 
 Base = declarative_base()
 
 
+# Métodos roteados para réplicas de leitura
+_READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+def _extract_identity_from_request(request: Request):
+    """Descobre (empresa, usuário) da requisição a partir do AuthContext.
+    Empresa: 1) Header X-Empresa  2) Token Bearer (campo 'empresa' ou 'empresa_code')
+    Usuário: login ('sub') do token, usado para read-your-writes nas réplicas
+    """
+    ctx = get_auth_context(request)
+    return ctx.empresa, ctx.login
+
+
 def _extract_empresa_from_request(request: Request) -> Optional[str]:
-    """Descobre a empresa da requisição.
-    1) Header X-Empresa
-    2) Token Bearer (campo 'empresa' ou 'empresa_code')
-    """
-    # 1) Header explícito
-    empresa = request.headers.get("X-Empresa") or request.headers.get("x-empresa")
-    if empresa:
-        return empresa.strip()
-
-    # 2) Token Bearer
-    auth_header = request.headers.get("Authorization")
-    if auth_header and auth_header.lower().startswith("bearer "):
-        token = auth_header.split(" ", 1)[1]
-        payload = decode_access_token(token)
-        if payload:
-            return payload.get("empresa") or payload.get("empresa_code") or payload.get("empresa_id")
-    return None
+    """Descobre a empresa da requisição (header X-Empresa ou token Bearer)"""
+    return _extract_identity_from_request(request)[0]
 
 
 def get_db(request: Request):
     """Dependency para injetar sessão do banco em rotas FastAPI (multi-banco).
-    Seleciona o engine conforme a empresa no header/token.
+    Seleciona o engine conforme a empresa no header/token; requisições de
+    leitura (GET) vão para uma réplica saudável quando configurada.
     """
-    empresa_code = _extract_empresa_from_request(request)
-    engine = get_engine_for_empresa(empresa_code)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+    start = time.perf_counter()
+    empresa_code, user = _extract_identity_from_request(request)
+    read_only = request.method in _READ_METHODS
+    db = _open_session(empresa_code, read_only, user)
+    server_timing.record("tenant", start)
     try:
         yield db
     finally:
         db.close()
+        if not read_only:
+            _REPLICAS.record_write(_resolve_empresa(empresa_code)[0], user)
 
 
 async def get_db_async(request: Request):
-    """Versão async da dependency get_db para rotas async"""
-    empresa_code = _extract_empresa_from_request(request)
-    engine = get_engine_for_empresa(empresa_code)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+    """Versão async da dependency get_db para rotas async.
+    Injeta AsyncSession (aiomysql): as queries não bloqueiam o event loop.
+    """
+    start = time.perf_counter()
+    empresa_code, user = _extract_identity_from_request(request)
+    read_only = request.method in _READ_METHODS
+    db = _open_async_session(empresa_code, read_only, user)
+    server_timing.record("tenant", start)
     try:
         yield db
     finally:
-        await db.close()  # Para SQLAlchemy 2.0+
+        await db.close()
+        if not read_only:
+            _REPLICAS.record_write(_resolve_empresa(empresa_code)[0], user)
 
 
 def get_db_by_empresa(empresa_code: str = "teste"):
-    """Retorna uma sessão de banco para uma empresa específica.
-    Útil para rotas async que não usam Depends(get_db).
-    IMPORTANTE: O chamador deve fechar a sessão manualmente ou usar context manager.
+    """Retorna uma sessão (sync) de banco para uma empresa específica.
+    Útil fora de rotas (scripts, tarefas). Rotas async devem usar get_db_async.
+    Dentro de uma requisição a sessão é fechada automaticamente ao final dela
+    (SessionScopeMiddleware); fora dela o chamador deve fechá-la.
     """
-    engine = get_engine_for_empresa(empresa_code)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    return SessionLocal()
+    return _open_session(empresa_code)
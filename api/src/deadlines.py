@@ -0,0 +1,230 @@
+"""
+Prazo (deadline) da requisição repassado ao banco
+
+O SecurityPipelineMiddleware abre um RequestDeadline por requisição. Cada
+statement executado dentro dela:
+- recebe o tempo restante como limite no servidor: no MariaDB
+  "SET STATEMENT max_statement_time=<s> FOR ...", no MySQL o hint
+  /*+ MAX_EXECUTION_TIME(ms) */ (só SELECT)
+- fica registrado (thread id da conexão) enquanto executa; se o prazo
+  estourar, o middleware chama cancel() e as queries em andamento recebem
+  KILL QUERY por uma conexão separada
+- é recusado na hora (QueryDeadlineExceeded) se o prazo já acabou
+
+KILL QUERY interrompe só o statement: a conexão continua válida e volta ao
+pool com rollback, como qualquer outra.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+
+from src.config import get_settings
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+settings = get_settings()
+
+
+class QueryDeadlineExceeded(Exception):
+    """Statement recusado: o prazo da requisição já acabou"""
+
+
+class _ActiveStatement:
+    """Statement em execução em uma conexão (thread id no servidor)"""
+
+    __slots__ = ("thread_id", "server_url", "lock", "running")
+
+    def __init__(self, thread_id: int, server_url):
+        self.thread_id = thread_id
+        self.server_url = server_url
+        self.lock = threading.Lock()
+        self.running = True
+
+
+class RequestDeadline:
+    """Prazo de uma requisição e statements em execução dentro dela"""
+
+    __slots__ = ("deadline", "cancelled", "active", "_lock")
+
+    def __init__(self, timeout_seconds: float):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.cancelled = False
+        self.active = set()
+        self._lock = threading.Lock()
+
+    def remaining(self) -> Optional[float]:
+        """Segundos restantes; None = sem prazo (desarmado)"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def disarm(self):
+        """Resposta já começou: statements seguintes (streaming, background) sem prazo"""
+        self.deadline = None
+
+    def register(self, statement: _ActiveStatement):
+        with self._lock:
+            self.active.add(statement)
+
+    def unregister(self, statement: _ActiveStatement):
+        # Espera um KILL em andamento terminar: a conexão só é liberada
+        # depois, então o KILL nunca atinge a query de outra requisição
+        with statement.lock:
+            statement.running = False
+        with self._lock:
+            self.active.discard(statement)
+
+    def cancel(self):
+        """Prazo estourou: bloqueia novos statements e mata os em andamento"""
+        self.cancelled = True
+        if not settings.db_kill_on_timeout:
+            return
+        with self._lock:
+            statements = list(self.active)
+        for statement in statements:
+            try:
+                _KILL_EXECUTOR.submit(_kill_query, statement)
+            except RuntimeError:
+                pass  # Executor encerrado (shutdown)
+
+
+_REQUEST_DEADLINE: ContextVar[Optional[RequestDeadline]] = ContextVar("request_deadline", default=None)
+
+
+def begin_request_deadline(timeout_seconds: float):
+    """Abre o prazo da requisição. Retorna (deadline, token para end_request_deadline)"""
+    deadline = RequestDeadline(timeout_seconds)
+    return deadline, _REQUEST_DEADLINE.set(deadline)
+
+
+def end_request_deadline(token):
+    _REQUEST_DEADLINE.reset(token)
+
+
+# ==================== KILL QUERY ====================
+
+_KILL_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kill-query")
+_KILL_ENGINES: Dict[str, object] = {}
+_KILL_ENGINES_LOCK = threading.Lock()
+_stats = {"hinted": 0, "rejected": 0, "killed": 0, "kill_errors": 0}
+
+
+def _kill_engine(server_url):
+    """Engine sem pool (pymysql) para o KILL: não disputa o pool saturado"""
+    url = server_url.set(drivername="mysql+pymysql", database="")
+    key = url.render_as_string(hide_password=False)
+    engine = _KILL_ENGINES.get(key)
+    if engine is None:
+        with _KILL_ENGINES_LOCK:
+            engine = _KILL_ENGINES.get(key)
+            if engine is None:
+                engine = create_engine(url, poolclass=NullPool, connect_args={"connect_timeout": 5})
+                _KILL_ENGINES[key] = engine
+    return engine
+
+
+def _kill_query(statement: _ActiveStatement):
+    with statement.lock:
+        if not statement.running:
+            return
+        try:
+            with _kill_engine(statement.server_url).connect() as conn:
+                conn.execute(text(f"KILL QUERY {int(statement.thread_id)}"))
+            _stats["killed"] += 1
+            logger.warning("Query cancelada por timeout da requisição",
+                           extra={"thread_id": statement.thread_id, "event_type": "query_killed"})
+        except Exception as e:
+            _stats["kill_errors"] += 1
+            logger.error("Falha ao cancelar query (KILL QUERY)",
+                         extra={"thread_id": statement.thread_id, "error": str(e)})
+
+
+def shutdown():
+    _KILL_EXECUTOR.shutdown(wait=False)
+    with _KILL_ENGINES_LOCK:
+        for engine in _KILL_ENGINES.values():
+            engine.dispose()
+        _KILL_ENGINES.clear()
+
+
+def stats() -> dict:
+    return dict(_stats)
+
+
+# ==================== Eventos da engine ====================
+
+_MARIADB_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+def _record_thread_id(dbapi_connection, connection_record):
+    """Guarda o thread id da conexão no servidor (alvo do KILL QUERY)"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT CONNECTION_ID()")
+        connection_record.info["thread_id"] = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _with_time_limit(statement: str, remaining: float, is_mariadb: bool) -> str:
+    head = statement.lstrip()[:7].upper()
+    if is_mariadb:
+        if head.startswith(_MARIADB_STATEMENTS):
+            return f"SET STATEMENT max_statement_time={remaining:.3f} FOR {statement}"
+    elif head.startswith("SELECT"):
+        offset = statement.upper().index("SELECT") + 6
+        return f"{statement[:offset]} /*+ MAX_EXECUTION_TIME({max(1, int(remaining * 1000))}) */{statement[offset:]}"
+    return statement
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    deadline = _REQUEST_DEADLINE.get()
+    if deadline is None:
+        return statement, parameters
+
+    remaining = deadline.remaining()
+    if deadline.cancelled or (remaining is not None and remaining <= 0):
+        _stats["rejected"] += 1
+        raise QueryDeadlineExceeded("Prazo da requisição esgotado antes da query")
+
+    thread_id = conn.info.get("thread_id")
+    if thread_id is not None and context is not None:
+        active = _ActiveStatement(thread_id, conn.engine.url)
+        deadline.register(active)
+        context._request_deadline = (deadline, active)
+
+    if remaining is not None and settings.db_statement_time_limit:
+        limited = _with_time_limit(statement, remaining, conn.dialect.is_mariadb)
+        if limited is not statement:
+            _stats["hinted"] += 1
+            statement = limited
+    return statement, parameters
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracked = getattr(context, "_request_deadline", None)
+    if tracked is not None:
+        deadline, active = tracked
+        deadline.unregister(active)
+        context._request_deadline = None
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        _after_cursor_execute(None, None, None, None, context, False)
+
+
+def install(engine):
+    """Liga o prazo da requisição aos statements da engine (sync; para
+    AsyncEngine, passar engine.sync_engine). Só MySQL/MariaDB.
+    """
+    if engine.dialect.name != "mysql":
+        return
+    event.listen(engine, "connect", _record_thread_id)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute, retval=True)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
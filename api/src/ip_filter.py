@@ -0,0 +1,209 @@
+"""
+Filtro de IPs por CIDR (allowlist/denylist) com trie de prefixos
+
+- Regras IPv4/IPv6 em CIDR ("10.0.0.0/8", "2001:db8::/32" ou IP único)
+- Busca do prefixo mais longo em uma trie binária: O(tamanho do prefixo)
+- IP real do cliente a partir de headers de proxies confiáveis
+  (CF-Connecting-IP do cloudflared, X-Forwarded-For)
+- Cache LRU limitado de decisões (não cresce com varreduras)
+- Regras por prefixo de path (ex.: /admin) somam-se às globais: o IP precisa
+  passar nas duas, então só restringem mais
+"""
+import ipaddress
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ALLOW = "allow"
+DENY = "deny"
+
+
+def _parse_ip(value: str):
+    """ip_address normalizado (IPv4 mapeado em IPv6 vira IPv4); None se inválido"""
+    try:
+        ip = ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        return ip.ipv4_mapped
+    return ip
+
+
+class PrefixTrie:
+    """Trie binária de prefixos (um bit por nível) com busca do prefixo mais longo"""
+
+    __slots__ = ("_root", "width")
+
+    def __init__(self, width: int):
+        self.width = width
+        self._root = [None, None, None]  # [filho 0, filho 1, valor]
+
+    def insert(self, network, value):
+        node = self._root
+        bits = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (bits >> (self.width - 1 - i)) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, None]
+            node = child
+        node[2] = value
+
+    def longest_match(self, address: int):
+        node = self._root
+        found = node[2]
+        for i in range(self.width - 1, -1, -1):
+            node = node[(address >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+
+class IPRuleSet:
+    """
+    Regras allow/deny compiladas em tries (IPv4 e IPv6)
+    Vale a regra de prefixo mais longo; no mesmo prefixo, deny vence.
+    Sem regra que case: bloqueia se houver allowlist, senão libera.
+    """
+
+    def __init__(self, allow: Iterable[str] = (), deny: Iterable[str] = ()):
+        self.allow = [cidr for cidr in allow if cidr and cidr.strip()]
+        self.deny = [cidr for cidr in deny if cidr and cidr.strip()]
+        self.default_allowed = not self.allow
+        self._tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for action, cidrs in ((ALLOW, self.allow), (DENY, self.deny)):
+            for cidr in cidrs:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+                self._tries[network.version].insert(network, action)
+
+    @property
+    def empty(self) -> bool:
+        return not self.allow and not self.deny
+
+    def is_allowed(self, ip) -> bool:
+        if ip is None:
+            return self.default_allowed
+        action = self._tries[ip.version].longest_match(int(ip))
+        if action is None:
+            return self.default_allowed
+        return action == ALLOW
+
+
+class IPFilter:
+    """Decide se o cliente da requisição pode acessar o path"""
+
+    def __init__(self, rules: IPRuleSet, path_rules: Optional[Dict[str, IPRuleSet]] = None,
+                 trusted_proxies: Iterable[str] = (), cache_size: int = 10000):
+        # Índice 0 = regras globais; demais = por prefixo (maior primeiro)
+        self._rule_sets: List[IPRuleSet] = [rules]
+        self._paths: List[Tuple[str, int]] = []
+        for prefix, rule_set in sorted((path_rules or {}).items(), key=lambda item: len(item[0]), reverse=True):
+            self._rule_sets.append(rule_set)
+            self._paths.append((prefix, len(self._rule_sets) - 1))
+        self._trusted = IPRuleSet(allow=trusted_proxies)
+        self._has_trusted = bool(self._trusted.allow)
+        self.enabled = any(not rule_set.empty for rule_set in self._rule_sets)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[int, str], bool]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.blocked = 0
+
+    @classmethod
+    def from_settings(cls, settings) -> "IPFilter":
+        """IP_ALLOWLIST / IP_DENYLIST / TRUSTED_PROXIES (CIDRs separados por
+        vírgula) e IP_PATH_RULES ({"/prefixo": {"allow": [...], "deny": [...]}})
+        """
+        return cls(
+            IPRuleSet(allow=settings.ip_allowlist.split(","), deny=settings.ip_denylist.split(",")),
+            path_rules={prefix: IPRuleSet(**rules) for prefix, rules in settings.ip_path_rules.items()},
+            trusted_proxies=settings.trusted_proxies.split(","),
+            cache_size=settings.ip_filter_cache_size,
+        )
+
+    # ==================== IP do cliente ====================
+
+    def client_ip(self, scope) -> Optional[str]:
+        """IP real do cliente: só confia nos headers se o peer é um proxy confiável"""
+        client = scope.get("client")
+        peer = client[0] if client else None
+        if not self._has_trusted or peer is None or not self._is_trusted(peer):
+            return peer
+
+        forwarded_for = None
+        for name, value in scope["headers"]:
+            if name == b"cf-connecting-ip":
+                candidate = value.decode("latin-1").strip()
+                if _parse_ip(candidate) is not None:
+                    return candidate
+            elif name == b"x-forwarded-for":
+                forwarded_for = value.decode("latin-1")
+
+        if forwarded_for:
+            # Da direita para a esquerda: o primeiro que não é proxy confiável.
+            # Hop inválido = IP desconhecido (nunca cai no valor do cliente)
+            hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+            for hop in reversed(hops):
+                if _parse_ip(hop) is None:
+                    return None
+                if not self._is_trusted(hop):
+                    return hop
+            if hops:
+                return hops[0]
+        return peer
+
+    def _is_trusted(self, value: str) -> bool:
+        ip = _parse_ip(value)
+        return ip is not None and self._trusted._tries[ip.version].longest_match(int(ip)) == ALLOW
+
+    # ==================== Decisão ====================
+
+    def _rule_index(self, path: str) -> int:
+        """Regras do prefixo mais longo que casa com o path (0 = só as globais)"""
+        for prefix, index in self._paths:
+            if path.startswith(prefix):
+                return index
+        return 0
+
+    def restricts(self, path: str) -> bool:
+        """Há allowlist (global ou do prefixo) valendo para o path"""
+        return bool(self._rule_sets[0].allow or self._rule_sets[self._rule_index(path)].allow)
+
+    def _decide(self, index: int, client_ip: Optional[str]) -> bool:
+        # Globais primeiro; as do path só podem bloquear mais
+        ip = _parse_ip(client_ip) if client_ip else None
+        if not self._rule_sets[0].is_allowed(ip):
+            return False
+        return index == 0 or self._rule_sets[index].is_allowed(ip)
+
+    def is_allowed(self, path: str, client_ip: Optional[str]) -> bool:
+        index = self._rule_index(path)
+        key = (index, client_ip or "")
+        with self._lock:
+            allowed = self._cache.get(key)
+            if allowed is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        if allowed is None:
+            self.misses += 1
+            allowed = self._decide(index, client_ip)
+            with self._lock:
+                self._cache[key] = allowed
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if not allowed:
+            self.blocked += 1
+        return allowed
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "cache_size": len(self._cache),
+            "cache_max_size": self.cache_size,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "blocked": self.blocked,
+        }
@@ -1,10 +1,32 @@
 """
 Sistema de logging estruturado para produção
+
+Os loggers não escrevem no stdout diretamente: cada registro entra em uma
+fila limitada (QueueHandler, sem bloquear quem loga) e uma thread em
+background (QueueListener) mascara dados sensíveis (RedactingFilter),
+formata o JSON e faz o I/O. Com o stdout lento (arquivos de log do PM2), a
+requisição não espera.
+
+Fila cheia (LOG_QUEUE_SIZE): registros abaixo de WARNING são descartados
+quando a fila passa de LOG_QUEUE_INFO_RATIO da capacidade (a folga fica
+para WARNING/ERROR); com a fila totalmente cheia, qualquer registro é
+descartado. Os descartes são contados por nível, expostos em
+logging_stats() e avisados no próprio log quando a fila volta a escoar.
+flush_logging() (shutdown do lifespan e atexit) escoa a fila.
 """
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import re
 import sys
+import threading
+import time
+from collections import deque
 from pythonjsonlogger import jsonlogger
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
 
@@ -14,8 +36,8 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
     def add_fields(self, log_record, record, message_dict):
         super().add_fields(log_record, record, message_dict)
         
-        # Adiciona timestamp ISO 8601
-        log_record['timestamp'] = datetime.utcnow().isoformat()
+        # Adiciona timestamp ISO 8601 (do evento: a formatação acontece depois, na thread do listener)
+        log_record['timestamp'] = datetime.utcfromtimestamp(record.created).isoformat()
         
         # Adiciona nível de log
         log_record['level'] = record.levelname
@@ -28,9 +50,145 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
         log_record['line'] = record.lineno
 
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que nunca bloqueia: fila cheia = registro descartado e contado"""
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int, info_limit: int):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.info_limit = info_limit
+        self.dropped = {}
+        self.enqueued = 0
+
+    def prepare(self, record):
+        # Mesma thread/processo: não precisa serializar nem formatar aqui,
+        # só congelar a mensagem (args podem mudar depois)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue (C, sem lock em Python) com limite checado aqui: o limite
+        # é aproximado sob concorrência, o que basta para segurar a memória
+        limit = self.info_limit if record.levelno < logging.WARNING else self.max_size
+        if self.queue.qsize() >= limit:
+            self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+            return
+        self.queue.put_nowait(record)
+        self.enqueued += 1
+
+
+class _LogListener(logging.handlers.QueueListener):
+    """QueueListener que avisa no log quando houve descartes"""
+
+    REPORT_INTERVAL = 10.0
+
+    def __init__(self, log_queue, handler, queue_handler: DroppingQueueHandler):
+        super().__init__(log_queue, handler, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self._reported = 0
+        self._last_report = 0.0
+
+    def handle(self, record):
+        super().handle(record)
+        dropped = sum(self.queue_handler.dropped.values())
+        if dropped != self._reported and time.monotonic() - self._last_report >= self.REPORT_INTERVAL:
+            self._last_report = time.monotonic()
+            warning = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                        "Logs descartados: fila de logging cheia", None, None)
+            warning.dropped_since_last_report = dropped - self._reported
+            warning.dropped_by_level = dict(self.queue_handler.dropped)
+            warning.event_type = "log_dropped"
+            self._reported = dropped
+            super().handle(warning)
+
+    def stop(self, timeout: float = 10.0):
+        # Com o stdout travado, não segura o shutdown para sempre (thread daemon)
+        self.enqueue_sentinel()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._thread = None
+
+
+_pipeline_lock = threading.Lock()
+_queue_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[_LogListener] = None
+_stdout_handler: Optional[logging.StreamHandler] = None
+
+
+def _queue_settings():
+    try:
+        from src.config import get_settings
+        settings = get_settings()
+        return settings.log_queue_size, settings.log_queue_info_ratio
+    except Exception:
+        return 10000, 0.9  # Sem configuração (ex.: scripts): padrões
+
+
+def _get_queue_handler() -> DroppingQueueHandler:
+    """Handler compartilhado por todos os loggers; inicia o listener na primeira vez"""
+    global _queue_handler, _listener, _stdout_handler
+    if _queue_handler is None:
+        with _pipeline_lock:
+            if _queue_handler is None:
+                size, info_ratio = _queue_settings()
+                log_queue = queue.SimpleQueue()
+                _stdout_handler = logging.StreamHandler(sys.stdout)
+                _stdout_handler.setFormatter(CustomJsonFormatter('%(timestamp)s %(level)s %(name)s %(message)s'))
+                _stdout_handler.addFilter(RedactingFilter())
+                handler = DroppingQueueHandler(log_queue, max_size=size, info_limit=int(size * info_ratio))
+                _listener = _LogListener(log_queue, _stdout_handler, handler)
+                _listener.start()
+                _queue_handler = handler
+    return _queue_handler
+
+
+def flush_logging(restart: bool = True):
+    """Escoa a fila (escreve tudo que estava pendente). No shutdown do lifespan;
+    restart=False (atexit) deixa o listener parado.
+    """
+    with _pipeline_lock:
+        if _listener is None or _listener._thread is None:
+            return
+        _listener.stop()
+        if _listener._thread is not None:
+            return  # Listener travado no I/O: não segura o shutdown
+        _stdout_handler.flush()
+        if restart:
+            _listener.start()
+
+
+def _reset_after_fork():
+    # A thread do listener não sobrevive ao fork (e a fila pode estar com o
+    # lock preso): o filho recomeça com fila e thread próprias
+    global _pipeline_lock
+    _pipeline_lock = threading.Lock()
+    if _listener is not None:
+        log_queue = queue.SimpleQueue()
+        _queue_handler.queue = _listener.queue = log_queue
+        _listener._thread = None
+        _listener.start()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush_logging, restart=False)
+
+
+def logging_stats() -> dict:
+    if _queue_handler is None:
+        return {"running": False}
+    return {
+        "running": _listener._thread is not None,
+        "queue_size": _queue_handler.queue.qsize(),
+        "queue_max_size": _queue_handler.max_size,
+        "enqueued": _queue_handler.enqueued,
+        "dropped": dict(_queue_handler.dropped),
+    }
+
+
 def setup_logger(name: str, level: str = "INFO") -> logging.Logger:
     """
-    Configura logger com formato JSON estruturado
+    Configura logger com formato JSON estruturado (via fila, sem I/O no chamador)
     
     Args:
         name: Nome do logger (geralmente __name__)
@@ -48,16 +206,8 @@ def setup_logger(name: str, level: str = "INFO") -> logging.Logger:
     # Define nível
     logger.setLevel(getattr(logging, level.upper()))
     
-    # Handler para stdout (JSON em produção)
-    handler = logging.StreamHandler(sys.stdout)
-    
-    # Formato JSON
-    formatter = CustomJsonFormatter(
-        '%(timestamp)s %(level)s %(name)s %(message)s'
-    )
-    
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # Fila compartilhada: formatação JSON e stdout ficam na thread do listener
+    logger.addHandler(_get_queue_handler())
     
     # Não propaga para o root logger
     logger.propagate = False
@@ -65,9 +215,44 @@ def setup_logger(name: str, level: str = "INFO") -> logging.Logger:
     return logger
 
 
+# Dados sensíveis: padrões combinados em uma regex (uma passada), compilada
+# uma vez por combinação. Checagens baratas (str) escolhem quais padrões
+# entram: sem "@" não há URL com senha nem e-mail, sem "bearer" não há
+# token, sem três dígitos seguidos não há CPF nem cartão
+_SENSITIVE_PATTERNS = {
+    "url": r"(?P<url>://(?P<url_user>[^:/\s@]+):[^@\s]+@)",                  # senha em URL
+    "email": r"(?P<email>\b[\w\.-]+@(?P<email_domain>[\w\.-]+)\b)",            # e-mail (mantém domínio)
+    "bearer": r"(?P<bearer>\b(?P<bearer_word>[Bb]earer|BEARER)\s+[\w\-\.~+/]+=*)",  # token Bearer
+    "cpf": r"(?P<cpf>\b(?P<cpf_head>\d{3})\.\d{3}\.\d{3}-\d{2}\b)",           # CPF formatado
+    "card": r"(?P<card>\b\d{4}[\s\-]?\d{4}[\s\-]?\d{4}[\s\-]?\d{4}\b)",       # cartão
+}
+_HAS_DIGITS = re.compile(r"\d\d\d")
+
+
+@lru_cache(maxsize=8)
+def _sensitive_regex(at: bool, bearer: bool, digits: bool):
+    names = (("url", "email") if at else ()) + (("bearer",) if bearer else ()) + (("cpf", "card") if digits else ())
+    return re.compile("|".join(_SENSITIVE_PATTERNS[name] for name in names))
+
+
+def _mask(match) -> str:
+    kind = match.lastgroup
+    if kind == "url":
+        return f"://{match.group('url_user')}:****@"
+    if kind == "bearer":
+        return f"{match.group('bearer_word')} ****"
+    if kind == "cpf":
+        return f"{match.group('cpf_head')}.***.***-**"
+    if kind == "card":
+        return "****-****-****-****"
+    return f"****@{match.group('email_domain')}"
+
+
 def mask_sensitive_data(data: str) -> str:
     """
-    Mascara dados sensíveis antes de logar
+    Mascara dados sensíveis antes de logar (senha em URL, Bearer, CPF,
+    e-mail, cartão). Aplicado automaticamente a todo registro pelo
+    RedactingFilter; continua disponível para uso direto.
     
     Args:
         data: String contendo dados potencialmente sensíveis
@@ -75,28 +260,218 @@ def mask_sensitive_data(data: str) -> str:
     Returns:
         String com dados mascarados
     """
-    import re
-    
-    # Mascara senhas em URLs
-    data = re.sub(r'://([^:]+):([^@]+)@', r'://\1:****@', data)
-    
-    # Mascara tokens Bearer
-    data = re.sub(r'Bearer\s+[\w\-\.]+', 'Bearer ****', data)
-    
-    # Mascara CPF (mantém 3 primeiros dígitos)
-    data = re.sub(r'\b(\d{3})\.\d{3}\.\d{3}-\d{2}\b', r'\1.***.***-**', data)
-    
-    # Mascara emails (mantém domínio)
-    data = re.sub(r'\b[\w\.-]+@([\w\.-]+)\b', r'****@\1', data)
-    
-    # Mascara números de cartão de crédito
-    data = re.sub(r'\b\d{4}[\s\-]?\d{4}[\s\-]?\d{4}[\s\-]?\d{4}\b', '****-****-****-****', data)
-    
-    return data
+    at = "@" in data
+    bearer = "earer" in data or "EARER" in data
+    digits = _HAS_DIGITS.search(data) is not None
+    if not (at or bearer or digits):
+        return data
+    return _sensitive_regex(at, bearer, digits).sub(_mask, data)
+
+
+_RECORD_ATTRS = frozenset(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+# Campos extra com valores de vocabulário fixo (nunca carregam dado do usuário)
+_SAFE_EXTRA = frozenset({"event_type", "http_method", "http_route", "log_reason",
+                         "security_event_type", "business_event_type"})
+_SKIP_ATTRS = _RECORD_ATTRS | _SAFE_EXTRA
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Mascara dados sensíveis na mensagem, nos campos extra (strings, e
+    strings dentro de dict/list/tuple) e no traceback de cada registro.
+    Fica no handler do listener: roda na thread de logging, não na requisição.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if isinstance(record.msg, str):
+            record.msg = mask_sensitive_data(record.msg)
+        for key, value in record.__dict__.items():
+            if key not in _SKIP_ATTRS and value is not None and not isinstance(value, (int, float, bool)):
+                record.__dict__[key] = self._redact(value)
+        if record.exc_info:
+            record.exc_text = mask_sensitive_data(_EXC_FORMATTER.formatException(record.exc_info))
+            record.exc_info = None
+        elif record.exc_text:
+            record.exc_text = mask_sensitive_data(record.exc_text)
+        return True
+
+    def _redact(self, value):
+        if isinstance(value, str):
+            return mask_sensitive_data(value)
+        if isinstance(value, dict):
+            return {k: self._redact(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._redact(v) for v in value)
+        return value
+
+
+_EXC_FORMATTER = logging.Formatter()
+
+
+class AccessLogSampler:
+    """
+    Amostragem do log de acesso por rota (template) e empresa
+
+    Sempre loga: status >= 400, requisições acima do p95 móvel da rota (ou
+    de slow_ms) e eventos de segurança (esses nem passam por aqui). O resto
+    é amostrado por contagem determinística por (rota, empresa): 1 a cada
+    round(1/taxa), sempre incluindo a primeira da janela, para que rotas e
+    empresas de pouco tráfego apareçam. A taxa vem de tenant_rates, senão de
+    route_rates, senão de sample_rate. Cada linha amostrada leva sample_rate
+    (peso = 1/taxa).
+
+    A cada summary_interval segundos, flush() devolve os agregados por rota
+    da janela (contagens por classe de status, descartadas, média, máx, p95).
+    """
+
+    WINDOW = 512            # Durações guardadas por rota para o p95
+    RECOMPUTE_EVERY = 128   # Requisições entre recálculos do p95
+    MIN_SAMPLES = 50        # Antes disso, só slow_ms vale como "lenta"
+    MAX_KEYS = 10000        # (rota, empresa) por janela; X-Empresa vem do cliente
+
+    def __init__(self, sample_rate: float = 1.0, route_rates: Optional[dict] = None,
+                 tenant_rates: Optional[dict] = None, slow_ms: float = 1000,
+                 summary_interval: float = 60):
+        self.sample_rate = sample_rate
+        self.route_rates = route_rates or {}
+        self.tenant_rates = tenant_rates or {}
+        self.slow_ms = slow_ms
+        self.summary_interval = summary_interval
+        self._lock = threading.Lock()
+        self._durations = {}    # rota -> deque das últimas durações
+        self._p95 = {}          # rota -> (limite, requisições até recalcular)
+        self._counters = {}     # (rota, empresa) -> requisições na janela
+        self._summary = {}      # rota -> agregados da janela
+        self._window_start = time.monotonic()
+
+    def _rate(self, route: str, tenant: Optional[str]) -> float:
+        rate = self.tenant_rates.get(tenant) if tenant is not None else None
+        if rate is None:
+            rate = self.route_rates.get(route, self.sample_rate)
+        return rate
+
+    def _is_slow(self, route: str, duration_ms: float) -> bool:
+        durations = self._durations.get(route)
+        if durations is None:
+            durations = self._durations[route] = deque(maxlen=self.WINDOW)
+        durations.append(duration_ms)
+        threshold, countdown = self._p95.get(route, (None, 0))
+        if countdown <= 0 and len(durations) >= self.MIN_SAMPLES:
+            ordered = sorted(durations)
+            threshold, countdown = ordered[int(len(ordered) * 0.95)], self.RECOMPUTE_EVERY
+        self._p95[route] = (threshold, countdown - 1)
+        return duration_ms >= self.slow_ms or (threshold is not None and duration_ms > threshold)
+
+    def decide(self, route: str, tenant: Optional[str], status_code: int, duration_ms: float,
+               flagged: bool = False, db_queries: int = 0, db_time_ms: float = 0.0):
+        """(motivo, taxa) se a requisição deve ser logada; (None, taxa) se descartada.
+        flagged (ex.: N+1 detectado) sempre loga.
+        """
+        with self._lock:
+            slow = self._is_slow(route, duration_ms)
+            summary = self._summary.get(route)
+            if summary is None:
+                summary = self._summary[route] = {
+                    "requests": 0, "logged": 0, "2xx": 0, "3xx": 0, "4xx": 0, "5xx": 0,
+                    "slow": 0, "flagged": 0, "duration_ms_total": 0.0, "duration_ms_max": 0.0,
+                    "db_queries_total": 0, "db_time_ms_total": 0.0,
+                }
+            summary["requests"] += 1
+            summary[f"{min(max(status_code // 100, 2), 5)}xx"] += 1
+            summary["duration_ms_total"] += duration_ms
+            summary["db_queries_total"] += db_queries
+            summary["db_time_ms_total"] += db_time_ms
+            if duration_ms > summary["duration_ms_max"]:
+                summary["duration_ms_max"] = duration_ms
+
+            if status_code >= 400:
+                reason, rate = "error", 1.0
+            elif flagged:
+                summary["flagged"] += 1
+                reason, rate = "flagged", 1.0
+            elif slow:
+                summary["slow"] += 1
+                reason, rate = "slow", 1.0
+            else:
+                rate = self._rate(route, tenant)
+                key = (route, tenant)
+                if key not in self._counters and len(self._counters) >= self.MAX_KEYS:
+                    key = (route, "<other>")
+                seen = self._counters.get(key, 0)
+                self._counters[key] = seen + 1
+                every = round(1 / rate) if rate > 0 else 0
+                reason = "sampled" if every and seen % every == 0 else None
+            if reason is not None:
+                summary["logged"] += 1
+            return reason, rate
+
+    def sizes(self) -> dict:
+        """Entradas guardadas (diagnóstico de memória)"""
+        with self._lock:
+            return {
+                "routes": len(self._durations),
+                "keys": len(self._counters),
+                "max_keys": self.MAX_KEYS,
+                "summary_routes": len(self._summary),
+            }
+
+    def flush(self, force: bool = False) -> Optional[dict]:
+        """Agregados por rota da janela encerrada (None se a janela não acabou)"""
+        now = time.monotonic()
+        if not force and now - self._window_start < self.summary_interval:
+            return None
+        with self._lock:
+            summary, self._summary = self._summary, {}
+            self._counters = {}
+            window = now - self._window_start
+            self._window_start = now
+            p95 = {route: threshold for route, (threshold, _) in self._p95.items()}
+        for route, entry in summary.items():
+            entry["window_seconds"] = round(window, 1)
+            entry["duration_ms_avg"] = round(entry.pop("duration_ms_total") / entry["requests"], 2)
+            entry["db_queries_avg"] = round(entry.pop("db_queries_total") / entry["requests"], 2)
+            entry["db_time_ms_avg"] = round(entry.pop("db_time_ms_total") / entry["requests"], 2)
+            entry["duration_ms_max"] = round(entry["duration_ms_max"], 2)
+            entry["p95_ms"] = round(p95[route], 2) if p95.get(route) is not None else None
+        return summary
+
+
+_access_sampler: Optional[AccessLogSampler] = None
+
+
+def get_access_log_sampler() -> AccessLogSampler:
+    global _access_sampler
+    if _access_sampler is None:
+        try:
+            from src.config import get_settings
+            settings = get_settings()
+            _access_sampler = AccessLogSampler(
+                sample_rate=settings.access_log_sample_rate,
+                route_rates=settings.access_log_route_rates,
+                tenant_rates=settings.access_log_tenant_rates,
+                slow_ms=settings.access_log_slow_ms,
+                summary_interval=settings.access_log_summary_interval,
+            )
+        except Exception:
+            _access_sampler = AccessLogSampler()  # Sem configuração: loga tudo
+    return _access_sampler
+
+
+def log_access_summary(logger: logging.Logger, force: bool = False):
+    """Emite os agregados por rota se a janela acabou (force: no shutdown)"""
+    summary = get_access_log_sampler().flush(force=force)
+    for route, entry in (summary or {}).items():
+        logger.info("HTTP Access Summary", extra={"http_route": route, "event_type": "http_summary", **entry})
 
 
 def log_request(logger: logging.Logger, method: str, path: str, 
-                status_code: int, duration_ms: float, user_id: Optional[int] = None):
+                status_code: int, duration_ms: float, user_id: Optional[int] = None,
+                route: Optional[str] = None, tenant: Optional[str] = None,
+                db_queries: Optional[int] = None, db_time_ms: Optional[float] = None,
+                flags: Optional[list] = None):
     """
     Loga requisição HTTP de forma estruturada
     
@@ -107,15 +482,37 @@ def log_request(logger: logging.Logger, method: str, path: str,
         status_code: Código de status HTTP
         duration_ms: Duração da requisição em milissegundos
         user_id: ID do usuário (se autenticado)
+        route: Template da rota (ex.: /clientes/{id}); com ele, a linha passa
+            pela amostragem do AccessLogSampler
+        tenant: Empresa da requisição (chave da amostragem junto com a rota)
+        db_queries: Statements executados na requisição (src/query_collector.py)
+        db_time_ms: Tempo total de banco na requisição
+        flags: Marcas da requisição (ex.: n_plus_one); sempre logada se houver
     """
+    reason = None
+    rate = 1.0
+    if route is not None:
+        sampler = get_access_log_sampler()
+        reason, rate = sampler.decide(route, tenant, status_code, duration_ms, flagged=bool(flags),
+                                      db_queries=db_queries or 0, db_time_ms=db_time_ms or 0.0)
+        log_access_summary(logger)
+        if reason is None:
+            return
     logger.info(
         "HTTP Request",
         extra={
             "http_method": method,
             "http_path": path,
+            "http_route": route,
             "http_status": status_code,
             "duration_ms": duration_ms,
             "user_id": user_id,
+            "tenant": tenant,
+            "db_queries": db_queries,
+            "db_time_ms": round(db_time_ms, 2) if db_time_ms is not None else None,
+            "query_flags": flags or None,
+            "log_reason": reason,
+            "sample_rate": rate,
             "event_type": "http_request"
         }
     )
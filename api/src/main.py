@@ -1,22 +1,47 @@
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from datetime import datetime, timezone
+import asyncio
 
 from src.config import get_settings
-from src.database import get_engine_for_empresa
-from src.routes import auth, clientes, vendas, agendamentos, kpis, produtos, servicos, pacotes, empresas, password_reset
-from src.logger import setup_logger, mask_sensitive_data
+from src.database import (
+    bind_app_loop,
+    health_check_engine,
+    dispose_async_engines,
+    start_databases_watcher,
+    stop_databases_watcher,
+    save_tenant_activity,
+    warm_up_pools,
+    warm_up_async_pools,
+    _ENGINES,
+    _ASYNC_ENGINES,
+    _REPLICAS,
+    _TENANT_ACTIVITY,
+)
+from src.routes import auth, clientes, vendas, agendamentos, kpis, produtos, servicos, pacotes, empresas, password_reset, admin
+from src.logger import (
+    setup_logger, mask_sensitive_data, flush_logging, logging_stats, log_access_summary, get_access_log_sampler
+)
+from src.auth import _token_cache, _password_hasher
+from src import catalog, deadlines, memory, metrics, query_collector
+from src.server_timing import TimedJSONResponse, TimedRoute
+from src.ip_filter import IPFilter
+from src.compression import CompressionStats, negotiate
 from src.middleware import (
-    SecurityHeadersMiddleware,
-    RequestLoggingMiddleware,
-    RequestSizeLimitMiddleware,
-    SQLInjectionProtectionMiddleware,
-    TimeoutMiddleware
+    SecurityPipelineMiddleware,
+    IPFilterGuard,
+    RequestSizeLimitGuard,
+    SQLInjectionGuard,
+    CompressionMiddleware,
+    ProfilingMiddleware,
+    SessionScopeMiddleware,
+    AuthContextMiddleware
 )
 
 settings = get_settings()
@@ -25,6 +50,23 @@ logger = setup_logger(__name__)
 # Rate Limiter
 limiter = Limiter(key_func=get_remote_address, default_limits=["200/minute"])
 
+# Readiness: o worker só recebe tráfego do balanceador após o warm-up
+_readiness = {"ready": False, "warmup": None}
+
+
+async def _warm_up():
+    """Aquece os pools (sync e async) em background e libera a readiness"""
+    warmup = _readiness["warmup"] = {}
+    try:
+        warmup["sync"] = await run_in_threadpool(warm_up_pools)
+        warmup["async"] = await warm_up_async_pools()
+        logger.info("Warm-up dos pools concluído", extra=warmup)
+    except Exception as e:
+        logger.error("Falha no warm-up dos pools", extra={"error": str(e)})
+    finally:
+        _readiness["ready"] = True
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gerencia lifecycle da aplicação"""
@@ -33,29 +75,124 @@ async def lifespan(app: FastAPI):
         "database": mask_sensitive_data(settings.database_url),
         "environment": "production" if not settings.debug else "development"
     })
+    if settings.memory_trace_on_startup:
+        memory.start()
+    # Engines async descartadas em outras threads fecham as conexões neste loop
+    bind_app_loop(asyncio.get_running_loop())
+    start_databases_watcher()
+    warmup_task = None
+    if settings.db_warmup_enabled:
+        warmup_task = asyncio.create_task(_warm_up())
+    else:
+        _readiness["ready"] = True
+    if _metrics_enabled:
+        metrics.start_metrics_refresher()
     yield
     # Shutdown
     logger.info("👋 Petshop API encerrando...")
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    if _metrics_enabled:
+        metrics.stop_metrics_refresher()
+    save_tenant_activity()
+    stop_databases_watcher()
+    _REPLICAS.shutdown()
+    _password_hasher.shutdown()
+    deadlines.shutdown()
+    _ENGINES.dispose_all()
+    await dispose_async_engines()
+    bind_app_loop(None)
+    # Agregados da última janela e logs ainda na fila antes de o processo sair
+    log_access_summary(logger, force=True)
+    flush_logging()
 
 app = FastAPI(
     title="Petshop API",
     description="API REST para gestão completa de petshop com integração ao banco MySQL",
     version="2.0.0",
     lifespan=lifespan,
+    default_response_class=TimedJSONResponse,  # Fase render do Server-Timing
     docs_url="/docs" if settings.debug else None,  # Desabilita docs em produção
     redoc_url="/redoc" if settings.debug else None,
 )
 
+# Rotas definidas direto no app também com as fases do Server-Timing
+app.router.route_class = TimedRoute
+
 # Rate Limiter
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-# Middlewares de Segurança (ordem importa!)
-app.add_middleware(SecurityHeadersMiddleware)
-app.add_middleware(RequestLoggingMiddleware)
-app.add_middleware(RequestSizeLimitMiddleware, max_size_mb=10)
-app.add_middleware(SQLInjectionProtectionMiddleware)
-app.add_middleware(TimeoutMiddleware, timeout_seconds=30)
+
+def _rate_limit_handler(request: Request, exc: RateLimitExceeded):
+    """Resposta padrão do slowapi, contando a rejeição por rota no /metrics"""
+    if _metrics_enabled:
+        route = request.scope.get("route")
+        metrics.record_rate_limited(route.path if route is not None else "<unmatched>")
+    return _rate_limit_exceeded_handler(request, exc)
+
+
+app.add_exception_handler(RateLimitExceeded, _rate_limit_handler)
+
+# Escopo de sessões de banco por requisição (mais interno)
+app.add_middleware(SessionScopeMiddleware)
+
+# Profiler sob demanda (X-Profile assinado): dentro do AuthContext, que identifica o admin
+if settings.profiling_enabled:
+    app.add_middleware(ProfilingMiddleware)
+
+# Identidade da requisição (token decodificado uma vez, em request.state.auth)
+app.add_middleware(AuthContextMiddleware)
+
+# Compressão negociada (gzip/brotli) das respostas grandes (listagens)
+_compression_stats = CompressionStats()
+if settings.compression_enabled:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.compression_min_size,
+        threadpool_min_size=settings.compression_threadpool_min_size,
+        gzip_level=settings.compression_gzip_level,
+        brotli_quality=settings.compression_brotli_quality,
+        stats=_compression_stats
+    )
+
+# Segurança + log de acesso: pipeline única em ASGI puro
+# (guards de IP, tamanho e SQL injection, timeout, headers de segurança, log)
+_ip_filter = IPFilter.from_settings(settings)
+# /metrics traz empresas e rotas: só sobe protegido por token ou allowlist de IP
+_metrics_enabled = settings.metrics_enabled and bool(settings.metrics_token or _ip_filter.restricts("/metrics"))
+if settings.metrics_enabled and not _metrics_enabled:
+    logger.warning("Métricas desligadas: defina METRICS_TOKEN ou uma allowlist de IP para /metrics")
+app.add_middleware(
+    SecurityPipelineMiddleware,
+    guards=[
+        IPFilterGuard(_ip_filter),
+        RequestSizeLimitGuard(
+            max_size_mb=settings.request_max_body_mb,
+            route_limits_mb=settings.request_body_limits_mb
+        ),
+        SQLInjectionGuard(
+            route_rules=settings.sqli_route_rules,
+            max_query_bytes=settings.sqli_max_query_bytes
+        ),
+    ],
+    timeout_seconds=settings.request_timeout_seconds,
+    metrics=_metrics_enabled,
+    server_timing=settings.server_timing_enabled
+)
+
+# Caches e registros no relatório de memória (/admin/memory)
+memory.register_cache("token_cache", _token_cache.stats)
+memory.register_cache("engines", _ENGINES.stats)
+memory.register_cache("async_engines", _ASYNC_ENGINES.stats)
+memory.register_cache("replicas", _REPLICAS.stats)
+memory.register_cache("ip_filter", _ip_filter.stats)
+memory.register_cache("tenant_activity", lambda: {"tenants": len(_TENANT_ACTIVITY)})
+memory.register_cache("access_log_sampler", get_access_log_sampler().sizes)
+memory.register_cache("metrics_tenants", metrics.stats)
+memory.register_cache("accept_encoding", negotiate)
+memory.register_cache("normalized_statements", query_collector.normalize_statement)
+memory.register_cache("logging_queue", logging_stats)
+memory.register_cache("password_hashing", _password_hasher.stats)
 
 # CORS - Configuração mais restritiva
 app.add_middleware(
@@ -70,6 +207,7 @@ app.add_middleware(
         "Accept",
         "Origin",
         "User-Agent",
+        "X-Server-Timing",
     ],
     expose_headers=["Content-Length", "X-Total-Count"],
     max_age=600,  # Cache preflight por 10 minutos
@@ -86,6 +224,7 @@ app.include_router(produtos.router)
 app.include_router(servicos.router)
 app.include_router(pacotes.router)
 app.include_router(empresas.router)
+app.include_router(admin.router)
 
 @app.get("/")
 @limiter.limit("10/minute")
@@ -111,6 +250,36 @@ def root(request: Request):
         "docs": "/docs" if settings.debug else "disabled in production"
     }
 
+@app.get("/health/live")
+def liveness():
+    """Liveness: o processo está de pé (não consulta o banco)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def readiness():
+    """Readiness: 200 só depois do warm-up dos pools (503 enquanto aquece)"""
+    if not _readiness["ready"]:
+        return JSONResponse(content={"status": "warming_up"}, status_code=503)
+    return {"status": "ready", "warmup": _readiness["warmup"]}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    """Métricas no formato Prometheus (METRICS_TOKEN e/ou allowlist de IP)"""
+    if not _metrics_enabled:
+        return JSONResponse(content={"detail": "Not Found"}, status_code=404)
+    if not metrics.is_authorized(request.headers.get("authorization")):
+        return JSONResponse(
+            content={"detail": "Not authenticated"},
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    metrics.refresh()
+    body, content_type = await run_in_threadpool(metrics.render)
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/health")
 @limiter.limit("30/minute")
 def health_check(request: Request):
@@ -125,7 +294,7 @@ def health_check(request: Request):
     
     # Check Database
     try:
-        engine = get_engine_for_empresa(None)
+        engine = health_check_engine()
         with engine.connect() as conn:
             start = datetime.now(timezone.utc)
             conn.execute(text("SELECT 1")).scalar()
@@ -142,6 +311,18 @@ def health_check(request: Request):
             "error": str(e)
         }
     
+    # Registro de engines (hit/miss/evictions)
+    health_status["checks"]["engines"] = _ENGINES.stats()
+    health_status["checks"]["replicas"] = _REPLICAS.stats()
+    health_status["checks"]["token_cache"] = _token_cache.stats()
+    health_status["checks"]["password_hashing"] = _password_hasher.stats()
+    health_status["checks"]["query_deadlines"] = deadlines.stats()
+    health_status["checks"]["ip_filter"] = _ip_filter.stats()
+    health_status["checks"]["compression"] = _compression_stats.stats()
+    health_status["checks"]["catalog_etags"] = catalog.stats()
+    health_status["checks"]["logging"] = logging_stats()
+    health_status["checks"]["metrics"] = metrics.stats()
+
     # Check API
     health_status["checks"]["api"] = {
         "status": "up",
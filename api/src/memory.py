@@ -0,0 +1,237 @@
+"""
+Diagnóstico de crescimento de memória (rotas em /admin/memory)
+
+- tracemalloc: start/stop no worker que atendeu a chamada (o "pid" vem na
+  resposta); com MEMORY_TRACE_ON_STARTUP, todos os workers já sobem medindo
+- Snapshots gravados em MEMORY_SNAPSHOT_DIR (no máximo MEMORY_MAX_SNAPSHOTS;
+  os mais antigos são apagados), não na memória que está sendo investigada
+- Diff entre dois snapshots do mesmo worker: maiores crescimentos agrupados
+  por arquivo e linha (ou só arquivo, ou traceback completo)
+- Relatório: RSS do processo, contadores do gc e tamanho dos caches e
+  registros da aplicação (registrados com register_cache); opcionalmente a
+  contagem de objetos vivos por tipo (percorre o heap inteiro: lento)
+
+tracemalloc deixa as alocações mais lentas e usa memória extra enquanto
+ativo: ligar só durante a investigação.
+"""
+import gc
+import json
+import os
+import re
+import secrets
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from src.config import get_settings
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+settings = get_settings()
+
+GROUP_BY = ("lineno", "filename", "traceback")
+_SNAPSHOT_ID = re.compile(r"^\d{8}T\d{9}-[0-9a-f]{8}$")
+# Alocações do próprio tracemalloc e do import de módulos não interessam
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+# Tipos contados à parte em objects=True (sessões vazadas, engines fora do registro)
+_WATCHED_TYPES = ("Session", "AsyncSession", "Engine", "AsyncEngine", "_ConnectionFairy")
+
+_caches: Dict[str, Callable[[], dict]] = {}
+
+
+def register_cache(name: str, stats: Callable):
+    """Inclui um cache/registro no relatório: função que devolve um dict
+    de estatísticas ou função com @lru_cache (usa cache_info())
+    """
+    if hasattr(stats, "cache_info"):
+        _caches[name] = lambda: stats.cache_info()._asdict()
+    else:
+        _caches[name] = stats
+
+
+def _short_path(filename: str) -> str:
+    for marker in ("/src/", "/site-packages/"):
+        index = filename.rfind(marker)
+        if index >= 0:
+            return filename[index + len(marker):]
+    return filename
+
+
+def _process_memory() -> dict:
+    """RSS atual e pico (Linux: /proc; senão só o pico via resource)"""
+    memory = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key = "rss_mb" if line.startswith("VmRSS") else "rss_peak_mb"
+                    memory[key] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        import resource
+        memory["rss_peak_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return memory
+
+
+def status() -> dict:
+    tracing = tracemalloc.is_tracing()
+    result = {"pid": os.getpid(), "tracing": tracing}
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        result.update({
+            "frames": tracemalloc.get_traceback_limit(),
+            "traced_mb": round(current / 1024 / 1024, 2),
+            "traced_peak_mb": round(peak / 1024 / 1024, 2),
+            "overhead_mb": round(tracemalloc.get_tracemalloc_memory() / 1024 / 1024, 2),
+        })
+    return result
+
+
+def start(frames: Optional[int] = None) -> dict:
+    """Liga o tracemalloc neste worker (sem efeito se já estiver ligado)"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames or settings.memory_trace_frames)
+        logger.info("tracemalloc ligado", extra={"frames": tracemalloc.get_traceback_limit()})
+    return status()
+
+
+def stop() -> dict:
+    """Desliga o tracemalloc neste worker (descarta os traces; snapshots ficam)"""
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        logger.info("tracemalloc desligado")
+    return status()
+
+
+def _stat_entry(stat, group_by: str) -> dict:
+    frame = stat.traceback[0]
+    entry = {
+        "file": _short_path(frame.filename),
+        "line": frame.lineno if group_by != "filename" else None,
+        "size_kb": round(stat.size / 1024, 1),
+        "count": stat.count,
+    }
+    if hasattr(stat, "size_diff"):
+        entry["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+        entry["count_diff"] = stat.count_diff
+    if group_by == "traceback":
+        entry["traceback"] = [f"{_short_path(f.filename)}:{f.lineno}" for f in stat.traceback]
+    return entry
+
+
+class SnapshotStore:
+    """Snapshots do tracemalloc em disco (.snap + .json de metadados), em quantidade limitada"""
+
+    def __init__(self, directory: str, max_snapshots: int):
+        self.directory = directory
+        self.max_snapshots = max_snapshots
+
+    def _path(self, snapshot_id: str, extension: str) -> str:
+        return os.path.join(self.directory, snapshot_id + extension)
+
+    def ids(self) -> list:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json") and _SNAPSHOT_ID.match(name[:-5]))
+
+    def save(self, snapshot, meta: dict) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot.dump(self._path(meta["id"], ".snap"))
+        with open(self._path(meta["id"], ".json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        ids = self.ids()
+        for old in ids[:max(len(ids) - self.max_snapshots, 0)]:
+            for extension in (".snap", ".json"):
+                try:
+                    os.remove(self._path(old, extension))
+                except FileNotFoundError:
+                    pass
+        return meta
+
+    def meta(self, snapshot_id: str) -> Optional[dict]:
+        if not _SNAPSHOT_ID.match(snapshot_id):
+            return None
+        try:
+            with open(self._path(snapshot_id, ".json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, snapshot_id: str):
+        return tracemalloc.Snapshot.load(self._path(snapshot_id, ".snap"))
+
+    def list(self) -> list:
+        return [meta for meta in map(self.meta, reversed(self.ids())) if meta is not None]
+
+
+store = SnapshotStore(settings.memory_snapshot_dir, settings.memory_max_snapshots)
+
+
+def take_snapshot(limit: int = 10) -> Optional[dict]:
+    """Grava um snapshot deste worker. None se o tracemalloc estiver desligado"""
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    now = datetime.now(timezone.utc)
+    meta = {
+        "id": f"{now:%Y%m%dT%H%M%S}{now.microsecond // 1000:03d}-{secrets.token_hex(4)}",
+        "created_at": now.isoformat(),
+        **_process_memory(),
+        **{key: value for key, value in status().items() if key != "pid"},
+        "top": [_stat_entry(stat, "lineno") for stat in snapshot.statistics("lineno")[:limit]],
+    }
+    return store.save(snapshot, meta)
+
+
+def diff(old_id: str, new_id: str, group_by: str = "lineno", limit: int = 25) -> dict:
+    """Maiores crescimentos de old_id para new_id.
+    LookupError: snapshot inexistente; ValueError: snapshots de workers diferentes
+    """
+    old_meta, new_meta = store.meta(old_id), store.meta(new_id)
+    if old_meta is None or new_meta is None:
+        raise LookupError(old_id if old_meta is None else new_id)
+    if old_meta["pid"] != new_meta["pid"]:
+        raise ValueError("Snapshots de workers diferentes (pid) não são comparáveis")
+    stats = store.load(new_id).compare_to(store.load(old_id), group_by)
+    return {
+        "old": old_id,
+        "new": new_id,
+        "pid": new_meta["pid"],
+        "group_by": group_by,
+        "size_diff_kb": round(sum(stat.size_diff for stat in stats) / 1024, 1),
+        "top": [_stat_entry(stat, group_by) for stat in stats[:limit]],
+    }
+
+
+def _object_counts(limit: int = 20) -> dict:
+    counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return {
+        "watched": {name: counts.get(name, 0) for name in _WATCHED_TYPES},
+        "top_types": dict(counts.most_common(limit)),
+        "total": sum(counts.values()),
+    }
+
+
+def report(objects: bool = False) -> dict:
+    caches = {}
+    for name, stats in _caches.items():
+        try:
+            caches[name] = stats()
+        except Exception as e:
+            caches[name] = {"error": str(e)}
+    result = {
+        "process": _process_memory(),
+        "tracemalloc": status(),
+        "gc": {"counts": gc.get_count(), "garbage": len(gc.garbage)},
+        "caches": caches,
+    }
+    if objects:
+        result["objects"] = _object_counts()
+    return result
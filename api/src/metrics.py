@@ -0,0 +1,312 @@
+"""
+Métricas Prometheus (GET /metrics)
+
+- Latência por rota (template), método, classe de status e empresa
+- Requisições em andamento
+- Pools de cada engine (sync e async): tamanho, em uso, overflow e
+  requisições esperando conexão
+- Threadpool do AnyIO (rotas sync, run_in_threadpool): ocupação e fila
+- Cache de tokens (hits/misses) e rejeições do rate limiter
+
+Cardinalidade limitada: só METRICS_TOP_TENANTS empresas ganham label próprio,
+as demais viram "other". O conjunto é fixado no startup a partir do ranking
+de atividade compartilhado pelos workers (DB_ACTIVITY_FILE, o mesmo do
+warm-up) e não muda até o próximo restart. Só códigos do databases.json
+ganham label (o X-Empresa vem do cliente). Os pools seguem o mesmo limite:
+engines de empresas sem label somam em "other", as de modo server em "server".
+
+Acesso: METRICS_TOKEN (Authorization: Bearer) e/ou allowlist de IP para
+/metrics; sem nenhum dos dois, as métricas ficam desligadas (src/main.py).
+
+Com --workers N (PM2 em produção), PROMETHEUS_MULTIPROC_DIR faz cada worker
+escrever em arquivos mmap do diretório e /metrics soma todos. O diretório
+precisa começar vazio a cada deploy; gauges de workers mortos são removidos.
+"""
+import asyncio
+import glob
+import hmac
+import os
+import re
+from typing import Callable, Optional
+
+from src.config import get_settings
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+settings = get_settings()
+
+# O prometheus_client decide o modo (memória ou mmap) no import: a variável
+# de ambiente precisa existir antes dele, mesmo quando vem do .env
+if settings.prometheus_multiproc_dir:
+    os.makedirs(settings.prometheus_multiproc_dir, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = settings.prometheus_multiproc_dir
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+from prometheus_client import multiprocess  # noqa: E402
+
+_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+OTHER_TENANT = "other"
+NO_TENANT = "none"
+
+# Até o timeout padrão da requisição (30s)
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latência das requisições HTTP",
+    ["route", "method", "status_class", "tenant"], buckets=_LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requisições HTTP em andamento", multiprocess_mode="livesum",
+)
+RATE_LIMITED = Counter(
+    "rate_limit_rejections_total", "Requisições rejeitadas pelo rate limiter", ["route"],
+)
+
+_POOL_LABELS = ["engine", "kind"]
+POOL_SIZE = Gauge("db_pool_size", "Conexões permanentes do pool", _POOL_LABELS, multiprocess_mode="livesum")
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Conexões em uso", _POOL_LABELS, multiprocess_mode="livesum")
+POOL_OVERFLOW = Gauge("db_pool_overflow", "Conexões de overflow abertas", _POOL_LABELS, multiprocess_mode="livesum")
+POOL_WAITING = Gauge(
+    "db_pool_waiting", "Threads/tarefas esperando uma conexão livre", _POOL_LABELS, multiprocess_mode="livesum",
+)
+
+THREADPOOL_BUSY = Gauge("threadpool_busy_threads", "Threads do AnyIO ocupadas", multiprocess_mode="livesum")
+THREADPOOL_CAPACITY = Gauge("threadpool_capacity", "Limite de threads do AnyIO", multiprocess_mode="livesum")
+THREADPOOL_WAITING = Gauge(
+    "threadpool_waiting_tasks", "Tarefas esperando thread do AnyIO", multiprocess_mode="livesum",
+)
+
+TOKEN_CACHE_HITS = Counter("token_cache_hits_total", "Tokens validados pelo cache")
+TOKEN_CACHE_MISSES = Counter("token_cache_misses_total", "Tokens decodificados (fora do cache)")
+TOKEN_CACHE_SIZE = Gauge("token_cache_size", "Entradas no cache de tokens", multiprocess_mode="livesum")
+
+
+class TenantLabels:
+    """
+    Label de empresa com cardinalidade limitada
+
+    seed() fixa as top N do ranking de atividade (igual em todos os workers).
+    Vagas que sobrarem (ranking vazio no primeiro deploy) são preenchidas
+    por ordem de chegada em cada worker, só com empresas conhecidas
+    (known: mapa de empresas do databases.json); antes do seed, tudo é
+    "other". O conjunto nunca é refeito em execução: séries novas não
+    aparecem a cada ciclo. Chamado só no event loop.
+    """
+
+    def __init__(self, top_n: int):
+        self.top_n = top_n
+        self._labeled = set()
+        self._known: Optional[Callable[[], dict]] = None
+
+    def seed(self, activity: dict, known: Callable[[], dict]):
+        self._known = known
+        tenants = known()
+        ranked = sorted((item for item in activity.items() if item[0] in tenants),
+                        key=lambda item: item[1], reverse=True)
+        self._labeled = {tenant for tenant, _ in ranked[:self.top_n]}
+
+    def label(self, tenant: Optional[str]) -> str:
+        if not tenant:
+            return NO_TENANT
+        if tenant in self._labeled:
+            return tenant
+        if len(self._labeled) < self.top_n and self._known is not None and tenant in self._known():
+            self._labeled.add(tenant)
+            return tenant
+        return OTHER_TENANT
+
+    def peek(self, tenant: str) -> str:
+        """Label já atribuído (sem ocupar vaga): pools seguem o tráfego"""
+        return tenant if tenant in self._labeled else OTHER_TENANT
+
+    def labeled(self) -> list:
+        return sorted(self._labeled)
+
+
+_tenants = TenantLabels(settings.metrics_top_tenants)
+# Séries de pool já publicadas: removidas quando não há mais engine com o
+# label (em modo multiprocess o valor fica no arquivo: zeradas)
+_pool_series = set()
+_token_cache_seen = {"hits": 0, "misses": 0}
+_refresher: Optional[asyncio.Task] = None
+
+
+def is_authorized(authorization: Optional[str]) -> bool:
+    """Header Authorization com o METRICS_TOKEN (sem token configurado: livre,
+    o acesso fica com a allowlist de IP)
+    """
+    if not settings.metrics_token:
+        return True
+    return hmac.compare_digest((authorization or "").encode(), f"Bearer {settings.metrics_token}".encode())
+
+
+def request_started():
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def request_finished():
+    REQUESTS_IN_PROGRESS.dec()
+
+
+def observe_request(route: str, method: str, status_code: int, tenant: Optional[str], duration_seconds: float):
+    REQUEST_LATENCY.labels(route, method, f"{status_code // 100}xx", _tenants.label(tenant)).observe(duration_seconds)
+
+
+def record_rate_limited(route: str):
+    RATE_LIMITED.labels(route).inc()
+
+
+def _pool_waiters(pool) -> int:
+    """Esperando conexão: Condition do Queue (sync) ou getters do asyncio.Queue (async)"""
+    queue = getattr(pool, "_pool", None)
+    try:
+        condition = getattr(queue, "not_empty", None)
+        if condition is not None:
+            return len(condition._waiters)
+        if "_queue" in vars(queue):  # memoized: só existe depois do primeiro uso
+            return len(queue._queue._getters)
+    except (AttributeError, TypeError):
+        pass
+    return 0
+
+
+def _pool_label(key: str) -> str:
+    """Label do pool pela chave do registro: "empresa", "empresa@replica:…"
+    ou "server:…" (modo server, engine compartilhada por várias empresas)
+    """
+    if key.startswith("server:"):
+        return "server"
+    tenant, replica, _ = key.partition("@replica:")
+    label = _tenants.peek(tenant)
+    return f"{label}@replica" if replica else label
+
+
+def _refresh_pools():
+    from src.database import _ASYNC_ENGINES, _ENGINES
+
+    totals = {}
+    for kind, registry in (("sync", _ENGINES), ("async", _ASYNC_ENGINES)):
+        for key, engine in registry.engines():
+            pool = getattr(engine, "sync_engine", engine).pool
+            values = totals.setdefault((_pool_label(key), kind), [0, 0, 0, 0])
+            try:
+                values[0] += pool.size()
+                values[1] += pool.checkedout()
+                values[2] += max(pool.overflow(), 0)
+            except AttributeError:  # Pools sem contadores (ex.: NullPool)
+                pass
+            values[3] += _pool_waiters(pool)
+    gauges = (POOL_SIZE, POOL_CHECKED_OUT, POOL_OVERFLOW, POOL_WAITING)
+    for labels, values in totals.items():
+        for gauge, value in zip(gauges, values):
+            gauge.labels(*labels).set(value)
+    for labels in _pool_series - totals.keys():
+        for gauge in gauges:
+            if _MULTIPROC_DIR:
+                gauge.labels(*labels).set(0)
+            else:
+                gauge.remove(*labels)
+    _pool_series.clear()
+    _pool_series.update(totals)
+
+
+def _refresh_threadpool():
+    from anyio import to_thread
+
+    try:
+        limiter = to_thread.current_default_thread_limiter()
+    except RuntimeError:  # Fora do event loop
+        return
+    statistics = limiter.statistics()
+    THREADPOOL_BUSY.set(statistics.borrowed_tokens)
+    THREADPOOL_CAPACITY.set(statistics.total_tokens)
+    THREADPOOL_WAITING.set(statistics.tasks_waiting)
+
+
+def _refresh_token_cache():
+    from src.auth import _token_cache
+
+    stats = _token_cache.stats()
+    # Contadores do cache são cumulativos no processo: publica só o incremento
+    for name, counter in (("hits", TOKEN_CACHE_HITS), ("misses", TOKEN_CACHE_MISSES)):
+        delta = stats[name] - _token_cache_seen[name]
+        if delta > 0:
+            counter.inc(delta)
+        _token_cache_seen[name] = stats[name]
+    TOKEN_CACHE_SIZE.set(stats["size"])
+
+
+def refresh():
+    """Atualiza os gauges deste worker (no event loop; também antes de cada /metrics)"""
+    for step in (_refresh_pools, _refresh_threadpool, _refresh_token_cache):
+        try:
+            step()
+        except Exception as e:
+            logger.warning("Falha ao atualizar métricas", extra={"step": step.__name__, "error": str(e)})
+
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(settings.metrics_refresh_interval)
+        refresh()
+
+
+def _cleanup_dead_workers():
+    """Remove os gauges de workers que não existem mais (restart do PM2)"""
+    for path in glob.glob(os.path.join(_MULTIPROC_DIR, "gauge_live*_*.db")):
+        match = re.search(r"_(\d+)\.db$", path)
+        if match is None:
+            continue
+        pid = int(match.group(1))
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            multiprocess.mark_process_dead(pid)
+        except PermissionError:  # Existe, de outro usuário
+            pass
+
+
+def start_metrics_refresher():
+    """Inicia a atualização periódica dos gauges (chamar no startup)"""
+    from src.database import _activity_file_path, _load_databases_map, _read_activity
+
+    global _refresher
+    if _MULTIPROC_DIR:
+        _cleanup_dead_workers()
+    _tenants.seed(_read_activity(_activity_file_path()), known=_load_databases_map)
+    refresh()
+    _refresher = asyncio.create_task(_refresh_loop())
+
+
+def stop_metrics_refresher():
+    """Para a atualização e, em modo multiprocess, descarta os gauges do worker"""
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        _refresher = None
+    if _MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def render():
+    """Corpo e content-type do /metrics (soma dos workers em modo multiprocess).
+    Lê os arquivos dos workers: chamar fora do event loop, depois de refresh().
+    """
+    if _MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def stats() -> dict:
+    return {
+        "multiprocess": bool(_MULTIPROC_DIR),
+        "top_tenants": _tenants.top_n,
+        "labeled_tenants": len(_tenants.labeled()),
+        "pool_series": len(_pool_series),
+    }
@@ -1,242 +1,790 @@
 """
 Middleware de segurança para proteção adicional
 """
-from fastapi import Request, Response, HTTPException, status
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from typing import Callable
+from fastapi import status
+from starlette.exceptions import HTTPException
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+import asyncio
+import json
+import re
+import sys
 import time
 from src.logger import setup_logger, log_request, log_security_event
+from src.config import get_settings
+from src.database import begin_session_scope, end_session_scope, report_open_sessions
+from src.auth import AuthContext
+from src.compression import CompressionStats, Encoder, is_compressible, negotiate
+from src.deadlines import begin_request_deadline, end_request_deadline
+from src import metrics, profiling, query_collector, server_timing
+from src.ip_filter import IPFilter, IPRuleSet
 
 logger = setup_logger(__name__)
+settings = get_settings()
 
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    """Adiciona headers de segurança em todas as respostas"""
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        response = await call_next(request)
-        
-        # Security Headers
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
-        
-        # Remove header que expõe tecnologia
-        if "Server" in response.headers:
-            del response.headers["Server"]
-        
-        return response
-
-
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
-    """Loga todas as requisições HTTP"""
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        start_time = time.time()
-        
-        # Pega informações da requisição
-        method = request.method
-        path = request.url.path
-        
+class SessionScopeMiddleware:
+    """
+    Escopo de sessões de banco por requisição (ASGI puro)
+    Fecha ao final da requisição toda sessão aberta durante ela e, com
+    DB_SESSION_LEAK_DEBUG, loga as que ainda seguram conexão na resposta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = begin_session_scope()
+
+        async def send_with_leak_check(message):
+            if message["type"] == "http.response.start":
+                report_open_sessions(scope.get("path", ""))
+            await send(message)
+
         try:
-            response = await call_next(request)
-            
-            # Calcula duração
-            duration_ms = (time.time() - start_time) * 1000
-            
-            # Extrai user_id se disponível
-            user_id = None
-            if hasattr(request.state, "user"):
-                user_id = getattr(request.state.user, "id", None)
-            
-            # Loga requisição
-            log_request(
-                logger=logger,
-                method=method,
-                path=path,
-                status_code=response.status_code,
-                duration_ms=duration_ms,
-                user_id=user_id
-            )
-            
-            return response
-            
-        except Exception as e:
-            duration_ms = (time.time() - start_time) * 1000
-            
-            logger.error(
-                f"Request failed: {method} {path}",
-                extra={
-                    "error": str(e),
-                    "duration_ms": duration_ms,
-                    "event_type": "request_error"
-                }
+            await self.app(
+                scope, receive,
+                send_with_leak_check if settings.db_session_leak_debug else send
             )
-            raise
+        finally:
+            await end_session_scope(token)
 
 
-class IPWhitelistMiddleware(BaseHTTPMiddleware):
+class AuthContextMiddleware:
     """
-    Middleware para whitelist de IPs (opcional)
-    Útil para endpoints administrativos
+    Decodifica o token Bearer uma única vez por requisição (ASGI puro)
+    e guarda o AuthContext em scope["state"] (request.state.auth).
     """
 
-    def __init__(self, app, allowed_ips: list = None):
-        super().__init__(app)
-        self.allowed_ips = set(allowed_ips or [])  # Usa set para lookup O(1)
-        self.enabled = len(self.allowed_ips) > 0
-        self._ip_cache = {}  # Cache simples para IPs verificados
-        self._cache_ttl = 300  # 5 minutos
-
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        if not self.enabled:
-            return await call_next(request)
+    def __init__(self, app):
+        self.app = app
 
-        # Pega IP do cliente
-        client_ip = request.client.host
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            authorization = x_empresa = None
+            for name, value in scope["headers"]:
+                if name == b"authorization":
+                    authorization = value.decode("latin-1")
+                elif name == b"x-empresa":
+                    x_empresa = value.decode("latin-1")
+            start = time.perf_counter()
+            scope.setdefault("state", {})["auth"] = AuthContext.from_headers(authorization, x_empresa)
+            server_timing.record("auth", start)
+        await self.app(scope, receive, send)
 
-        # Verifica cache primeiro
-        current_time = time.time()
-        if client_ip in self._ip_cache:
-            cached_result, cache_time = self._ip_cache[client_ip]
-            if current_time - cache_time < self._cache_ttl:
-                if not cached_result:
-                    raise HTTPException(
-                        status_code=status.HTTP_403_FORBIDDEN,
-                        detail="IP não autorizado"
-                    )
-                return await call_next(request)
 
-        # Verifica whitelist
-        allowed = client_ip in self.allowed_ips
+class ProfilingMiddleware:
+    """
+    Profiler por amostragem da requisição com X-Profile válido (src/profiling.py)
+    Fica dentro do AuthContextMiddleware: o header só vale para o admin global
+    (is_superadmin) e assinado para a sua empresa + login. A resposta traz
+    X-Profile-Id.
+    """
 
-        # Atualiza cache
-        self._ip_cache[client_ip] = (allowed, current_time)
+    def __init__(self, app, store: Optional[profiling.ProfileStore] = None):
+        self.app = app
+        self.store = store or profiling.store
 
-        if not allowed:
-            logger.warning(
-                f"IP bloqueado tentou acessar: {client_ip}",
-                extra={
-                    "ip": client_ip,
-                    "path": request.url.path,
-                    "event_type": "ip_blocked"
-                }
-            )
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="IP não autorizado"
-            )
+    async def __call__(self, scope, receive, send):
+        value = _header(scope, b"x-profile") if scope["type"] == "http" else None
+        if value is None:
+            return await self.app(scope, receive, send)
 
-        return await call_next(request)
-        if client_ip not in self.allowed_ips:
+        auth = scope.get("state", {}).get("auth")
+        payload = auth.payload if auth is not None else None
+        if not profiling.verify_token(value.decode("latin-1"), auth.user if auth is not None else None):
             log_security_event(
                 logger=logger,
-                event_type="ip_blocked",
-                description=f"Access denied from IP {client_ip}",
+                event_type="profiling_denied",
+                description=f"X-Profile inválido em {scope['method']} {scope['path']}",
                 severity="WARNING",
-                ip_address=client_ip
+                user_id=payload.get("id_funcionario") if payload else None,
+                ip_address=_client_ip(scope)
             )
-            
-            return JSONResponse(
-                status_code=status.HTTP_403_FORBIDDEN,
-                content={"detail": "Access forbidden"}
-            )
-        
-        return await call_next(request)
+            return await self.app(scope, receive, send)
+
+        # Frame desta coroutine: raiz das pilhas amostradas
+        session = profiling.begin_profile(sys._getframe())
+        if session is None:
+            logger.warning("Perfil ignorado: limite de perfis simultâneos", extra={"http_path": scope["path"]})
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers", ())) + [(b"x-profile-id", session.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiling.end_profile(session)
+            route = scope.get("route")
+            meta = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route.path if route is not None else None,
+                "status": status_code,
+                "user": payload.get("sub"),
+            }
+            try:
+                meta = await run_in_threadpool(self.store.save, session, meta)
+                logger.info("Perfil da requisição salvo", extra={"profile": meta})
+            except OSError as e:
+                logger.error("Falha ao salvar perfil", extra={"profile_id": session.id, "error": str(e)})
+
+
+def _client_ip(scope) -> Optional[str]:
+    """IP do cliente (o real, se o IPFilterGuard já resolveu pelos proxies)"""
+    state = scope.get("state")
+    if state and "client_ip" in state:
+        return state["client_ip"]
+    client = scope.get("client")
+    return client[0] if client else None
 
 
-class RequestSizeLimitMiddleware(BaseHTTPMiddleware):
-    """Limita tamanho das requisições para prevenir DoS"""
-    
-    def __init__(self, app, max_size_mb: float = 10):
-        super().__init__(app)
+def _header(scope, name: bytes) -> Optional[bytes]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return None
+
+
+class IPFilterGuard:
+    """
+    Allowlist/denylist de IPs por CIDR, com regras por path (src/ip_filter.py)
+    Resolve o IP real atrás de proxies confiáveis e o guarda em
+    scope["state"]["client_ip"] para os logs da requisição.
+    """
+
+    def __init__(self, ip_filter: IPFilter):
+        self.ip_filter = ip_filter
+
+    def __call__(self, scope) -> Optional[Tuple[int, dict]]:
+        client_ip = self.ip_filter.client_ip(scope)
+        scope.setdefault("state", {})["client_ip"] = client_ip
+        if not self.ip_filter.enabled or self.ip_filter.is_allowed(scope["path"], client_ip):
+            return None
+
+        log_security_event(
+            logger=logger,
+            event_type="ip_blocked",
+            description=f"Access denied from IP {client_ip}",
+            severity="WARNING",
+            ip_address=client_ip
+        )
+        return status.HTTP_403_FORBIDDEN, {"detail": "IP não autorizado"}
+
+
+class RequestBodyTooLarge(HTTPException):
+    """Corpo da requisição passou do limite enquanto era lido (413)"""
+
+    def __init__(self, limit_bytes: float):
+        super().__init__(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Request size exceeds {limit_bytes / 1024 / 1024}MB limit",
+        )
+
+
+class RequestSizeLimitGuard:
+    """
+    Limita tamanho das requisições para prevenir DoS
+    - Content-Length acima do limite: 413 antes de ler o corpo
+    - Sem Content-Length (chunked): wrap_receive conta os bytes conforme
+      chegam e aborta com 413 assim que o limite é cruzado, sem bufferizar
+
+    route_limits_mb: {prefixo do path: MB}; vale o maior prefixo que casar.
+    """
+
+    def __init__(self, max_size_mb: float = 10, route_limits_mb: Optional[Dict[str, float]] = None):
         self.max_size_bytes = max_size_mb * 1024 * 1024
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # Verifica Content-Length header
-        content_length = request.headers.get("content-length")
-        
-        if content_length and int(content_length) > self.max_size_bytes:
-            log_security_event(
-                logger=logger,
-                event_type="request_too_large",
-                description=f"Request size {content_length} exceeds limit {self.max_size_bytes}",
-                severity="WARNING",
-                ip_address=request.client.host
-            )
-            
-            return JSONResponse(
-                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                content={"detail": f"Request size exceeds {self.max_size_bytes / 1024 / 1024}MB limit"}
+        # Maior prefixo primeiro
+        self._routes = sorted(
+            ((prefix, mb * 1024 * 1024) for prefix, mb in (route_limits_mb or {}).items()),
+            key=lambda item: len(item[0]), reverse=True,
+        )
+
+    def _limit_for(self, path: str) -> float:
+        for prefix, limit in self._routes:
+            if path.startswith(prefix):
+                return limit
+        return self.max_size_bytes
+
+    def _log(self, scope, size, limit):
+        log_security_event(
+            logger=logger,
+            event_type="request_too_large",
+            description=f"Request size {size} exceeds limit {limit} on {scope['path']}",
+            severity="WARNING",
+            ip_address=_client_ip(scope)
+        )
+
+    def __call__(self, scope) -> Optional[Tuple[int, dict]]:
+        content_length = _header(scope, b"content-length")
+        if content_length is None:
+            return None
+        if not content_length.isdigit():
+            return status.HTTP_400_BAD_REQUEST, {"detail": "Invalid Content-Length header"}
+        limit = self._limit_for(scope["path"])
+        if int(content_length) > limit:
+            self._log(scope, int(content_length), limit)
+            return (
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                {"detail": f"Request size exceeds {limit / 1024 / 1024}MB limit"},
             )
-        
-        return await call_next(request)
+        return None
+
+    def wrap_receive(self, scope, receive):
+        """receive que conta os bytes do corpo e levanta RequestBodyTooLarge"""
+        if _header(scope, b"content-length") is not None:
+            # Já validado acima; o servidor não entrega mais que o Content-Length
+            return receive
+        limit = self._limit_for(scope["path"])
+        received = 0
 
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    self._log(scope, f">{received}", limit)
+                    raise RequestBodyTooLarge(limit)
+            return message
 
-class SQLInjectionProtectionMiddleware(BaseHTTPMiddleware):
+        return receive_limited
+
+
+# Bytes de palavra (\w ASCII e latin-1 acentuado) ficam; o resto vira espaço
+_WORD_BYTES = bytes(c if (c in b"0123456789_" or 97 <= c <= 122 or c >= 128) else 32 for c in range(256))
+
+
+def _padded_words(text: str) -> str:
+    """Texto com cada caractere que não é de palavra trocado por espaço (e espaço nas pontas).
+    A troca é em bytes (bytes.translate, em C); a volta para str deixa o `in` mais barato
+    """
+    return (b" " + text.encode("latin-1").translate(_WORD_BYTES) + b" ").decode("latin-1")
+
+
+class SQLInjectionGuard:
     """
     Detecta tentativas básicas de SQL Injection em query parameters
     Nota: Não substitui queries parametrizadas, é apenas uma camada extra
+
+    Custo linear no tamanho da query string, quase todo em buscas de
+    substring em C (nenhuma regex com alternância ou distância variável):
+    0. Query string acima de max_query_bytes: 414 sem varrer (16 KB, o
+       limite de linha de requisição do uvicorn/h11 e da Cloudflare)
+    1. Pré-filtro: a query string decodificada (uma vez) e em minúsculas é
+       procurada pelas âncoras das regras. Palavras só
+       contam inteiras: todo caractere que não é de palavra vira espaço
+       (bytes.translate) e a palavra é buscada como " select ". Trechos de
+       pontuação ("--", "||", "0x"...) com `in`, depois de um memchr pelo
+       caractere raro. Sem âncora (o caso comum), a requisição passa aqui
+    2. Só então cada valor passa pelas regras das âncoras achadas:
+       - Palavras-chave SQL no formato de um comando, em ordem no mesmo
+         valor ("union ... select", "select ... from", "update ... set",
+         "drop ... table"...): "Pet Update", "Executivo" e "Loja Select" passam
+       - Regex ("--" como comentário SQL, exec(...), <script>, 0x...)
+         começando pela âncora (busca de prefixo do re). Âncora repetida
+         mais de MAX_REPEATS vezes no valor é recusada sem rodar a regex
+       - A regra "keyword_strict" (fora do padrão) recusa a palavra isolada
+
+    route_rules: {prefixo do path: nomes de regras | None}. Vale o maior
+    prefixo que casar; None desliga a verificação naquele prefixo.
     """
-    
-    SUSPICIOUS_PATTERNS = [
-        "union", "select", "insert", "update", "delete", "drop",
-        "exec", "execute", "script", "javascript", "--", "/*", "*/",
-        "xp_", "sp_", "0x", "char(", "chr(", "ascii(", "||", "&&"
-    ]
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # Verifica query parameters
-        for key, value in request.query_params.items():
-            value_lower = str(value).lower()
-            
-            for pattern in self.SUSPICIOUS_PATTERNS:
-                if pattern in value_lower:
-                    log_security_event(
-                        logger=logger,
-                        event_type="sql_injection_attempt",
-                        description=f"Suspicious pattern '{pattern}' in parameter '{key}'",
-                        severity="ERROR",
-                        ip_address=request.client.host
-                    )
-                    
-                    return JSONResponse(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        content={"detail": "Invalid request parameters"}
-                    )
-        
-        return await call_next(request)
-
-
-class TimeoutMiddleware(BaseHTTPMiddleware):
-    """Adiciona timeout para requisições"""
-    
-    def __init__(self, app, timeout_seconds: int = 30):
-        super().__init__(app)
-        self.timeout_seconds = timeout_seconds
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        import asyncio
-        
-        try:
-            return await asyncio.wait_for(
-                call_next(request),
-                timeout=self.timeout_seconds
-            )
-        except asyncio.TimeoutError:
+
+    _DROP_TARGETS = ("table", "database", "schema", "view", "index", "procedure")
+    _EXEC = r"exec(?:ute)?\s*[\s(]\s*[\w@'\"]"
+
+    # Regra: verificações (âncora, palavra que precisa vir depois, regex).
+    # Âncora só com letras = palavra inteira; com pontuação = trecho literal.
+    # Sem palavra seguinte nem regex, a âncora sozinha basta.
+    RULES = {
+        "statement": (
+            ("union", "select", None), ("select", "from", None), ("insert", "into", None),
+            ("delete", "from", None), ("update", "set", None),
+        ) + tuple(("drop", target, None) for target in _DROP_TARGETS),
+        "exec": (("exec", None, _EXEC), ("execute", None, _EXEC)),
+        "script": (("<", None, r"<\s*script\b"), ("javascript", None, r"javascript\s*:")),
+        "keyword_strict": tuple(
+            (word, None, None) for word in ("union", "select", "insert", "update", "delete", "drop",
+                                            "exec", "execute", "script", "javascript")
+        ),
+        "comment": (("--", None, r"--(?:\s|$)"), ("/*", None, None), ("*/", None, None)),
+        "proc": (("xp_", None, r"xp_(?<!\wxp_)\w"), ("sp_", None, r"sp_(?<!\wsp_)\w")),
+        "hex": (("0x", None, r"0x(?<!\w0x)[0-9a-f]+\b"),),
+        "function": tuple((word, None, rf"{word}\s*\(") for word in ("char", "chr", "ascii")),
+        "operator": (("||", None, None), ("&&", None, None)),
+    }
+    DEFAULT_RULES = ["statement", "exec", "script", "comment", "proc", "hex", "function", "operator"]
+    # Nenhum valor legítimo repete "exec", "--" ou "0x" dezenas de vezes; limita o trabalho da regex
+    MAX_REPEATS = 32
+
+    def __init__(self, rules: Optional[List[str]] = None,
+                 route_rules: Optional[Dict[str, Optional[List[str]]]] = None,
+                 max_query_bytes: int = 16384):
+        self.max_query_bytes = max_query_bytes
+        self._default = self._compile(rules or self.DEFAULT_RULES)
+        # Maior prefixo primeiro
+        self._routes = sorted(
+            ((prefix, self._compile(names) if names else None) for prefix, names in (route_rules or {}).items()),
+            key=lambda item: len(item[0]), reverse=True,
+        )
+
+    @classmethod
+    def _compile(cls, names: List[str]):
+        """(palavras-âncora, trechos-âncora, caracteres raros, verificações) de um conjunto de regras.
+        Palavra vira " palavra "; trecho vira (caractere raro, trecho): o `in`
+        de um caractere só é um memchr e descarta rápido
+        """
+        unknown = set(names) - set(cls.RULES)
+        if unknown:
+            raise ValueError(f"Regras de SQL injection desconhecidas: {sorted(unknown)}")
+        words, literals, checks = [], [], []
+        for name in names:
+            for anchor, following, pattern in cls.RULES[name]:
+                if anchor.isalpha():
+                    key = f" {anchor} "
+                    if key not in words:
+                        words.append(key)
+                else:
+                    key = (next((char for char in anchor if not char.isalnum()), anchor[-1]), anchor)
+                    if key not in literals:
+                        literals.append(key)
+                checks.append((
+                    name, key,
+                    f" {following} " if following else None,
+                    re.compile(pattern) if pattern else None,
+                ))
+        return tuple(words), tuple(literals), frozenset(gate for gate, _ in literals), checks
+
+    def _rules_for(self, path: str):
+        for prefix, rules in self._routes:
+            if path.startswith(prefix):
+                return rules
+        return self._default
+
+    @staticmethod
+    def _anchors(words, literals, gates, text: str, padded: str):
+        """(palavras, trechos) presentes no texto em minúsculas (padded: _padded_words(text))"""
+        # filter/map + __contains__: o laço fica em C
+        found_words = tuple(filter(padded.__contains__, words))
+        if not any(map(text.__contains__, gates)):
+            return found_words, ()
+        return found_words, tuple(key for key in literals if key[0] in text and key[1] in text)
+
+    @classmethod
+    def _match(cls, checks, value: str) -> Optional[Tuple[str, str]]:
+        """(regra, trecho) da primeira verificação que casar com o valor.
+        checks: só as das âncoras achadas pelo pré-filtro
+        """
+        value = value.lower()
+        padded = None
+        for name, anchor, following, pattern in checks:
+            if type(anchor) is str:  # Palavra inteira
+                if padded is None:
+                    padded = _padded_words(value)
+                start = padded.find(anchor)
+                if start < 0:
+                    continue
+                if following is not None:
+                    if padded.rfind(following) > start:
+                        return name, f"{anchor.strip()} ... {following.strip()}"
+                    continue
+                text, haystack, needle = anchor.strip(), padded, anchor
+            else:
+                text = anchor[1]
+                if text not in value:
+                    continue
+                haystack, needle = value, text
+            if pattern is None:
+                return name, text
+            # Muitas ocorrências: recusa sem pagar uma tentativa da regex por ocorrência
+            count = haystack.count(needle)
+            if count > cls.MAX_REPEATS:
+                return name, f"{text} x{count}"
+            match = pattern.search(value)
+            if match:
+                return name, match.group()
+        return None
+
+    def __call__(self, scope) -> Optional[Tuple[int, dict]]:
+        query_string = scope.get("query_string")
+        if not query_string:
+            return None
+        rules = self._rules_for(scope["path"])
+        if rules is None:
+            return None
+        if len(query_string) > self.max_query_bytes:
             log_security_event(
                 logger=logger,
-                event_type="request_timeout",
-                description=f"Request exceeded {self.timeout_seconds}s timeout",
+                event_type="query_string_too_long",
+                description=f"Query string of {len(query_string)} bytes exceeds {self.max_query_bytes} on {scope['path']}",
                 severity="WARNING",
-                ip_address=request.client.host
+                ip_address=_client_ip(scope)
             )
-            
-            return JSONResponse(
-                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-                content={"detail": "Request timeout"}
+            return status.HTTP_414_REQUEST_URI_TOO_LONG, {"detail": "Query string too long"}
+        words, literals, gates, checks = rules
+
+        # latin-1: todo byte vira um caractere (sem erro de decodificação, nada escapa da verificação).
+        # Decodifica uma vez só: com %XX, o parse vem antes e o pré-filtro usa os valores
+        # (separados por um caractere fora de palavras e trechos); sem, a query inteira
+        # serve (nomes, "=" e "&" só podem sobrar âncoras a mais) e o parse fica para depois
+        query = query_string.decode("latin-1")
+        params = parse_qsl(query, keep_blank_values=True, encoding="latin-1") if "%" in query else None
+        text = ("\0".join(value for _, value in params) if params is not None else query.replace("+", " ")).lower()
+        words, literals = self._anchors(words, literals, gates, text, _padded_words(text))
+        if not words and not literals:
+            return None
+
+        found_anchors = set(words).union(literals)
+        checks = [check for check in checks if check[1] in found_anchors]
+        if params is None:
+            params = parse_qsl(query, keep_blank_values=True, encoding="latin-1")
+        for key, value in params:
+            found = self._match(checks, value)
+            if found:
+                name, fragment = found
+                log_security_event(
+                    logger=logger,
+                    event_type="sql_injection_attempt",
+                    description=f"Suspicious pattern '{fragment[:64]}' ({name}) in parameter '{key}'",
+                    severity="ERROR",
+                    ip_address=_client_ip(scope)
+                )
+                return status.HTTP_400_BAD_REQUEST, {"detail": "Invalid request parameters"}
+        return None
+
+
+class SecurityPipelineMiddleware:
+    """
+    Pipeline de segurança e logging em ASGI puro (um único middleware)
+
+    Para cada requisição HTTP, em ordem:
+    1. Guards (IP, tamanho, SQL injection, ...): callables guard(scope) que
+       retornam None ou (status, corpo JSON) para rejeitar na hora; um guard
+       com wrap_receive(scope, receive) também vê o corpo em streaming
+    2. Timeout até o início da resposta (504 se estourar). O prazo também
+       vale no banco (src/deadlines.py): limite por statement pelo tempo
+       restante e KILL QUERY nas queries em andamento quando estoura
+    3. Headers de segurança pré-computados (e remoção do header Server)
+    4. Um único log de acesso com a duração (um só timer), queries e tempo
+       de banco (src/query_collector.py), amostrado por rota/empresa
+       (AccessLogSampler em src/logger.py)
+    5. Com metrics=True, a mesma duração no histograma do /metrics e o
+       gauge de requisições em andamento (src/metrics.py)
+    6. Com server_timing=True, fases da requisição no header Server-Timing
+       para quem pode vê-lo (src/server_timing.py)
+
+    Não bufferiza a resposta: streaming passa direto.
+    """
+
+    SECURITY_HEADERS = [
+        (b"x-content-type-options", b"nosniff"),
+        (b"x-frame-options", b"DENY"),
+        (b"x-xss-protection", b"1; mode=block"),
+        (b"strict-transport-security", b"max-age=31536000; includeSubDomains"),
+        (b"referrer-policy", b"strict-origin-when-cross-origin"),
+        (b"permissions-policy", b"geolocation=(), microphone=(), camera=()"),
+    ]
+    _REPLACED = frozenset(name for name, _ in SECURITY_HEADERS) | {b"server"}
+
+    def __init__(self, app, guards: Optional[List[Callable]] = None, timeout_seconds: float = 30,
+                 metrics: bool = False, server_timing: bool = False):
+        self.app = app
+        self.guards = list(guards) if guards is not None else [RequestSizeLimitGuard(), SQLInjectionGuard()]
+        self.timeout_seconds = timeout_seconds
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start_time = time.perf_counter()
+        method = scope["method"]
+        path = scope["path"]
+        status_code = 500
+        response_started = False
+        timeout = None
+        deadline, deadline_token = begin_request_deadline(self.timeout_seconds)
+        queries, queries_token = query_collector.begin_query_collector()
+        if self.metrics:
+            metrics.request_started()
+        timing = timing_token = None
+        if self.server_timing:
+            timing, timing_token = server_timing.begin_server_timing()
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                status_code = message["status"]
+                headers = [h for h in message.get("headers", ()) if h[0].lower() not in self._REPLACED]
+                headers.extend(self.SECURITY_HEADERS)
+                if timing is not None and server_timing.wants_header(scope, scope.get("state", {}).get("auth")):
+                    total_ms = (time.perf_counter() - start_time) * 1000
+                    headers.append((b"server-timing", timing.header(queries.count, queries.time_ms, total_ms)))
+                message["headers"] = headers
+                # Resposta começou: o timeout não vale para o corpo (streaming)
+                if timeout is not None:
+                    timeout.reschedule(None)
+                    deadline.disarm()
+            await send(message)
+
+        try:
+            for guard in self.guards:
+                rejection = guard(scope)
+                if rejection is not None:
+                    await self._send_json(send_wrapper, *rejection)
+                    return
+                # Guards que inspecionam o corpo conforme ele chega
+                wrap_receive = getattr(guard, "wrap_receive", None)
+                if wrap_receive is not None:
+                    receive = wrap_receive(scope, receive)
+
+            try:
+                async with asyncio.timeout(self.timeout_seconds) as timeout:
+                    await self.app(scope, receive, send_wrapper)
+                timeout = None
+            except TimeoutError:
+                # TimeoutError da própria rota (socket, cliente HTTP) não é o
+                # prazo da requisição: só vira 504 se o prazo expirou de fato
+                if timeout is None or not timeout.expired():
+                    raise
+                timeout = None
+                deadline.cancel()
+                log_security_event(
+                    logger=logger,
+                    event_type="request_timeout",
+                    description=f"Request exceeded {self.timeout_seconds}s timeout",
+                    severity="WARNING",
+                    ip_address=_client_ip(scope)
+                )
+                if response_started:
+                    raise
+                await self._send_json(send_wrapper, status.HTTP_504_GATEWAY_TIMEOUT, {"detail": "Request timeout"})
+
+        except RequestBodyTooLarge as e:
+            # Corpo lido fora do tratamento do FastAPI (ex.: middleware interno)
+            if response_started:
+                raise
+            await self._send_json(send_wrapper, e.status_code, {"detail": e.detail})
+
+        except Exception as e:
+            logger.error(
+                f"Request failed: {method} {path}",
+                extra={
+                    "error": str(e),
+                    "duration_ms": (time.perf_counter() - start_time) * 1000,
+                    "event_type": "request_error"
+                }
             )
+            raise
+        finally:
+            end_request_deadline(deadline_token)
+            query_collector.end_query_collector(queries_token)
+            if timing_token is not None:
+                server_timing.end_server_timing(timing_token)
+            if self.metrics:
+                metrics.request_finished()
+
+        duration = time.perf_counter() - start_time
+        auth = scope.get("state", {}).get("auth")
+        tenant = auth.empresa if auth is not None else None
+        route = scope.get("route")
+        route_path = route.path if route is not None else "<unmatched>"
+        if self.metrics:
+            metrics.observe_request(route_path, method, status_code, tenant, duration)
+        log_request(
+            logger=logger,
+            method=method,
+            path=path,
+            status_code=status_code,
+            duration_ms=duration * 1000,
+            user_id=auth.payload.get("id_funcionario") if auth is not None and auth.payload else None,
+            route=route_path,
+            tenant=tenant,
+            db_queries=queries.count,
+            db_time_ms=queries.time_ms,
+            flags=query_collector.report(queries, method, path, route_path)
+        )
+
+    @staticmethod
+    async def _send_json(send, status_code: int, content: dict):
+        body = json.dumps(content).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class CompressionMiddleware:
+    """
+    Compressão das respostas negociada pelo Accept-Encoding, em ASGI puro
+
+    - brotli (se instalado) ou gzip; corpos abaixo de minimum_size vão sem
+      compressão, assim como tipos não textuais, respostas já codificadas,
+      parciais (206 / Content-Range) e Cache-Control: no-transform
+    - corpos (ou chunks) a partir de threadpool_min_size são comprimidos no
+      threadpool, fora do event loop
+    - streaming: cada chunk é comprimido e enviado com flush (sem bufferizar)
+    - taxa e CPU por rota em self.stats (exposto no /health)
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, threadpool_min_size: int = 65536,
+                 gzip_level: int = 6, brotli_quality: int = 4, stats: Optional[CompressionStats] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_min_size = threadpool_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.stats = stats if stats is not None else CompressionStats()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept_encoding = _header(scope, b"accept-encoding")
+        encoding = negotiate(accept_encoding.decode("latin-1")) if accept_encoding else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        encoder = None
+        passthrough = False
+        offloaded = False
+        chunks = raw_bytes = compressed_bytes = 0
+
+        async def compress(data: bytes, final: bool) -> bytes:
+            nonlocal offloaded
+            if len(data) >= self.threadpool_min_size:
+                offloaded = True
+                return await run_in_threadpool(encoder.compress, data, final)
+            return encoder.compress(data, final)
+
+        async def send_wrapper(message):
+            nonlocal start_message, encoder, passthrough, chunks, raw_bytes, compressed_bytes
+            if message["type"] == "http.response.start":
+                # Segura o início até ver o primeiro chunk do corpo
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                reason = self._skip_reason(start_message, body, more_body)
+                if reason is not None:
+                    passthrough = True
+                    self.stats.skip(reason)
+                    await send(start_message)
+                    return await send(message)
+                encoder = Encoder(encoding, self.gzip_level, self.brotli_quality)
+                out = await compress(body, not more_body)
+                headers = self._compressed_headers(start_message.get("headers", ()), encoding)
+                if not more_body:
+                    headers.append((b"content-length", str(len(out)).encode()))
+                start_message["headers"] = headers
+                await send(start_message)
+            else:
+                out = await compress(body, not more_body)
+
+            chunks += 1
+            raw_bytes += len(body)
+            compressed_bytes += len(out)
+            if not more_body:
+                route = scope.get("route")
+                self.stats.record(
+                    route.path if route is not None else "<unmatched>", encoding, raw_bytes,
+                    compressed_bytes, encoder.cpu_seconds, offloaded, streamed=chunks > 1,
+                )
+            await send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _skip_reason(self, start_message, body: bytes, more_body: bool) -> Optional[str]:
+        status_code = start_message["status"]
+        if status_code < 200 or status_code in (204, 304):
+            return "status"
+        if status_code == 206:
+            return "partial"
+        content_type = b""
+        for name, value in start_message.get("headers", ()):
+            name = name.lower()
+            if name == b"content-encoding":
+                return "encoded"
+            if name == b"content-range":
+                # Faixa de bytes da representação sem compressão: comprimir
+                # invalidaria os offsets que o cliente usa para juntar as partes
+                return "partial"
+            if name == b"content-type":
+                content_type = value
+            elif name == b"cache-control" and b"no-transform" in value.lower():
+                return "no_transform"
+        if not is_compressible(content_type.decode("latin-1")):
+            return "content_type"
+        if not more_body and len(body) < self.minimum_size:
+            return "small"
+        return None
+
+    @staticmethod
+    def _compressed_headers(headers, encoding: str) -> list:
+        result = []
+        vary = None
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == b"content-length":
+                continue
+            if lowered == b"vary":
+                vary = value
+                continue
+            if lowered == b"etag" and value.startswith(b'"'):
+                # ETag forte identifica a representação: a comprimida ganha sufixo
+                value = value[:-1] + b"-" + encoding.encode() + b'"'
+            result.append((name, value))
+        if vary is None:
+            vary = b"Accept-Encoding"
+        elif b"accept-encoding" not in vary.lower():
+            vary += b", Accept-Encoding"
+        result.append((b"vary", vary))
+        result.append((b"content-encoding", encoding.encode()))
+        return result
+
+
+class IPWhitelistMiddleware:
+    """
+    Middleware para whitelist de IPs (opcional), em ASGI puro
+    Útil para endpoints administrativos. Aceita IPs e CIDRs IPv4/IPv6.
+    Na aplicação principal o mesmo filtro roda como IPFilterGuard na
+    SecurityPipelineMiddleware (configurado por IP_ALLOWLIST etc.).
+    """
+
+    def __init__(self, app, allowed_ips: list = None, denied_ips: list = None,
+                 path_rules: Dict[str, dict] = None, trusted_proxies: list = None):
+        self.app = app
+        self.guard = IPFilterGuard(IPFilter(
+            IPRuleSet(allow=allowed_ips or [], deny=denied_ips or []),
+            path_rules={prefix: IPRuleSet(**rules) for prefix, rules in (path_rules or {}).items()},
+            trusted_proxies=trusted_proxies or [],
+        ))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            rejection = self.guard(scope)
+            if rejection is not None:
+                return await SecurityPipelineMiddleware._send_json(send, *rejection)
+        await self.app(scope, receive, send)
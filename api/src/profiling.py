@@ -0,0 +1,273 @@
+"""
+Profiler por amostragem sob demanda (requisições escolhidas pelo admin global)
+
+1. O admin global (is_superadmin) gera o header em POST /admin/profiling/token
+   (HMAC com a SECRET_KEY, empresa + login do admin e validade)
+2. Requisições do mesmo admin com X-Profile: <valor> rodam com um sampler:
+   uma thread que a cada PROFILING_INTERVAL_MS registra a pilha Python da
+   requisição
+   - rodando no event loop: pilha da thread do loop
+   - suspensa (await em socket do banco, lock, ...): cadeia de cr_await da
+     task, terminando em "<aguardando X>"
+   - rota sync na threadpool: pilha da thread que a executa
+3. Resultado em collapsed stacks (flamegraph.pl, speedscope, inferno) em
+   PROFILING_DIR, com no máximo PROFILING_MAX_FILES perfis (os mais antigos
+   são apagados); a resposta traz X-Profile-Id
+4. GET /admin/profiles lista, GET /admin/profiles/{id} baixa
+
+Sem o header, o custo é uma busca no header e um ContextVar.get por rota sync.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from src.config import get_settings
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+settings = get_settings()
+
+HEADER = "X-Profile"
+_PROFILE_ID = re.compile(r"^\d{8}T\d{9}-[0-9a-f]{8}$")  # Ordem lexicográfica = cronológica (ms)
+
+
+# ==================== Header assinado ====================
+
+def _signature(user: dict, expires: int) -> str:
+    # Empresa + login: o mesmo login em outra empresa não reaproveita o header
+    message = f"profile:{user.get('empresa_id')}:{user.get('empresa_nome')}:{user.get('login')}:{expires}".encode()
+    return hmac.new(settings.secret_key.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def issue_token(user: dict) -> dict:
+    """Valor do header X-Profile para o admin, válido por PROFILING_TOKEN_TTL segundos"""
+    expires = int(time.time()) + settings.profiling_token_ttl
+    return {
+        "header": HEADER,
+        "value": f"{expires}.{_signature(user, expires)}",
+        "expires_at": datetime.fromtimestamp(expires, timezone.utc).isoformat(),
+    }
+
+
+def verify_token(value: str, user: Optional[dict]) -> bool:
+    """Header válido, no prazo e emitido para este usuário (que precisa ser admin global)"""
+    expires, _, signature = value.partition(".")
+    if not user or not user.get("is_superadmin") or not user.get("login"):
+        return False
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _signature(user, int(expires)))
+
+
+# ==================== Pilhas ====================
+
+def _label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # Caminho curto: a partir de src/ ou site-packages/
+    for marker in ("/src/", "/site-packages/"):
+        index = filename.rfind(marker)
+        if index >= 0:
+            filename = filename[index + len(marker):]
+            break
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _thread_stack(frame, root) -> list:
+    """Pilha da raiz (root, se estiver nela) até a folha"""
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame))
+        if frame is root:
+            break
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _awaiting_stack(coro, root) -> list:
+    """Cadeia de awaits da task suspensa, a partir do frame root"""
+    stack = []
+    started = False
+    obj = coro
+    while obj is not None:
+        frame = getattr(obj, "cr_frame", None) or getattr(obj, "gi_frame", None) or getattr(obj, "ag_frame", None)
+        if frame is None:
+            stack.append(f"<aguardando {type(obj).__name__}>")
+            break
+        started = started or frame is root
+        if started:
+            stack.append(_label(frame))
+        obj = getattr(obj, "cr_await", None) or getattr(obj, "gi_yieldfrom", None) or getattr(obj, "ag_await", None)
+    return stack if started else []
+
+
+class ProfileSession:
+    """Amostragem de uma requisição (thread própria, parada no fim dela)"""
+
+    def __init__(self, profile_id: str, root_frame):
+        self.id = profile_id
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.root = root_frame
+        self.threads = {}  # ident -> frame da rota sync na threadpool
+        self.samples = Counter()
+        self.interval = settings.profiling_interval_ms / 1000
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.token = None  # ContextVar (begin_profile/end_profile)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{profile_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        deadline = time.monotonic() + settings.profiling_max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            try:
+                self._sample()
+            except Exception:  # Pilha mudou durante a leitura: descarta a amostra
+                pass
+
+    def _sample(self):
+        frames = sys._current_frames()
+        if self.threads:
+            for ident, root in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[";".join(["<threadpool>"] + _thread_stack(frame, root))] += 1
+            return
+        coro = self.task.get_coro()
+        if asyncio.current_task(self.loop) is self.task:
+            stack = _thread_stack(frames.get(self.loop_thread), self.root)
+        else:
+            stack = _awaiting_stack(coro, self.root)
+        if stack:
+            self.samples[";".join(stack)] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+_SESSION: ContextVar[Optional[ProfileSession]] = ContextVar("profile_session", default=None)
+_active = {"sessions": 0}
+_active_lock = threading.Lock()
+
+
+def begin_profile(root_frame) -> Optional[ProfileSession]:
+    """Inicia o sampler da requisição atual (None se já houver perfis demais rodando)"""
+    with _active_lock:
+        if _active["sessions"] >= settings.profiling_max_concurrent:
+            return None
+        _active["sessions"] += 1
+    now = datetime.now(timezone.utc)
+    profile_id = f"{now:%Y%m%dT%H%M%S}{now.microsecond // 1000:03d}-{secrets.token_hex(4)}"
+    session = ProfileSession(profile_id, root_frame)
+    session.token = _SESSION.set(session)
+    session.start()
+    return session
+
+
+def end_profile(session: ProfileSession):
+    session.stop()
+    _SESSION.reset(session.token)
+    with _active_lock:
+        _active["sessions"] -= 1
+
+
+def attach_thread(frame):
+    """Rota sync começando na threadpool: passa a amostrar esta thread. Retorna o token"""
+    session = _SESSION.get()
+    if session is None:
+        return None
+    ident = threading.get_ident()
+    session.threads[ident] = frame
+    return session, ident
+
+
+def detach_thread(token):
+    if token is not None:
+        session, ident = token
+        session.threads.pop(ident, None)
+
+
+# ==================== Armazenamento ====================
+
+class ProfileStore:
+    """Diretório local com no máximo max_files perfis (.folded + .json de metadados)"""
+
+    def __init__(self, directory: str, max_files: int):
+        self.directory = directory
+        self.max_files = max_files
+
+    def save(self, session: ProfileSession, meta: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {
+            **meta,
+            "id": session.id,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(session.duration * 1000, 2),
+            "samples": sum(session.samples.values()),
+            "interval_ms": settings.profiling_interval_ms,
+        }
+        base = os.path.join(self.directory, session.id)
+        with open(base + ".folded", "w", encoding="utf-8") as f:
+            f.write(session.collapsed())
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        self._prune()
+        return meta
+
+    def _ids(self) -> list:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json") and _PROFILE_ID.match(name[:-5]))
+
+    def _prune(self):
+        ids = self._ids()
+        for profile_id in ids[:max(len(ids) - self.max_files, 0)]:
+            for extension in (".folded", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> list:
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            try:
+                with open(os.path.join(self.directory, profile_id + ".json"), encoding="utf-8") as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def path(self, profile_id: str) -> Optional[str]:
+        """Caminho do .folded (None se o id for inválido ou não existir)"""
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.join(self.directory, profile_id + ".folded")
+        return path if os.path.isfile(path) else None
+
+
+store = ProfileStore(settings.profiling_dir, settings.profiling_max_files)
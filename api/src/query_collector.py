@@ -0,0 +1,149 @@
+"""
+Instrumentação das queries por requisição (eventos de cursor do SQLAlchemy)
+
+O SecurityPipelineMiddleware abre um QueryCollector por requisição. Cada
+statement executado dentro dela (engines sync e async de todas as empresas)
+registra texto normalizado, duração e rowcount:
+- statement acima de DB_SLOW_QUERY_MS: log_database_query na hora
+- mesmo statement normalizado mais de DB_REPEATED_QUERY_THRESHOLD vezes
+  (padrão N+1) ou mais de DB_QUERY_BUDGET statements na requisição:
+  a requisição é marcada e um aviso é logado no fim dela
+- total de queries e tempo de banco vão para o log de acesso
+
+Normalização: literais viram "?", listas IN viram "(?...)", espaços
+colapsados e o prefixo de limite de tempo (src/deadlines.py) removido.
+"""
+import re
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+from src.config import get_settings
+from src.logger import setup_logger, log_database_query
+
+logger = setup_logger(__name__)
+settings = get_settings()
+
+_LITERALS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|:\w+|\?")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize_statement(statement: str) -> str:
+    normalized = _LITERALS.sub("?", statement)
+    normalized = _IN_LISTS.sub("(?...)", normalized)
+    return _SPACES.sub(" ", normalized).strip()
+
+
+class QueryCollector:
+    """Statements de uma requisição: totais e repetições por texto normalizado"""
+
+    __slots__ = ("count", "time_ms", "slow", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.time_ms = 0.0
+        self.slow = 0
+        self.statements: Dict[str, List] = {}  # normalizado -> [vezes, ms, linhas]
+
+    def record(self, statement: str, duration_ms: float, rowcount: int):
+        self.count += 1
+        self.time_ms += duration_ms
+        normalized = normalize_statement(statement)
+        entry = self.statements.get(normalized)
+        if entry is None:
+            self.statements[normalized] = [1, duration_ms, max(rowcount, 0)]
+        else:
+            entry[0] += 1
+            entry[1] += duration_ms
+            entry[2] += max(rowcount, 0)
+
+    def repeated(self) -> List[dict]:
+        """Statements acima do limite de repetição (suspeitas de N+1)"""
+        threshold = settings.db_repeated_query_threshold
+        return [
+            {"statement": normalized, "count": count, "time_ms": round(ms, 2), "rows": rows}
+            for normalized, (count, ms, rows) in self.statements.items()
+            if count > threshold
+        ]
+
+    def flags(self) -> List[str]:
+        flags = []
+        if self.count > settings.db_query_budget:
+            flags.append("query_budget")
+        if any(entry[0] > settings.db_repeated_query_threshold for entry in self.statements.values()):
+            flags.append("n_plus_one")
+        return flags
+
+
+_REQUEST_COLLECTOR: ContextVar[Optional[QueryCollector]] = ContextVar("query_collector", default=None)
+
+
+def begin_query_collector():
+    """Abre o coletor da requisição. Retorna (coletor, token para end_query_collector)"""
+    collector = QueryCollector()
+    return collector, _REQUEST_COLLECTOR.set(collector)
+
+
+def end_query_collector(token):
+    _REQUEST_COLLECTOR.reset(token)
+
+
+def report(collector: QueryCollector, method: str, path: str, route: Optional[str]) -> List[str]:
+    """Loga o aviso de N+1/orçamento estourado. Retorna as marcas da requisição"""
+    flags = collector.flags()
+    if flags:
+        logger.warning(
+            f"Excesso de queries: {method} {path}",
+            extra={
+                "http_route": route,
+                "db_queries": collector.count,
+                "db_time_ms": round(collector.time_ms, 2),
+                "query_flags": flags,
+                "repeated_statements": collector.repeated(),
+                "event_type": "db_query_flagged",
+            }
+        )
+    return flags
+
+
+# ==================== Eventos da engine ====================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collector = _REQUEST_COLLECTOR.get()
+    if collector is not None and context is not None:
+        # Texto antes do prefixo de limite de tempo (listener instalado antes do de deadlines)
+        context._query_collector = (collector, statement, time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracked = getattr(context, "_query_collector", None)
+    if tracked is None:
+        return
+    collector, original, start = tracked
+    context._query_collector = None
+    duration_ms = (time.perf_counter() - start) * 1000
+    rowcount = cursor.rowcount if cursor is not None else -1
+    collector.record(original, duration_ms, rowcount)
+    if duration_ms >= settings.db_slow_query_ms:
+        collector.slow += 1
+        log_database_query(logger, original, duration_ms, rowcount)
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        _after_cursor_execute(None, None, None, None, context, False)
+
+
+def install(engine):
+    """Liga a coleta aos statements da engine (sync; para AsyncEngine,
+    passar engine.sync_engine). Instalar antes de deadlines.install.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
@@ -0,0 +1,240 @@
+"""
+Roteamento de leituras para réplicas de leitura (por empresa)
+"""
+import itertools
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, text
+
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class _ReplicaState:
+    """Último resultado do health check de uma réplica"""
+
+    __slots__ = ("healthy", "lag", "latency_ms", "checked_at", "checking", "error")
+
+    def __init__(self):
+        self.healthy: Optional[bool] = None  # None = ainda não verificada
+        self.lag: Optional[float] = None      # Segundos de atraso (None = desconhecido)
+        self.latency_ms: float = 0.0
+        self.checked_at: float = 0.0
+        self.checking = False
+        self.error: Optional[str] = None
+
+
+class NotAReplicaError(RuntimeError):
+    """A URL de réplica responde, mas o servidor não replica de ninguém"""
+
+
+class ReplicaRouter:
+    """
+    Escolhe uma réplica saudável para requisições somente leitura.
+
+    - Health check (SELECT 1 + atraso de replicação) em background, no máximo
+      a cada `check_interval` segundos por réplica; a requisição nunca espera
+    - Réplicas com atraso acima de `max_lag` ou com falha ficam de fora;
+      queda de conexão numa requisição (handle_error da engine) também tira
+      a réplica até o próximo health check. Servidor sem replicação
+      configurada também fica de fora (URL de réplica apontando para um
+      primário)
+    - Política "round_robin" ou "least_latency"
+    - Read-your-writes: após uma escrita, o mesmo usuário lê do primário
+      por `sticky_seconds`
+    - Sem réplica elegível (ou ainda não verificada): usa o primário
+    """
+
+    MAX_TRACKED_WRITES = 10000
+
+    def __init__(self, engine_getter: Callable, policy: str = "round_robin",
+                 max_lag: float = 5, check_interval: float = 10, sticky_seconds: float = 5):
+        self._engine_getter = engine_getter
+        self.policy = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.sticky_seconds = sticky_seconds
+        self._states: Dict[str, _ReplicaState] = {}
+        self._recent_writes: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="replica-check")
+        self._watched = weakref.WeakSet()  # Engines de réplica com o listener de erro
+        self.routed = 0
+        self.fallbacks = 0
+        self.sticky_reads = 0
+
+    # ==================== Read-your-writes ====================
+
+    def record_write(self, empresa: str, user: Optional[str]):
+        """Marca escrita do usuário: próximas leituras vão ao primário"""
+        if not user:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[(empresa, user)] = now
+            if len(self._recent_writes) > self.MAX_TRACKED_WRITES:
+                cutoff = now - self.sticky_seconds
+                self._recent_writes = {k: t for k, t in self._recent_writes.items() if t >= cutoff}
+
+    def is_sticky(self, empresa: str, user: Optional[str]) -> bool:
+        if not user:
+            return False
+        written_at = self._recent_writes.get((empresa, user))
+        if written_at is None:
+            return False
+        if time.monotonic() - written_at < self.sticky_seconds:
+            self.sticky_reads += 1
+            return True
+        return False
+
+    # ==================== Seleção ====================
+
+    def choose(self, replicas: List[tuple]) -> Optional[tuple]:
+        """Escolhe uma réplica entre tuplas (chave, url, ...). None = usar primário"""
+        now = time.monotonic()
+        candidates = []
+        for replica in replicas:
+            key, url = replica[0], replica[1]
+            state = self._state(key)
+            if now - state.checked_at >= self.check_interval:
+                self._schedule_check(key, url, state)
+            if state.healthy and (state.lag is None or state.lag <= self.max_lag):
+                candidates.append((replica, state))
+
+        if not candidates:
+            self.fallbacks += 1
+            return None
+
+        self.routed += 1
+        if self.policy == "least_latency":
+            return min(candidates, key=lambda c: c[1].latency_ms)[0]
+        return candidates[next(self._rr) % len(candidates)][0]
+
+    def mark_unhealthy(self, key: str, error: str):
+        """Tira a réplica de rotação até o próximo health check bem-sucedido"""
+        state = self._state(key)
+        if state.healthy is not False:
+            logger.warning("Réplica com falha de conexão, leituras vão ao primário",
+                           extra={"replica": key, "error": error})
+        state.healthy = False
+        state.error = error
+
+    def watch(self, key: str, engine):
+        """Escuta os erros da engine (sync) da réplica: queda ou falha ao conectar
+        tira a réplica de rotação. Uma vez por engine (o registro pode recriá-la)
+        """
+        if engine in self._watched:
+            return
+        with self._lock:
+            if engine in self._watched:
+                return
+            self._watched.add(engine)
+
+        def _on_error(context):
+            # Pre-ping que falha é refeito pelo pool com outra conexão
+            if context.is_pre_ping:
+                return
+            if context.is_disconnect or context.connection is None:
+                self.mark_unhealthy(key, str(context.original_exception))
+
+        event.listen(engine, "handle_error", _on_error)
+
+    def _state(self, key: str) -> _ReplicaState:
+        state = self._states.get(key)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(key, _ReplicaState())
+        return state
+
+    # ==================== Health check ====================
+
+    def _schedule_check(self, key: str, url: str, state: _ReplicaState):
+        with self._lock:
+            if state.checking:
+                return
+            state.checking = True
+        try:
+            self._executor.submit(self._check, key, url, state)
+        except RuntimeError:
+            # Executor encerrado (shutdown)
+            state.checking = False
+
+    def _check(self, key: str, url: str, state: _ReplicaState):
+        start = time.perf_counter()
+        try:
+            engine = self._engine_getter(key, url)
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                state.latency_ms = (time.perf_counter() - start) * 1000
+                state.lag = self._replication_lag(conn)
+            state.healthy = True
+            state.error = None
+        except Exception as e:
+            if state.healthy is not False:
+                logger.warning("Réplica indisponível, leituras vão ao primário",
+                               extra={"replica": key, "error": str(e)})
+            state.healthy = False
+            state.error = str(e)
+        finally:
+            state.checked_at = time.monotonic()
+            state.checking = False
+
+    _LAG_COLUMNS = ("Seconds_Behind_Source", "Seconds_Behind_Master")
+
+    @classmethod
+    def _replication_lag(cls, conn) -> Optional[float]:
+        """Atraso da réplica em segundos (MySQL 8 e MariaDB/MySQL antigos).
+        inf = replicação parada; None = sem privilégio para verificar.
+        O MariaDB 10.5+ aceita SHOW REPLICA STATUS mas mantém a coluna
+        Seconds_Behind_Master: vale a que vier na linha.
+        Servidor sem replicação configurada (URL apontando para outro
+        primário ou para um servidor avulso) levanta NotAReplicaError.
+        """
+        for statement in ("SHOW REPLICA STATUS", "SHOW SLAVE STATUS"):
+            try:
+                row = conn.exec_driver_sql(statement).mappings().first()
+            except Exception:
+                continue
+            if row is None:
+                raise NotAReplicaError("Servidor sem replicação configurada")
+            for column in cls._LAG_COLUMNS:
+                if column in row:
+                    value = row[column]
+                    return float(value) if value is not None else float("inf")
+            return None
+        return None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self, detail: bool = False) -> dict:
+        """Contadores e réplicas por situação. Chaves e erros do driver só com
+        detail=True (rotas de admin): o /health é público
+        """
+        states = list(self._states.items())
+        result = {
+            "policy": self.policy,
+            "routed": self.routed,
+            "fallbacks": self.fallbacks,
+            "sticky_reads": self.sticky_reads,
+            "replicas": len(states),
+            "healthy": sum(1 for _, state in states if state.healthy),
+            "unhealthy": sum(1 for _, state in states if state.healthy is False),
+        }
+        if detail:
+            result["states"] = {
+                key: {
+                    "healthy": state.healthy,
+                    "lag": state.lag,
+                    "latency_ms": round(state.latency_ms, 2),
+                    "error": state.error,
+                }
+                for key, state in states
+            }
+        return result
@@ -0,0 +1,97 @@
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import FileResponse
+
+from src import memory, profiling
+from src.auth import require_superadmin
+from src.database import _ASYNC_ENGINES, _ENGINES, _REPLICAS
+from src.server_timing import TimedRoute
+
+router = APIRouter(prefix="/admin", tags=["Administração"], route_class=TimedRoute)
+
+
+@router.post("/profiling/token")
+def gerar_header_profiling(admin: dict = Depends(require_superadmin)):
+    """Header X-Profile para perfilar as próximas requisições deste admin"""
+    return profiling.issue_token(admin)
+
+
+@router.get("/profiles")
+def listar_perfis(admin: dict = Depends(require_superadmin)):
+    """Perfis salvos (mais recentes primeiro)"""
+    return profiling.store.list()
+
+
+@router.get("/profiles/{profile_id}")
+def baixar_perfil(profile_id: str, admin: dict = Depends(require_superadmin)):
+    """Collapsed stacks do perfil (flamegraph.pl, speedscope, inferno)"""
+    path = profiling.store.path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Perfil não encontrado")
+    return FileResponse(path, media_type="text/plain", filename=f"{profile_id}.folded")
+
+
+# ==================== Engines ====================
+
+@router.get("/engines")
+def detalhar_engines(admin: dict = Depends(require_superadmin)):
+    """Registro de engines deste worker com o tamanho do pool por empresa/servidor
+    e a situação de cada réplica (com o último erro)
+    """
+    return {
+        "pid": os.getpid(),
+        "sync": _ENGINES.stats(detail=True),
+        "async": _ASYNC_ENGINES.stats(detail=True),
+        "replicas": _REPLICAS.stats(detail=True),
+    }
+
+
+# ==================== Memória ====================
+
+@router.get("/memory")
+def relatorio_memoria(objects: bool = False, admin: dict = Depends(require_superadmin)):
+    """RSS, gc, caches e registros deste worker; objects=true conta objetos vivos por tipo (lento)"""
+    return memory.report(objects)
+
+
+@router.post("/memory/tracemalloc/start")
+def ligar_tracemalloc(frames: int = Query(None, ge=1, le=100), admin: dict = Depends(require_superadmin)):
+    """Liga o tracemalloc no worker que atender a chamada (ver "pid")"""
+    return memory.start(frames)
+
+
+@router.post("/memory/tracemalloc/stop")
+def desligar_tracemalloc(admin: dict = Depends(require_superadmin)):
+    return memory.stop()
+
+
+@router.post("/memory/snapshots")
+def criar_snapshot(limit: int = Query(10, ge=1, le=100), admin: dict = Depends(require_superadmin)):
+    """Snapshot do tracemalloc deste worker, com as maiores alocações por linha"""
+    meta = memory.take_snapshot(limit)
+    if meta is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="tracemalloc desligado neste worker")
+    return meta
+
+
+@router.get("/memory/snapshots")
+def listar_snapshots(admin: dict = Depends(require_superadmin)):
+    return memory.store.list()
+
+
+@router.get("/memory/diff")
+def comparar_snapshots(
+    old: str,
+    new: str,
+    group_by: str = Query("lineno", pattern="^(lineno|filename|traceback)$"),
+    limit: int = Query(25, ge=1, le=200),
+    admin: dict = Depends(require_superadmin),
+):
+    """Maiores crescimentos de memória entre dois snapshots do mesmo worker"""
+    try:
+        return memory.diff(old, new, group_by, limit)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Snapshot não encontrado: {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
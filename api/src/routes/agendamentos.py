@@ -6,8 +6,9 @@ from typing import List
 from src.database import get_db
 from src.schemas import AgendamentoCreate, Agendamento
 from src.routes.auth import get_current_user_id
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/agendamentos", tags=["Agendamentos"])
+router = APIRouter(prefix="/agendamentos", tags=["Agendamentos"], route_class=TimedRoute)
 
 @router.post("", response_model=dict, status_code=status.HTTP_201_CREATED)
 def criar_agendamento(agendamento: AgendamentoCreate, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
@@ -1,26 +1,29 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta, datetime, timezone
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-from src.database import get_db
-from src.auth import verify_password, create_access_token, get_current_user as get_user_from_token
+from src.database import get_db_async
+from src.auth import verify_password_async, create_access_token, get_current_user as get_user_from_token
 from src.schemas import Token, UserResponse
 from src.config import get_settings
 from src.logger import setup_logger, log_security_event
+from src.server_timing import TimedRoute
 from sqlalchemy import text
 
-router = APIRouter(prefix="/auth", tags=["Autenticação"])
+router = APIRouter(prefix="/auth", tags=["Autenticação"], route_class=TimedRoute)
 settings = get_settings()
 logger = setup_logger(__name__)
 limiter = Limiter(key_func=get_remote_address)
 
 @router.post("/login", response_model=Token)
 @limiter.limit("5/minute")  # Máximo 5 tentativas de login por minuto
-def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    """Login com credenciais do funcionário - Rate limited para prevenir força bruta"""
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db_async)):
+    """Login com credenciais do funcionário - Rate limited para prevenir força bruta
+    O bcrypt roda em pool dedicado (não ocupa o threadpool das rotas sync).
+    """
     # Determinar empresa pelo header X-Empresa (padrão: default)
     empresa_code = request.headers.get("X-Empresa") or request.headers.get("x-empresa") or "default"
     client_ip = request.client.host
@@ -31,7 +34,7 @@ def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db
         FROM funcionarios f
         WHERE f.login = :login AND f.ativo = TRUE
     """)
-    result = db.execute(query, {"login": form_data.username}).fetchone()
+    result = (await db.execute(query, {"login": form_data.username})).fetchone()
     
     if not result:
         # Loga tentativa de login falhada
@@ -50,7 +53,7 @@ def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db
         )
     
     # Verifica senha (assumindo que está em hash bcrypt no banco)
-    if not verify_password(form_data.password, result[2]):  # result.senha
+    if not await verify_password_async(form_data.password, result[2]):  # result.senha
         # Loga tentativa de senha incorreta
         log_security_event(
             logger=logger,
@@ -1,15 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Header
+from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from typing import List
 from datetime import datetime, timedelta
 
-from src.database import get_db, get_db_by_empresa
+from src.database import get_db, get_db_async
 from src.schemas import Cliente, ClienteCreate, ClienteUpdate, Pet, ClientePacoteCreate, ClientePacoteDetalhado
 from src.routes.auth import get_current_user_id
 from src.auth import get_current_user
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/clientes", tags=["Clientes"])
+router = APIRouter(prefix="/clientes", tags=["Clientes"], route_class=TimedRoute)
 
 @router.get("", response_model=List[Cliente])
 def listar_clientes(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
@@ -139,19 +141,17 @@ async def comprar_pacote(
     id_cliente: int,
     compra: ClientePacoteCreate,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Registra compra de pacote para um cliente"""
-    db = get_db_by_empresa(x_empresa)
-    
     # Verificar se cliente existe
-    check_cliente = db.execute(text("SELECT id_cliente FROM clientes WHERE id_cliente = :id"), {"id": id_cliente})
+    check_cliente = await db.execute(text("SELECT id_cliente FROM clientes WHERE id_cliente = :id"), {"id": id_cliente})
     if not check_cliente.fetchone():
         raise HTTPException(404, "Cliente não encontrado")
     
     # Buscar informações do pacote
     query_pacote = text("SELECT * FROM pacotes WHERE id_pacote = :id AND ativo = TRUE")
-    pacote = db.execute(query_pacote, {"id": compra.id_pacote}).fetchone()
+    pacote = (await db.execute(query_pacote, {"id": compra.id_pacote})).fetchone()
     
     if not pacote:
         raise HTTPException(404, "Pacote não encontrado ou inativo")
@@ -174,7 +174,7 @@ async def comprar_pacote(
         VALUES (:id_cliente, :id_pacote, :data_validade, :usos_restantes, 'ativo', :valor_pago, :observacoes)
     """)
     
-    result = db.execute(query_insert, {
+    result = await db.execute(query_insert, {
         "id_cliente": id_cliente,
         "id_pacote": compra.id_pacote,
         "data_validade": data_validade,
@@ -182,7 +182,7 @@ async def comprar_pacote(
         "valor_pago": valor_pago,
         "observacoes": compra.observacoes
     })
-    db.commit()
+    await db.commit()
     
     id_cliente_pacote = result.lastrowid
     
@@ -198,7 +198,7 @@ async def comprar_pacote(
         WHERE cp.id_cliente_pacote = :id
     """)
     
-    result = db.execute(query_detalhado, {"id": id_cliente_pacote})
+    result = await db.execute(query_detalhado, {"id": id_cliente_pacote})
     row = result.fetchone()
     
     response = dict(row._mapping)
@@ -210,7 +210,7 @@ async def comprar_pacote(
         JOIN servicos s ON ps.id_servico = s.id_servico
         WHERE ps.id_pacote = :id_pacote
     """)
-    servicos_result = db.execute(query_servicos, {"id_pacote": compra.id_pacote})
+    servicos_result = await db.execute(query_servicos, {"id_pacote": compra.id_pacote})
     servicos = [dict(row._mapping) for row in servicos_result.fetchall()]
     
     response['servicos'] = servicos
@@ -223,11 +223,9 @@ async def listar_pacotes_cliente(
     id_cliente: int,
     status: str = None,  # Filtrar por status: ativo, usado, expirado
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Lista todos os pacotes comprados por um cliente"""
-    db = get_db_by_empresa(x_empresa)
-    
     query = """
         SELECT 
             cp.*,
@@ -246,7 +244,7 @@ async def listar_pacotes_cliente(
     
     query += " ORDER BY cp.data_compra DESC"
     
-    result = db.execute(text(query), params)
+    result = await db.execute(text(query), params)
     rows = result.fetchall()
     
     pacotes = []
@@ -260,7 +258,7 @@ async def listar_pacotes_cliente(
             JOIN servicos s ON ps.id_servico = s.id_servico
             WHERE ps.id_pacote = :id_pacote
         """)
-        servicos_result = db.execute(query_servicos, {"id_pacote": pacote_dict['id_pacote']})
+        servicos_result = await db.execute(query_servicos, {"id_pacote": pacote_dict['id_pacote']})
         servicos = [dict(row._mapping) for row in servicos_result.fetchall()]
         
         pacote_dict['servicos'] = servicos
@@ -4,6 +4,7 @@ from sqlalchemy import text
 from pydantic import BaseModel
 
 from src.database import get_db
+from src.server_timing import TimedRoute
 
 class CriarEmpresaRequest(BaseModel):
     nome: str
@@ -12,7 +13,7 @@ class CriarEmpresaRequest(BaseModel):
     endereco: str = None
     cnpj: str = None
 
-router = APIRouter(prefix="/empresas", tags=["empresas"])
+router = APIRouter(prefix="/empresas", tags=["empresas"], route_class=TimedRoute)
 
 @router.post("/criar")
 def criar_empresa(
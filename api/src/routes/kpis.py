@@ -4,8 +4,9 @@ from datetime import datetime, timedelta
 
 from src.database import get_db
 from src.routes.auth import get_current_user_id
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/kpis", tags=["KPIs e Relatórios"])
+router = APIRouter(prefix="/kpis", tags=["KPIs e Relatórios"], route_class=TimedRoute)
 
 @router.get("/dashboard")
 def dashboard(db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
@@ -1,15 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from datetime import datetime, timedelta
-from ..database import get_db_by_empresa
+from ..database import get_db_async
 from ..schemas import (
     PacoteCreate, PacoteUpdate, Pacote, PacoteComServicos,
     ClientePacoteCreate, ClientePacoteUpdate, ClientePacote, ClientePacoteDetalhado
 )
 from ..auth import get_current_user
+from ..catalog import AsyncCatalogETag, bump_catalog_version_async, PACOTES
+from ..server_timing import TimedRoute
 
-router = APIRouter(prefix="/pacotes", tags=["pacotes"])
+router = APIRouter(prefix="/pacotes", tags=["pacotes"], route_class=TimedRoute)
 
 # ==================== CRUD Pacotes ====================
 
@@ -18,11 +21,10 @@ async def listar_pacotes(
     ativo: Optional[bool] = None,
     tipo: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async),
+    _etag: None = Depends(AsyncCatalogETag(PACOTES))
 ):
-    """Lista todos os pacotes com seus serviços incluídos"""
-    db = get_db_by_empresa(x_empresa)
-    
+    """Lista todos os pacotes com seus serviços incluídos (304 se o catálogo não mudou)"""
     query = """
         SELECT 
             p.*,
@@ -51,7 +53,7 @@ async def listar_pacotes(
     
     query += " GROUP BY p.id_pacote ORDER BY p.nome"
     
-    result = db.execute(text(query), params)
+    result = await db.execute(text(query), params)
     rows = result.fetchall()
     
     pacotes = []
@@ -79,11 +81,9 @@ async def listar_pacotes(
 async def criar_pacote(
     pacote: PacoteCreate,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Cria um novo pacote"""
-    db = get_db_by_empresa(x_empresa)
-    
     # Validar tipo e campos obrigatórios
     if pacote.tipo == 'creditos':
         if not pacote.validade_dias or not pacote.max_usos:
@@ -100,7 +100,7 @@ async def criar_pacote(
         VALUES (:nome, :descricao, :tipo, :preco_base, :validade_dias, :max_usos, :ativo)
     """)
     
-    result = db.execute(query, {
+    result = await db.execute(query, {
         "nome": pacote.nome,
         "descricao": pacote.descricao,
         "tipo": pacote.tipo,
@@ -109,7 +109,7 @@ async def criar_pacote(
         "max_usos": pacote.max_usos,
         "ativo": pacote.ativo
     })
-    db.commit()
+    await db.commit()
     id_pacote = result.lastrowid
     
     # Associar serviços
@@ -119,12 +119,13 @@ async def criar_pacote(
                 INSERT INTO pacotes_servicos (id_pacote, id_servico, quantidade)
                 VALUES (:id_pacote, :id_servico, 1)
             """)
-            db.execute(query_servico, {"id_pacote": id_pacote, "id_servico": id_servico})
-        db.commit()
+            await db.execute(query_servico, {"id_pacote": id_pacote, "id_servico": id_servico})
+        await db.commit()
+    await bump_catalog_version_async(db, PACOTES)
     
     # Buscar pacote criado
     query_select = text("SELECT * FROM pacotes WHERE id_pacote = :id")
-    result = db.execute(query_select, {"id": id_pacote})
+    result = await db.execute(query_select, {"id": id_pacote})
     row = result.fetchone()
     
     return dict(row._mapping)
@@ -134,11 +135,9 @@ async def criar_pacote(
 async def obter_pacote(
     id_pacote: int,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Obtém detalhes de um pacote específico"""
-    db = get_db_by_empresa(x_empresa)
-    
     query = text("""
         SELECT p.*, s.id_servico, s.nome as servico_nome, s.preco_base as servico_preco, ps.quantidade
         FROM pacotes p
@@ -147,7 +146,7 @@ async def obter_pacote(
         WHERE p.id_pacote = :id
     """)
     
-    result = db.execute(query, {"id": id_pacote})
+    result = await db.execute(query, {"id": id_pacote})
     rows = result.fetchall()
     
     if not rows:
@@ -180,13 +179,11 @@ async def atualizar_pacote(
     id_pacote: int,
     pacote: PacoteUpdate,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Atualiza um pacote existente"""
-    db = get_db_by_empresa(x_empresa)
-    
     # Verificar se existe
-    check = db.execute(text("SELECT * FROM pacotes WHERE id_pacote = :id"), {"id": id_pacote})
+    check = await db.execute(text("SELECT * FROM pacotes WHERE id_pacote = :id"), {"id": id_pacote})
     if not check.fetchone():
         raise HTTPException(404, "Pacote não encontrado")
     
@@ -220,13 +217,13 @@ async def atualizar_pacote(
     
     if updates:
         query = text(f"UPDATE pacotes SET {', '.join(updates)} WHERE id_pacote = :id")
-        db.execute(query, params)
-        db.commit()
+        await db.execute(query, params)
+        await db.commit()
     
     # Atualizar serviços se fornecido
     if pacote.servicos_ids is not None:
         # Remover associações antigas
-        db.execute(text("DELETE FROM pacotes_servicos WHERE id_pacote = :id"), {"id": id_pacote})
+        await db.execute(text("DELETE FROM pacotes_servicos WHERE id_pacote = :id"), {"id": id_pacote})
         
         # Adicionar novas
         for id_servico in pacote.servicos_ids:
@@ -234,12 +231,13 @@ async def atualizar_pacote(
                 INSERT INTO pacotes_servicos (id_pacote, id_servico, quantidade)
                 VALUES (:id_pacote, :id_servico, 1)
             """)
-            db.execute(query_servico, {"id_pacote": id_pacote, "id_servico": id_servico})
+            await db.execute(query_servico, {"id_pacote": id_pacote, "id_servico": id_servico})
         
-        db.commit()
+        await db.commit()
+    await bump_catalog_version_async(db, PACOTES)
     
     # Retornar atualizado
-    result = db.execute(text("SELECT * FROM pacotes WHERE id_pacote = :id"), {"id": id_pacote})
+    result = await db.execute(text("SELECT * FROM pacotes WHERE id_pacote = :id"), {"id": id_pacote})
     row = result.fetchone()
     
     return dict(row._mapping)
@@ -249,12 +247,10 @@ async def atualizar_pacote(
 async def deletar_pacote(
     id_pacote: int,
     current_user: dict = Depends(get_current_user),
-    x_empresa: str = Header(default="teste")
+    db: AsyncSession = Depends(get_db_async)
 ):
     """Deleta um pacote (soft delete - apenas marca como inativo)"""
-    db = get_db_by_empresa(x_empresa)
-    
-    result = db.execute(
+    result = await db.execute(
         text("UPDATE pacotes SET ativo = FALSE WHERE id_pacote = :id"),
         {"id": id_pacote}
     )
@@ -262,5 +258,6 @@ async def deletar_pacote(
     if result.rowcount == 0:
         raise HTTPException(404, "Pacote não encontrado")
     
-    db.commit()
+    await db.commit()
+    await bump_catalog_version_async(db, PACOTES)
     return None
@@ -8,11 +8,12 @@ import hashlib
 from typing import Optional
 
 from src.database import get_db
-from src.auth import get_current_user, get_password_hash
+from src.auth import get_current_user, get_password_hash_async
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/auth", tags=["Autenticação"])
+router = APIRouter(prefix="/auth", tags=["Autenticação"], route_class=TimedRoute)
 
-router = APIRouter(prefix="/auth", tags=["Autenticação"])
+router = APIRouter(prefix="/auth", tags=["Autenticação"], route_class=TimedRoute)
 
 class ForgotPasswordRequest(BaseModel):
     email: EmailStr
@@ -151,8 +152,8 @@ async def reset_password(
         raise HTTPException(status_code=400, detail="A senha deve conter pelo menos um número")
 
     try:
-        # Gerar hash seguro da senha usando bcrypt
-        hashed_password = get_password_hash(request.new_password)
+        # Gerar hash seguro da senha usando bcrypt (pool dedicado)
+        hashed_password = await get_password_hash_async(request.new_password)
 
         # Atualizar senha do usuário
         db.execute(text("""
@@ -4,10 +4,12 @@ from sqlalchemy import text
 from typing import List
 from pydantic import BaseModel
 
+from src.catalog import CatalogETag, bump_catalog_version, PRODUTOS
 from src.database import get_db
 from src.routes.auth import get_current_user_id
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/produtos", tags=["Produtos"]) 
+router = APIRouter(prefix="/produtos", tags=["Produtos"], route_class=TimedRoute) 
 
 class ProdutoCreate(BaseModel):
     nome: str
@@ -18,8 +20,9 @@ class ProdutoCreate(BaseModel):
     estoque_total: int = 0
 
 @router.get("", response_model=List[dict])
-def listar_produtos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
-    """Lista produtos ativos com estoque total agregado."""
+def listar_produtos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id),
+                    _etag: None = Depends(CatalogETag(PRODUTOS))):
+    """Lista produtos ativos com estoque total agregado (304 se o catálogo não mudou)."""
     query = text("""
         SELECT 
             p.id_produto,
@@ -69,6 +72,7 @@ def criar_produto(produto: ProdutoCreate, db: Session = Depends(get_db), current
             })
         
         db.commit()
+        bump_catalog_version(db, PRODUTOS)
         
         return {
             "id_produto": id_produto,
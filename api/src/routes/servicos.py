@@ -3,15 +3,18 @@ from sqlalchemy.orm import Session
 from sqlalchemy import text
 from typing import List
 
+from src.catalog import CatalogETag, bump_catalog_version, SERVICOS, PACOTES
 from src.database import get_db
 from src.routes.auth import get_current_user_id
 from src.schemas import ServicoCreate, ServicoUpdate, ServicoAtivoUpdate
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/servicos", tags=["Servicos"]) 
+router = APIRouter(prefix="/servicos", tags=["Servicos"], route_class=TimedRoute) 
 
 @router.get("", response_model=List[dict])
-def listar_servicos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
-    """Lista serviços ativos"""
+def listar_servicos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id),
+                    _etag: None = Depends(CatalogETag(SERVICOS))):
+    """Lista serviços ativos (304 se o If-None-Match bater com a versão do catálogo)"""
     query = text("""
         SELECT id_servico, nome, descricao, preco_base, duracao_padrao, ativo, created_at
         FROM servicos
@@ -37,6 +40,7 @@ def criar_servico(payload: ServicoCreate, db: Session = Depends(get_db), current
         })
         rid = db.execute(text("SELECT LAST_INSERT_ID() AS id")).fetchone()[0]
         db.commit()
+        bump_catalog_version(db, SERVICOS, PACOTES)
         return {"id_servico": rid, "message": "Serviço criado com sucesso"}
     except Exception as e:
         db.rollback()
@@ -58,6 +62,7 @@ def atualizar_servico(id_servico: int, payload: ServicoUpdate, db: Session = Dep
         q = text(f"UPDATE servicos SET {', '.join(set_parts)} WHERE id_servico = :id")
         db.execute(q, params)
         db.commit()
+        bump_catalog_version(db, SERVICOS, PACOTES)
         return {"message": "Serviço atualizado"}
     except HTTPException:
         raise
@@ -71,6 +76,7 @@ def atualizar_ativo(id_servico: int, payload: ServicoAtivoUpdate, db: Session =
         q = text("UPDATE servicos SET ativo = :ativo WHERE id_servico = :id")
         db.execute(q, {"ativo": payload.ativo, "id": id_servico})
         db.commit()
+        bump_catalog_version(db, SERVICOS, PACOTES)
         return {"message": f"Serviço {'ativado' if payload.ativo else 'inativado'}"}
     except Exception as e:
         db.rollback()
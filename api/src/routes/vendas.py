@@ -3,11 +3,13 @@ from sqlalchemy.orm import Session
 from typing import List
 import json
 
+from src.catalog import bump_catalog_version, PRODUTOS
 from src.database import get_db
 from src.schemas import VendaCreate, VendaResponse
 from src.routes.auth import get_current_user_id
+from src.server_timing import TimedRoute
 
-router = APIRouter(prefix="/vendas", tags=["Vendas"])
+router = APIRouter(prefix="/vendas", tags=["Vendas"], route_class=TimedRoute)
 
 @router.post("", response_model=VendaResponse)
 def registrar_venda(venda: VendaCreate, db: Session = Depends(get_db), current_user: int = Depends(get_current_user_id)):
@@ -42,6 +44,8 @@ def registrar_venda(venda: VendaCreate, db: Session = Depends(get_db), current_u
         # Busca valores de saída
         result = db.execute("SELECT @p_id_venda AS id_venda, @p_valor_final AS valor_final").fetchone()
         db.commit()
+        # A venda baixa o estoque: muda o estoque_total de /produtos
+        bump_catalog_version(db, PRODUTOS)
         
         return {
             "id_venda": result.id_venda,
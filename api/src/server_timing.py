@@ -0,0 +1,199 @@
+"""
+Header Server-Timing: onde foi o tempo da requisição (DevTools > Network > Timing)
+
+Fases medidas (ms; as de dentro de "deps"/"app" também aparecem sozinhas):
+- auth:     decodificação do token (AuthContextMiddleware)
+- tenant:   escolha da engine da empresa em get_db/get_db_async
+- checkout: espera por conexão livre no pool (e abertura, se nova)
+- deps:     corpo + validação da entrada + dependencies da rota
+- app:      função da rota
+- db:       soma dos statements (src/query_collector.py)
+- validate: validação do retorno pelo response_model
+- render:   serialização JSON da resposta
+- total:    até o início da resposta
+
+Medido em toda requisição (só perf_counter); o header sai para admins
+(cargo "admin") e, com SERVER_TIMING_PUBLIC, para quem mandar
+X-Server-Timing: 1. As rotas precisam de route_class=TimedRoute e o app de
+default_response_class=TimedJSONResponse; os pools de TimedQueuePool.
+"""
+import functools
+import inspect
+import sys
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from src import profiling
+from src.config import get_settings
+
+settings = get_settings()
+
+REQUEST_HEADER = b"x-server-timing"
+
+_DESCRIPTIONS = {
+    "auth": "JWT",
+    "tenant": "engine da empresa",
+    "checkout": "pool",
+    "deps": "dependencies",
+    "app": "rota",
+    "validate": "response_model",
+    "render": "JSON",
+}
+
+
+class ServerTiming:
+    """Fases de uma requisição (ms acumulados por nome)"""
+
+    __slots__ = ("phases", "endpoint_start", "endpoint_end")
+
+    def __init__(self):
+        self.phases = {}
+        self.endpoint_start = None
+        self.endpoint_end = None
+
+    def add(self, name: str, duration_ms: float):
+        self.phases[name] = self.phases.get(name, 0.0) + duration_ms
+
+    def header(self, db_queries: int, db_time_ms: float, total_ms: float) -> bytes:
+        items = [
+            f'{name};dur={self.phases[name]:.2f};desc="{_DESCRIPTIONS[name]}"'
+            for name in ("auth", "tenant", "checkout", "deps", "app")
+            if name in self.phases
+        ]
+        if db_queries:
+            items.append(f'db;dur={db_time_ms:.2f};desc="{db_queries} queries"')
+        items.extend(
+            f'{name};dur={self.phases[name]:.2f};desc="{_DESCRIPTIONS[name]}"'
+            for name in ("validate", "render")
+            if name in self.phases
+        )
+        items.append(f"total;dur={total_ms:.2f}")
+        return ", ".join(items).encode("latin-1", "replace")
+
+
+_REQUEST_TIMING: ContextVar[Optional[ServerTiming]] = ContextVar("server_timing", default=None)
+
+
+def begin_server_timing():
+    """Abre as medições da requisição. Retorna (ServerTiming, token para end_server_timing)"""
+    timing = ServerTiming()
+    return timing, _REQUEST_TIMING.set(timing)
+
+
+def end_server_timing(token):
+    _REQUEST_TIMING.reset(token)
+
+
+def record(name: str, start: float):
+    """Soma a fase desde start (perf_counter) na requisição atual, se houver"""
+    timing = _REQUEST_TIMING.get()
+    if timing is not None:
+        timing.add(name, (time.perf_counter() - start) * 1000)
+
+
+def wants_header(scope, auth) -> bool:
+    """Admins sempre; os demais pedindo com X-Server-Timing (se permitido)"""
+    if auth is not None and auth.payload and auth.payload.get("cargo") == "admin":
+        return True
+    if not settings.server_timing_public:
+        return False
+    for name, value in scope["headers"]:
+        if name == REQUEST_HEADER:
+            return value not in (b"0", b"false")
+    return False
+
+
+# ==================== Rotas e resposta ====================
+
+def _timed_endpoint(call):
+    """Marca início/fim da função da rota (sync roda na threadpool, mesmo contexto)"""
+    if inspect.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def timed(*args, **kwargs):
+            timing = _REQUEST_TIMING.get()
+            if timing is None:
+                return await call(*args, **kwargs)
+            timing.endpoint_start = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                timing.endpoint_end = time.perf_counter()
+    else:
+        @functools.wraps(call)
+        def timed(*args, **kwargs):
+            timing = _REQUEST_TIMING.get()
+            # Requisição com profiler (src/profiling.py): amostra esta thread
+            profile = profiling.attach_thread(sys._getframe())
+            if timing is not None:
+                timing.endpoint_start = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                if timing is not None:
+                    timing.endpoint_end = time.perf_counter()
+                profiling.detach_thread(profile)
+    timed._server_timing = True
+    return timed
+
+
+class TimedRoute(APIRoute):
+    """
+    APIRoute que separa deps / app / validate: o handler do FastAPI resolve as
+    dependencies, chama a rota, valida o retorno e renderiza a resposta.
+    """
+
+    def get_route_handler(self):
+        if not getattr(self.dependant.call, "_server_timing", False):
+            self.dependant.call = _timed_endpoint(self.dependant.call)
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            timing = _REQUEST_TIMING.get()
+            if timing is None:
+                return await handler(request)
+            start = time.perf_counter()
+            response = await handler(request)
+            if timing.endpoint_start is not None and timing.endpoint_end is not None:
+                timing.add("deps", (timing.endpoint_start - start) * 1000)
+                timing.add("app", (timing.endpoint_end - timing.endpoint_start) * 1000)
+                validate_ms = (time.perf_counter() - timing.endpoint_end) * 1000 - timing.phases.get("render", 0.0)
+                timing.add("validate", max(validate_ms, 0.0))
+            return response
+
+        return timed_handler
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse com o tempo de serialização na fase render"""
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        record("render", start)
+        return body
+
+
+# ==================== Pools ====================
+
+class _TimedCheckout:
+    def _do_get(self):
+        if _REQUEST_TIMING.get() is None:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            record("checkout", start)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    """QueuePool que mede a espera por conexão (fase checkout)"""
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    """Mesmo, para engines async (o checkout roda no greenlet, mesmo contexto)"""
@@ -0,0 +1,17 @@
+-- V17: Versões dos catálogos por empresa (ETag/304 em /servicos, /produtos e /pacotes)
+-- A API incrementa a versão depois de cada escrita no catálogo (inclusive vendas,
+-- que mudam o estoque). Escritas manuais fora da API devem rodar o mesmo UPDATE:
+--   UPDATE catalogo_versoes SET versao = versao + 1 WHERE catalogo = 'produtos';
+
+CREATE TABLE IF NOT EXISTS catalogo_versoes (
+    catalogo VARCHAR(30) NOT NULL,
+    versao BIGINT UNSIGNED NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW() ON UPDATE NOW(),
+    PRIMARY KEY (catalogo)
+);
+
+-- Versão inicial pelo relógio (microssegundos): recriar o banco não repete versões já servidas
+INSERT IGNORE INTO catalogo_versoes (catalogo, versao) VALUES
+    ('servicos', FLOOR(UNIX_TIMESTAMP(NOW(6)) * 1000000)),
+    ('produtos', FLOOR(UNIX_TIMESTAMP(NOW(6)) * 1000000)),
+    ('pacotes', FLOOR(UNIX_TIMESTAMP(NOW(6)) * 1000000));
@@ -17,6 +17,8 @@ module.exports = {
       env_production: {
         NODE_ENV: 'production',
         args: 'src.main:app --host 0.0.0.0 --port 8000 --workers 4',
+        // /metrics soma os 4 workers (esvaziado a cada deploy no post-deploy)
+        PROMETHEUS_MULTIPROC_DIR: '/tmp/petshop-metrics',
       },
       error_file: './logs/api-error.log',
       out_file: './logs/api-out.log',
@@ -55,7 +57,7 @@ module.exports = {
       ref: 'origin/main',
       repo: 'https://github.com/DarlanCavalcante/petshop.git',
       path: '/var/www/petshop',
-      'post-deploy': 'npm install && pm2 reload ecosystem.config.js --env production',
+      'post-deploy': 'npm install && rm -rf /tmp/petshop-metrics && pm2 reload ecosystem.config.js --env production',
     },
   },
 };